@@ -8,69 +8,137 @@
 
 # Imports
 
+# Time for startup timing (imported first so the import phase itself is measured)
+import time
+STARTUP_T0 = time.perf_counter()
 # GUI
 import tkinter as tk
-from tkinter import scrolledtext, filedialog, messagebox
-# HTTP Calls
-import requests
-# JSON file handling to store preferences and settings at appropriate level
+from tkinter import scrolledtext, filedialog, messagebox, ttk
+# JSON file handling for conversations and presets
 import json
 # Threading for background API calls
 import threading
-# Time for timestamps and preference entry tracking
-import time
 # OS for file paths
 import os
-# OpenAI client for efficient and convenient local API calls
-from openai import OpenAI
+# Command-line flags
+import argparse
+# Writing the profile report when the app exits
+import atexit
+# Headless chat engine (history, personality, preferences and backends)
+from chatmax_engine import (
+    ChatSession, DEFAULT_PRESETS, AI_MODELS, REASONING_EFFORTS, PREFS_PATH, PRESETS_PATH, PERSONALITIES_DIR, CONVERSATIONS_DIR,
+    save_settings, get_saved_api_key, get_saved_endpoint, get_saved_ai_model,
+    match_preset_name, load_personality_files, load_last_selected_preset, parse_preset_values,
+    load_startup_config, warm_backends, merge_extraction_settings,
+)
+# Client-side request/token limits shared by chat and extraction
+from chatmax_ratelimit import merge_rate_limits
+# Turns parked in the outbox while the backend is unreachable
+from chatmax_outbox import TurnQueued
+# Server-mode request compression and wire byte counters
+from chatmax_wire import WIRE, merge_compression_settings
+# Server-mode delta-sync counters
+from chatmax_sync import SYNC
+# Latency histograms behind the adaptive timeouts
+from chatmax_latency import get_latency_tracker
+# Per-turn latency tracing shown in the Diagnostics window
+from chatmax_trace import TRACES, STAGE_RENDER
+# Saved-conversation formats (readable/compact/compressed, auto-detected on load)
+from chatmax_convfile import FORMATS, FILE_TYPES, DEFAULT_FORMAT, available_formats, default_extension, write_conversation, read_conversation, strip_extension
+# Background writer for settings/preferences/presets (flushed on exit)
+from chatmax_writer import WRITER
+# Health of the configured server endpoints
+from chatmax_routing import get_endpoint_pool, merge_hedge_policy, HEDGES
+# Recent-conversations catalog for the startup quick-open list
+from chatmax_catalog import ConversationCatalog
+# Timestamp formatting for the quick-open list
+from chatmax_messages import format_ts
+# Time-sliced insertion into the chat view
+from chatmax_render import ChunkedRenderer, DEFAULT_BUDGET_MS, MIN_BUDGET_MS, MAX_BUDGET_MS, clamp_budget
+# Opt-in cProfile/tracemalloc hooks (CHATMAX_PROFILE or --profile)
+from chatmax_profile import PROFILER
 
 
 # Constants
 
-# Paths
-# Preferences are stored in 'preferences.json' as a list of timestamped entries
-PREFS_PATH = os.path.join(os.path.dirname(__file__), 'preferences.json')
-# Settings are stored in 'settings.json' as key-value pair dict of configuration options
-SETTINGS_PATH = os.path.join(os.path.dirname(__file__), 'settings.json')
-
-# Defaults
-# Default maximum chat history entries to keep (can be changed by user via UI)
-HISTORY_DEFAULT_LINES = 20
-# Default maximum preference entries to keep (can be changed by user via UI)
-PREFS_DEFAULT_LINES = 20
-
 # OpenAI API key storage (prompt at startup if not present)
 OPENAI_API_KEY = None
 
-# Built-in presets (shared so they can be referenced at startup)
-DEFAULT_PRESETS = {
-    'Default AI': (2, 1, 0, 30, 1, 0, 0, 1),
-    'Helpful Professional': (2, 2, 0, 35, 1, 0, 0, 1),
-    'Casual Friendly': (3, 0, 0, 25, 1, 1, 0, 1),
-    'Playful Sarcastic': (2, 0, 1, 18, 1, 2, 2, 1),
-    'Child-Friendly': (3, 1, 0, 12, 1, 0, 0, 2),
-    'Stoic Professional': (1, 2, 0, 40, 1, 0, 0, 0),
-    'Sailor-Mouth': (0, 0, 2, 30, 1, 1, 2, 0),
-}
+# Time-to-first-paint target reported by --startup-timing (milliseconds)
+STARTUP_TARGET_MS = 400
+# How often queued (offline) turns are checked for a retry (milliseconds)
+OUTBOX_POLL_MS = 2000
+# Startup phase marks (label, seconds since STARTUP_T0), filled when --startup-timing is set
+startup_marks = None
 
 
 # Functions
 
 # Startup Functions (run on startup)
 
-def build_main_window():
-    global root, menubar, settings_menu, use_local_var, HISTORY_LIMIT, PREFS_LIMIT, OPENAI_API_KEY, SERVER_ENDPOINT, endpoint, history, full_history, current_conversation_path, unsaved_changes, conv_title, chat_area, entry, send_btn, show_timestamps_var, show_ts_cb, summary_label, friendliness_var, professionalism_var, profanity_var, age_var, gender_var, humor_var, sarcasm_var, introversion_var
+def mark_startup(label: str):
+    if startup_marks is not None:
+        startup_marks.append((label, time.perf_counter() - STARTUP_T0))
+
+
+def report_startup_timing():
+    if not startup_marks:
+        return
+    print('[startup] phase timings (ms since launch):')
+    for label, t in startup_marks:
+        print(f'[startup]   {label:<22} {t * 1000:8.1f}')
+    paint = next((t for label, t in startup_marks if label == 'first paint'), None)
+    if paint is not None:
+        status = 'OK' if paint * 1000 <= STARTUP_TARGET_MS else 'OVER TARGET'
+        print(f'[startup] time-to-first-paint {paint * 1000:.1f} ms (target {STARTUP_TARGET_MS} ms): {status}')
+
+
+def on_first_paint(event=None):
+    # Runs once when the main window is first mapped: record the paint and
+    # warm the active network backend in the background so the import cost
+    # is paid while the user is reading/typing, not on the first send
+    if getattr(on_first_paint, 'done', False) or (event is not None and event.widget is not root):
+        return
+    on_first_paint.done = True
+    mark_startup('first paint')
+
+    def warm():
+        try:
+            warm_backends(session.use_local, session.api_key)
+        except Exception:
+            pass
+        mark_startup('backend warmed')
+        try:
+            root.after(0, report_startup_timing)
+        except Exception:
+            report_startup_timing()
+
+    threading.Thread(target=warm, daemon=True).start()
 
-    # Initialize global variables
-    history = []
-    full_history = []
+
+def build_main_window():
+    global root, menubar, settings_menu, use_local_var, conversation_format_var, session, usage_label, OPENAI_API_KEY, SERVER_ENDPOINT, endpoint, history, full_history, current_conversation_path, unsaved_changes, catalog, conv_title, chat_area, renderer, entry, send_btn, show_timestamps_var, show_ts_cb, summary_label, friendliness_var, professionalism_var, profanity_var, age_var, gender_var, humor_var, sarcasm_var, introversion_var
+
+    mark_startup('imports')
+    # Read settings.json, presets.json and personalities/ once up front
+    startup_config = load_startup_config()
+    _loaded_settings = startup_config['settings']
+    mark_startup('config loaded')
+
+    # The headless session owns history, limits, personality and backends,
+    # `history` and `full_history` are kept as aliases of its lists
+    session = ChatSession(_loaded_settings)
+    history = session.history
+    full_history = session.full_history
     current_conversation_path = None
     unsaved_changes = False
+    catalog = ConversationCatalog(CONVERSATIONS_DIR)
 
     # Tkinter root window
     root = tk.Tk()
     root.title("Chat Test")
     root.geometry("800x600")
+    root.bind('<Map>', on_first_paint, add='+')
 
     # Menu bar
     menubar = tk.Menu(root)
@@ -78,6 +146,9 @@ def build_main_window():
     file_menu.add_command(label='New...', command=new_conversation)
     file_menu.add_command(label='Save...', command=save_conversation)
     file_menu.add_command(label='Load...', command=load_conversation_file)
+    file_menu.add_command(label='Recent...', command=open_recent_conversations)
+    file_menu.add_command(label='Usage...', command=show_usage)
+    file_menu.add_command(label='Retry Queued Messages', command=retry_queued_now)
     file_menu.add_separator()
     file_menu.add_command(label='Exit', command=on_exit)
     menubar.add_cascade(label='Conversation', menu=file_menu)
@@ -93,13 +164,11 @@ def build_main_window():
 
     # Settings menu
     settings_menu = tk.Menu(menubar, tearoff=0)
-    # Ensure use_local_var exists (loaded earlier near UI setup, if not, provide default)
-    if 'use_local_var' not in globals():
-        try:
-            _loaded_settings = load_settings()
-            use_local_var = tk.BooleanVar(value=bool(_loaded_settings.get('use_local_ai', True)))
-        except Exception:
-            use_local_var = tk.BooleanVar(value=True)
+    # Expose the persisted use_local_ai setting as a Tk var for menu toggling
+    try:
+        use_local_var = tk.BooleanVar(value=bool(_loaded_settings.get('use_local_ai', True)))
+    except Exception:
+        use_local_var = tk.BooleanVar(value=True)
 
     settings_menu.add_checkbutton(label='Use Local OpenAI API Key', variable=use_local_var, command=toggle_use_local)
     settings_menu.add_command(label='API Key...', command=manage_api_key)
@@ -108,7 +177,29 @@ def build_main_window():
     settings_menu.add_separator()
     settings_menu.add_command(label='AI Chat Memory Limit...', command=limit_chat)
     settings_menu.add_command(label='AI Preference Memory Limit...', command=limit_prefs)
+    settings_menu.add_command(label='Preference Extraction...', command=manage_extraction)
+    settings_menu.add_command(label='Timeouts...', command=manage_timeouts)
+    settings_menu.add_command(label='Rate Limits...', command=manage_rate_limits)
+    # Duplicate server requests that run past the observed p95
+    hedge_var = tk.BooleanVar(value=merge_hedge_policy(_loaded_settings.get('hedge_policy'))['enabled'])
+    settings_menu.add_checkbutton(label='Hedge Slow Server Requests', variable=hedge_var, command=lambda: toggle_hedging(hedge_var.get()))
+    # gzip request bodies in server mode (servers that reject it get plain JSON)
+    gzip_var = tk.BooleanVar(value=merge_compression_settings(_loaded_settings.get('server_compression'))['enabled'])
+    settings_menu.add_checkbutton(label='Compress Server Requests (gzip)', variable=gzip_var, command=lambda: toggle_compression(gzip_var.get()))
+    # Send only new messages to servers that cache conversations (others get full payloads)
+    delta_sync_var = tk.BooleanVar(value=bool(_loaded_settings.get('server_delta_sync', False)))
+    settings_menu.add_checkbutton(label='Send Only New Messages (Delta Sync)', variable=delta_sync_var, command=lambda: toggle_delta_sync(delta_sync_var.get()))
     settings_menu.add_command(label='Clear Preferences...', command=clear_prefs)
+    # Format used when saving conversations (loading detects any format)
+    conversation_format_var = tk.StringVar(value=_loaded_settings.get('conversation_format') or DEFAULT_FORMAT)
+    format_menu = tk.Menu(settings_menu, tearoff=0)
+    for fmt in available_formats():
+        format_menu.add_radiobutton(label=FORMATS[fmt][0], variable=conversation_format_var, value=fmt,
+                                    command=lambda: save_settings(bool(use_local_var.get()), conversation_format=conversation_format_var.get()))
+    settings_menu.add_cascade(label='Conversation File Format', menu=format_menu)
+    settings_menu.add_command(label='Chat View Frame Budget...', command=manage_render_budget)
+    settings_menu.add_separator()
+    settings_menu.add_command(label='Diagnostics...', command=open_diagnostics_window)
     menubar.add_cascade(label='Settings', menu=settings_menu)
 
     # Conversation title label (shows filename or 'New Conversation')
@@ -122,6 +213,8 @@ def build_main_window():
     # Configure tags for colored labels
     chat_area.tag_configure('user_label', foreground='#003366', font=(None, 10, 'bold'))
     chat_area.tag_configure('assistant_label', foreground='#b30000', font=(None, 10, 'bold'))
+    # Long conversations and replies are inserted a slice at a time
+    renderer = ChunkedRenderer(chat_area, _loaded_settings.get('render_budget_ms') or DEFAULT_BUDGET_MS)
 
     entry_frame = tk.Frame(root)
     entry_frame.pack(fill=tk.X, padx=10, pady=(0,10))
@@ -129,6 +222,8 @@ def build_main_window():
     entry = tk.Entry(entry_frame, font=("Arial", 12))
     entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0,5))
     entry.bind("<Return>", lambda e: send_message())
+    # First keystroke of a message: warm the connection and pre-build the payload
+    entry.bind("<Key>", lambda e: speculate_turn(first_key=True), add='+')
 
     send_btn = tk.Button(entry_frame, text="Send", command=send_message, 
                          font=("Arial", 12), bg="lightblue")
@@ -152,122 +247,22 @@ def build_main_window():
     summary_label = tk.Label(root, text="", wraplength=400, justify='left', font=(None, 9, 'italic'), fg='gray40')
     summary_label.pack(padx=8, pady=(4,6))
 
+    # Running token/cost totals for the current conversation
+    usage_label = tk.Label(root, text=session.usage.summary_text(), font=(None, 9), fg='gray40')
+    usage_label.pack(padx=8, pady=(0,4))
+
     # Toggle to show/hide timestamps in the chat display
     show_ts_cb = tk.Checkbutton(root, text='Show timestamps', variable=show_timestamps_var, command=render_history)
     show_ts_cb.pack(padx=8, pady=(0,6), anchor='w')
 
-    # Load persisted settings (use_local_ai) and expose a Tk var for menu toggling
-    try:
-        # _loaded_settings = load_settings()
-        # If use_local_var already exists (created earlier for the settings menu), reuse it
-        if 'use_local_var' in globals() and isinstance(use_local_var, tk.BooleanVar):
-            try:
-                use_local_var.set(bool(_loaded_settings.get('use_local_ai', True)))
-            except Exception:
-                pass
-        else:
-            use_local_var = tk.BooleanVar(value=bool(_loaded_settings.get('use_local_ai', True)))
-    except Exception:
-        if 'use_local_var' in globals() and isinstance(use_local_var, tk.BooleanVar):
-            try:
-                use_local_var.set(True)
-            except Exception:
-                pass
-        else:
-            use_local_var = tk.BooleanVar(value=True)
-
-    # Initialize runtime history & preference limits from settings (clamp to reasonable bounds)
-    try:
-        _hist_val = None
-        try:
-            _hist_val = int(_loaded_settings.get('ai_history_lines')) if isinstance(_loaded_settings, dict) and _loaded_settings.get('ai_history_lines') is not None else None
-        except Exception:
-            _hist_val = None
-        if _hist_val is None:
-            HISTORY_LIMIT = HISTORY_DEFAULT_LINES
-        else:
-            HISTORY_LIMIT = max(0, min(50, int(_hist_val)))
-    except Exception:
-        HISTORY_LIMIT = HISTORY_DEFAULT_LINES
-    try:
-        _pref_val = None
-        try:
-            _pref_val = int(_loaded_settings.get('pref_memory_lines')) if isinstance(_loaded_settings, dict) and _loaded_settings.get('pref_memory_lines') is not None else None
-        except Exception:
-            _pref_val = None
-        if _pref_val is None:
-            PREFS_LIMIT = PREFS_DEFAULT_LINES
-        else:
-            PREFS_LIMIT = max(0, min(50, int(_pref_val)))
-    except Exception:
-        PREFS_LIMIT = PREFS_DEFAULT_LINES
-
-    # On startup, attempt to apply the last selected preset stored in presets.json
+    # On startup, apply the last selected preset stored in presets.json
+    # Only a built-in preset or a file in personalities/ is applied, if it was
+    # 'Custom' or not found, revert to DEFAULT_PRESETS['Default AI']
+    last_selected = startup_config['last_selected']
     try:
-        presets_path = os.path.join(os.path.dirname(__file__), 'presets.json')
-        presets_dir = os.path.join(os.path.dirname(__file__), 'personalities')
-        last_selected = None
-        if os.path.exists(presets_path):
-            try:
-                with open(presets_path, 'r', encoding='utf-8') as pf:
-                    loaded = json.load(pf)
-                last_selected = loaded.get('last_selected') if isinstance(loaded, dict) else None
-            except Exception:
-                last_selected = None
-
-        # Only apply if last_selected is a built-in preset or a file in personalities/
-        if last_selected:
-            applied = False
-            if last_selected in DEFAULT_PRESETS:
-                vals = DEFAULT_PRESETS[last_selected]
-                friendliness_var.set(vals[0])
-                professionalism_var.set(vals[1])
-                profanity_var.set(vals[2])
-                age_var.set(vals[3])
-                gender_var.set(vals[4])
-                humor_var.set(vals[5])
-                sarcasm_var.set(vals[6])
-                introversion_var.set(vals[7])
-                applied = True
-            else:
-                # check personalities/ for a matching file
-                try:
-                    fn = os.path.join(presets_dir, f"{last_selected}.json")
-                    if os.path.exists(fn):
-                        with open(fn, 'r', encoding='utf-8') as pf:
-                            loaded = json.load(pf)
-                        vals = None
-                        if isinstance(loaded, list):
-                            vals = loaded
-                        elif isinstance(loaded, dict) and 'values' in loaded:
-                            vals = loaded.get('values')
-                        if vals and len(vals) >= 8:
-                            vals = [int(x) for x in vals[:8]]
-                            friendliness_var.set(vals[0])
-                            professionalism_var.set(vals[1])
-                            profanity_var.set(vals[2])
-                            age_var.set(vals[3])
-                            friendliness_var.set(vals[4])
-                            humor_var.set(vals[5])
-                            sarcasm_var.set(vals[6])
-                            introversion_var.set(vals[7])
-                            applied = True
-                except Exception:
-                    applied = False
-                # If last_selected was 'Custom' or not found, revert to DEFAULT_PRESETS['Default AI']
-                if not last_selected or not applied:
-                    vals = DEFAULT_PRESETS.get('Default AI')
-                    friendliness_var.set(vals[0])
-                    professionalism_var.set(vals[1])
-                    professionalism_var.set(vals[2])
-                    age_var.set(vals[3])
-                    gender_var.set(vals[4])
-                    humor_var.set(vals[5])
-                    sarcasm_var.set(vals[6])
-                    introversion_var.set(vals[7])
-                # If a saved preset was applied, the UI will be refreshed later after
-                # summary/title helper functions are defined
-                # Avoid calling them here to prevent editor/static-analysis 'not defined' warnings
+        if last_selected and not session.apply_preset(last_selected):
+            session.apply_preset('Default AI')
+        _set_personality_vars(session.personality)
     except Exception:
         pass
 
@@ -276,9 +271,9 @@ def build_main_window():
     try:
         try:
             # Determine saved credentials and any metadata about deletions
-            loaded_meta = load_settings() or {}
-            saved_key = get_saved_api_key()
-            saved_ep = get_saved_endpoint()
+            loaded_meta = _loaded_settings or {}
+            saved_key = loaded_meta.get('openai_api_key') or None
+            saved_ep = loaded_meta.get('server_endpoint') or None
 
             OPENAI_API_KEY = saved_key  # set global variable for immediate use
             SERVER_ENDPOINT = saved_ep  # set global variable for immediate use
@@ -329,189 +324,67 @@ def build_main_window():
         pass
 
     # On startup, show the last-selected preset in the conversation title (if available)
-    try:
-        presets_path = os.path.join(os.path.dirname(__file__), 'presets.json')
-        if os.path.exists(presets_path):
-            try:
-                with open(presets_path, 'r', encoding='utf-8') as pf:
-                    loaded = json.load(pf)
-                last_sel = loaded.get('last_selected') if isinstance(loaded, dict) else None
-            except Exception:
-                last_sel = None
-        if last_sel:
-            try:
-                set_conversation_title(None, last_sel)
-            except Exception:
-                pass
-    except Exception:
-        pass
+    if last_selected:
+        try:
+            set_conversation_title(None, last_selected)
+        except Exception:
+            pass
 
     # Schedule prompt shortly after mainloop starts so dialogs are shown properly
     try:
         root.after(200, prompt_load_on_startup)
+        # Deliver queued (offline) turns once the backend answers again
+        root.after(OUTBOX_POLL_MS, poll_outbox)
     except Exception:
         pass
+    mark_startup('window built')
 
 
-def load_prefs_list():
-    try:
-        if not os.path.exists(PREFS_PATH):
-            # No preferences file yet, return empty list
-            return []
-        with open(PREFS_PATH, 'r', encoding='utf-8') as pf:
-            loaded = json.load(pf)
-        out = []
-        if isinstance(loaded, list):
-            for item in loaded:
-                if isinstance(item, dict) and 'line' in item:
-                    try:
-                        ts = int(item.get('ts')) if item.get('ts') is not None else int(time.time())
-                    except Exception:
-                        ts = int(time.time())
-                    out.append({'line': str(item.get('line') or ''), 'ts': ts})
-                else:
-                    # older formats where each list item is a string
-                    out.append({'line': str(item), 'ts': int(time.time())})
-        elif isinstance(loaded, str):
-            for l in loaded.splitlines():
-                l = l.strip()
-                if l:
-                    out.append({'line': l, 'ts': int(time.time())})
-        return out
-    except Exception:
-        return []
+def _personality_vars():
+    # Slider order matches DEFAULT_PRESETS tuples
+    return (friendliness_var, professionalism_var, profanity_var, age_var, gender_var, humor_var, sarcasm_var, introversion_var)
 
 
-def load_settings():
-    try:
-        if os.path.exists(SETTINGS_PATH):
-            with open(SETTINGS_PATH, 'r', encoding='utf-8') as sf:
-                loaded = json.load(sf)
-            return {
-                'use_local_ai': bool(loaded.get('use_local_ai', True)),
-                'openai_api_key': loaded.get('openai_api_key'),
-                'server_endpoint': loaded.get('server_endpoint'),
-                'last_credential_deleted': loaded.get('last_credential_deleted'),
-                'last_credential_deleted_ts': loaded.get('last_credential_deleted_ts'),
-                'ai_history_lines': loaded.get('ai_history_lines'),
-                'pref_memory_lines': loaded.get('pref_memory_lines'),
-                'ai_model': loaded.get('ai_model') or 'gpt-4o-mini'
-            }
-    except Exception:
-        pass
-    return {'use_local_ai': True, 'openai_api_key': None, 'server_endpoint': None, 'last_credential_deleted': None, 'ai_history_lines': None, 'pref_memory_lines': None, 'ai_model': 'gpt-4o-mini'}
+def current_personality_values():
+    return tuple(int(v.get()) for v in _personality_vars())
 
 
-def get_saved_api_key():
-    try:
-        loaded = load_settings()
-        if isinstance(loaded, dict):
-            key = loaded.get('openai_api_key')
-            if key:
-                return key
-    except Exception:
-        pass
-    return None
+def _set_personality_vars(vals):
+    for var_obj, val in zip(_personality_vars(), vals):
+        var_obj.set(val)
 
 
-def get_saved_endpoint():
+def _sync_session():
+    # Push the UI state (sliders, mode, credentials) into the headless session
+    session.set_personality(current_personality_values())
     try:
-        loaded = load_settings()
-        if isinstance(loaded, dict):
-            ep = loaded.get('server_endpoint')
-            if ep:
-                return ep
+        session.use_local = bool(use_local_var.get())
     except Exception:
-        pass
-    return None
+        session.use_local = True
+    session.reload_credentials()
 
 
-def get_saved_ai_model():
+def speculate_turn(first_key: bool = False):
+    # Pre-warm the backend connection and pre-build the payload prefix in the
+    # background. From the entry box only the first keystroke after a send
+    # (or startup) triggers it, after a reply it runs unconditionally
+    if first_key:
+        if not speculate_turn.armed:
+            return
+        speculate_turn.armed = False
     try:
-        loaded = load_settings()
-        if isinstance(loaded, dict):
-            model = loaded.get('ai_model')
-            if model:
-                return model
+        _sync_session()
+        session.warm_up()
     except Exception:
         pass
-    return 'gpt-4o-mini'
-
-
-def update_summary(*args):
-
-    f = friendliness_var.get()
-    p = professionalism_var.get()
-    r = profanity_var.get()
-    a = age_var.get()
-    g = gender_var.get()
-    h = humor_var.get()
-    s = sarcasm_var.get()
-    i = introversion_var.get()
-    tone = []
-
-    # Friendliness (0-3)
-    if f == 3:
-        tone.append('very friendly')
-    elif f == 2:
-        tone.append('friendly')
-    elif f == 1:
-        tone.append('somewhat reserved')
-    else:
-        tone.append('reserved')
-
-    # Professionalism (0-2)
-    if p == 2:
-        tone.append('professional')
-    elif p == 1:
-        tone.append('somewhat professional')
-    else:
-        tone.append('casual')
-
-    # Profanity (0-2)
-    if r == 2:
-        tone.append('coarse language')
-    elif r == 1:
-        tone.append('somewhat coarse language')
-    else:
-        tone.append('clean language')
-    
-    # Age (5-127)
-    tone.append(f'age {a}')
-
-    # Gender (0-2)
-    if g == 2:
-        tone.append('feminine')
-    elif g == 1:
-        tone.append('gender neutral')
-    else:
-        tone.append('masculine')
 
-    # Humor (0-2)
-    if h == 2:
-        tone.append('strong humour')
-    elif h == 1:
-        tone.append('mild humour')
-    else:
-        tone.append('no humour')
 
-    # Sarcasm (0-2)
-    if s == 2:
-        tone.append('strong sarcasm')
-    elif s == 1:
-        tone.append('mild sarcasm')
-    else:
-        tone.append('no sarcasm')
+speculate_turn.armed = True
 
-    # Extroversion (0-2)
-    if i == 2:
-        tone.append('extroverted')
-    elif i == 1:
-        tone.append('neutral extroversion')
-    else:
-        tone.append('introverted')
 
-    summary_label.config(text='Summary: ' + ', '.join(tone) + f' ')
+def update_summary(*args):
+    session.set_personality(current_personality_values())
+    summary_label.config(text=session.summary())
 
     # After updating summary, also refresh conversation title to show active preset
     try:
@@ -537,7 +410,7 @@ def set_conversation_title(name: str, preset_override: str = None):
         preset_label = None
 
     if name:
-        base = os.path.splitext(name)[0]
+        base = strip_extension(name)
         display = base if base else 'New Conversation'
     else:
         display = 'New Conversation'
@@ -549,37 +422,7 @@ def set_conversation_title(name: str, preset_override: str = None):
 
 
 def determine_active_preset_name():
-    # Build the current tuple
-    tpl = (
-        int(friendliness_var.get()), int(professionalism_var.get()), int(profanity_var.get()),
-        int(age_var.get()), int(gender_var.get()), int(humor_var.get()), int(sarcasm_var.get()), int(introversion_var.get())
-    )
-    # Check built-ins first
-    for name, vals in DEFAULT_PRESETS.items():
-        if tuple(vals) == tpl:
-            return name
-    # Check personalities dir for saved presets
-    try:
-        presets_dir = os.path.join(os.path.dirname(__file__), 'personalities')
-        for fname in os.listdir(presets_dir):
-            if not fname.lower().endswith('.json'):
-                continue
-            full = os.path.join(presets_dir, fname)
-            try:
-                with open(full, 'r', encoding='utf-8') as pf:
-                    loaded = json.load(pf)
-                vals = None
-                if isinstance(loaded, list):
-                    vals = loaded
-                elif isinstance(loaded, dict) and 'values' in loaded:
-                    vals = loaded.get('values')
-                if vals and len(vals) >= 8 and tuple(int(x) for x in vals[:8]) == tpl:
-                    return os.path.splitext(fname)[0]
-            except Exception:
-                continue
-    except Exception:
-        pass
-    return 'Custom'
+    return match_preset_name(current_personality_values())
 
 
 def prompt_for_api_key():
@@ -709,7 +552,7 @@ def prompt_for_endpoint():
         dlg.protocol('WM_DELETE_WINDOW', lambda: None)
         dlg.bind('<Escape>', lambda: None)
 
-        tk.Label(dlg, text='A server endpoint is required for server mode. Enter the full URL (e.g. http://host:port/chat):', wraplength=420, justify='left').pack(padx=16, pady=(12,6))
+        tk.Label(dlg, text='A server endpoint is required for server mode. Enter the full URL (e.g. http://host:port/chat), separate several with commas for failover:', wraplength=420, justify='left').pack(padx=16, pady=(12,6))
         ep_var = tk.StringVar()
         entry = tk.Entry(dlg, textvariable=ep_var, width=60)
         entry.pack(padx=16, pady=(0,8))
@@ -807,134 +650,12 @@ def send_message():
     if not message.strip():
         return
 
-    # Add to history (keep last 10 messages), each entry is (role, message, iso_timestamp)
-    ts = time.strftime('%Y-%m-%d %H:%M:%S')
-    history.append(("You", message, ts))
-    # Also append to the untrimmed full_history for persistence
-    full_history.append(("You", message, ts))
-    try:
-        _trim_history()
-    except Exception:
-        pass
-
-    # Determine the active preset label (use in UI instead of generic 'AI')
-    try:
-        preset_label = determine_active_preset_name()
-    except Exception:
-        preset_label = 'Default AI'
-
-    # Convert GUI history to ChatGPT format under system role
-    # Start with a neutral, blank-slate system instruction, all tone/style should be provided
-    # by subsequent system messages (e.g., personality_instruction and preferences)
-    messages_for_gpt = [{"role": "system", "content": (
-        f"Your name is {preset_label} and you are a user's chat partner. As such, you should keep responses concise, try to adapt them based on the context of the conversation, and for the most part the user's preferences or tone depending on your personality defined below."
-    )}]
-
-    # Personality instructions built from sliders (appended as another system message)
-    def build_personality_instructions():
-        parts = []
-        # core sliders
-        f = friendliness_var.get()
-        p = professionalism_var.get()
-        r = profanity_var.get()
-        a = age_var.get()
-        g = gender_var.get()
-        h = humor_var.get()
-        s = sarcasm_var.get()
-        i = introversion_var.get()
-
-        # Friendliness (0-3)
-        if f == 3:
-            parts.append('Be very friendly, kind and warm.')
-        elif f == 2:
-            parts.append('Be friendly and kind.')
-        elif f == 1:
-            parts.append('Be slightly reserved.')
-        else:
-            parts.append('Be very reserved and blunt.')
-
-        # Professionalism (0-2)
-        if p == 2:
-            parts.append('Maintain a professional tone.')
-        elif p == 1:
-            parts.append('Be somewhat professional.')
-        else:
-            parts.append('Use casual wording.')
-
-        # Profanity (0-2), but enforce age constraint, young voices should not use profanity
-        if a <= 15:
-            # force no profanity for young ages regardless of setting
-            parts.append('Do not use profanity under any circumstances; avoid coarse language due to youthful voice.')
-        else:
-            if r == 2:
-                parts.append('Profanity allowed: high (use strong coarse language as much as possible if it makes sense).')
-            elif r == 1:
-                parts.append('Profanity allowed: moderate (may use mild swear words).')
-            else:
-                parts.append('No profanity; use clean language.')
-
-        # Age (5-127)
-        parts.append(f'Adopt the voice of someone aged {a}.')
-
-        # Gender (0-2)
-        if g == 2:
-            parts.append('Use a feminine voice/wording.')
-        elif g == 0:
-            parts.append('Use a masculine voice/wording.')
-        else:
-            parts.append('Use neutral wording.')
-
-        # Humor (0-2)
-        if h == 2:
-            parts.append('Try and be comedic as much as possible where appropriate.')
-        elif h == 1:
-            parts.append('Use some humour occasionally.')
-        else:
-            parts.append('Avoid humour; be straightforward.')
-
-        # Sarcasm (0-2)
-        if s == 2:
-            parts.append('Sarcasm permitted: use sharp, ironic remarks as much as possible if fitting.')
-        elif s == 1:
-            parts.append('Sarcasm permitted: mild irony allowed.')
-        else:
-            parts.append('Do not use sarcasm; be literal and sincere.')
-
-        # Extroversion (0-2)
-            if i == 2:
-                parts.append('Favor social/outgoing hobbies and confident wording. Be excitable and enthusiastic where appropriate, expressing with exclamation marks more often than not.')
-            elif i == 1:
-                parts.append('No particular bias toward extroversion or introversion.')
-            else:
-                parts.append("Favor solitary/quiet hobbies and mention mild nervousness or reserve in social situations when relevant. Do not be excitable, for instance lay off of exclamation marks unless absolutely necessary.")
-
-        return ' '.join(parts)
-
-    personality_instruction = build_personality_instructions()
-    if personality_instruction:
-        messages_for_gpt.append({"role": "system", "content": personality_instruction})
-
-    # Preferences are loaded from `preferences.json` later in the worker and
-    # inserted as a system message alongside personality instructions
-    # Add each entry under short term history to the payload
-    for entry_item in history:
-        if len(entry_item) >= 2:
-            role = entry_item[0]
-            msg = entry_item[1]
-            messages_for_gpt.append({"role": "user" if role == "You" else "assistant", "content": msg})
-
-    # Ensure the current user message is present in the payload even when
-    # the in-memory short-term history limit is set to 0 (which would
-    # otherwise remove recently-appended items)
-    # Avoid duplicating if it's already present
-    try:
-        if not any(m.get('role') == 'user' and m.get('content') == message for m in messages_for_gpt):
-            messages_for_gpt.append({"role": "user", "content": message})
-    except Exception:
-        try:
-            messages_for_gpt.append({"role": "user", "content": message})
-        except Exception:
-            pass
+    # Record the user's message in the session and build the payload for it
+    # (system prompt, personality instructions, short-term history), each
+    # history entry is (role, message, timestamp)
+    _sync_session()
+    trace = session.new_trace()
+    messages_for_gpt, preset_label, ts = session.begin_turn(message, trace)
 
     # Add user message to chat UI immediately (include timestamp if enabled) and insert AI placeholder
     try:
@@ -954,7 +675,6 @@ def send_message():
     except Exception:
         append_chat(f"{preset_label} is thinking...\n\n")
     entry.delete(0, tk.END)
-    chat_area.see(tk.END)
 
     # Disable send controls while awaiting a reply
     send_btn.config(state=tk.DISABLED)
@@ -969,10 +689,29 @@ def send_message():
         unsaved_changes = True
     except Exception:
         pass
+    # The next message's first keystroke may warm up again
+    speculate_turn.armed = True
 
     # Flag to track if response was received (for timeout handling)
     response_received = [False]
 
+    def enable_controls():
+        try:
+            send_btn.config(state=tk.NORMAL)
+        except Exception:
+            pass
+        # Use the global widget reference to ensure we enable the correct Entry widget
+        try:
+            ent = globals().get('entry')
+            if ent is not None:
+                ent.config(state=tk.NORMAL)
+        except Exception:
+            pass
+        try:
+            show_ts_cb.config(state=tk.NORMAL)
+        except Exception:
+            pass
+
     def timeout_callback():
         if not response_received[0]:
             # Determine timeout message based on current mode
@@ -986,210 +725,21 @@ def send_message():
                 timeout_msg = "Request timed out. Please check your API key or server endpoint configuration."
 
             # Replace the placeholder with timeout error
-            ts = time.strftime('%Y-%m-%d %H:%M:%S')
-            history.append((preset_label, timeout_msg, ts))
-            full_history.append((preset_label, timeout_msg, ts))
-            try:
-                _trim_history()
-            except Exception:
-                pass
-
-            # Re-enable controls
-            try:
-                send_btn.config(state=tk.NORMAL)
-            except Exception:
-                pass
-            try:
-                ent = globals().get('entry')
-                if ent is not None:
-                    ent.config(state=tk.NORMAL)
-            except Exception:
-                pass
-            try:
-                show_ts_cb.config(state=tk.NORMAL)
-            except Exception:
-                pass
+            session.add_message(preset_label, timeout_msg)
 
-            # Re-render the chat area to show the timeout message
+            # Re-enable controls and re-render the chat area to show the timeout message
+            enable_controls()
             render_history()
 
-    # Schedule timeout after 20 seconds
-    timeout_id = root.after(20000, timeout_callback)
+    # Schedule the UI timeout from observed latency of the active backend/model
+    # (see Settings -> Timeouts...)
+    timeout_id = root.after(int(session.turn_timeout() * 1000), timeout_callback)
 
     def worker(payload):
         try:
-            # Attempt to extract new/updated preferences from recent conversation and merge into PREFS_PATH
-            try:
-                # Load current prefs (may be empty)
-                current_prefs = ''
-                if os.path.exists(PREFS_PATH):
-                    try:
-                        with open(PREFS_PATH, 'r', encoding='utf-8') as pf:
-                            current_prefs = pf.read().strip()
-                    except Exception:
-                        current_prefs = ''
-
-                # Build a prompt to extract concise preference lines, from the user's messages only
-                gen_msgs = [
-                    {"role": "system", "content": (
-                        "Extract concise user preference statements from the conversation. "
-                        "Important: consider ONLY the user's messages; ignore all assistant/AI utterances. "
-                        "Output plain text only, one canonical statement per line, using this exact pattern: The user's <property> is <value>. "
-                        "Examples: The user's favourite colour is purple; The user's name is Colin. "
-                        "Do NOT include numbering, explanations, or extra commentary. Compare with the existing preferences below and output ONLY NEW or UPDATED preference lines (one per line). If there are none, output nothing."
-                    )},
-                ]
-
-                # Include existing preferences (migrate/load JSON) as context
-                try:
-                    existing_prefs_list = load_prefs_list()
-                    if existing_prefs_list:
-                        prefs_text = '\n'.join([p.get('line','') for p in existing_prefs_list])
-                        gen_msgs.append({"role": "system", "content": "Existing preferences:\n" + prefs_text})
-                except Exception:
-                    # Fallback to legacy text if something goes wrong
-                    try:
-                        if current_prefs:
-                            gen_msgs.append({"role": "system", "content": "Existing preferences:\n" + current_prefs})
-                    except Exception:
-                        pass
-
-                # Provide recent user-only history as context (limit to last 8 user messages)
-                # history entries may be (role, msg, ts) so don't unpack incorrectly
-                user_msgs = [item[1] for item in history if isinstance(item, (list, tuple)) and len(item) >= 2 and item[0] == "You"]
-                for um in user_msgs[-8:]:
-                    gen_msgs.append({"role": "user", "content": um})
-
-                # Also include the current user message explicitly
-                gen_msgs.append({"role": "user", "content": message})
-
-                # Try to get extracted preferences from the server
-                try:
-                    # Route preference-extraction through local or server API depending on settings
-                    if 'use_local_var' in globals() and use_local_var.get():
-                        gen_text = call_local_openai(gen_msgs)
-                    else:
-                        gen_text = call_server_api(gen_msgs)
-                    extracted = gen_text.strip() if isinstance(gen_text, str) else ''
-                except Exception as e:
-                    extracted = ''
-
-                if extracted:
-                    # New extracted preference lines
-                    new_lines = [l.strip() for l in extracted.splitlines() if l.strip()]
-                    try:
-                        existing = load_prefs_list() or []
-                    except Exception:
-                        existing = []
-
-                    # Build ordered key list and dict keyed by canonical pref key
-                    def pref_key(line):
-                        low = line.lower()
-                        if ' is ' in low:
-                            return low.split(' is ', 1)[0].strip()
-                        return low
-
-                    keys = []
-                    mapping = {}
-                    for item in existing:
-                        ln = item.get('line','').strip()
-                        if not ln:
-                            continue
-                        k = pref_key(ln)
-                        if k in mapping:
-                            # skip duplicates in file, keep first occurrence
-                            continue
-                        mapping[k] = {'line': ln, 'ts': int(item.get('ts') or int(time.time()))}
-                        keys.append(k)
-
-                    # Apply new/updated lines: move updated keys to newest position
-                    for nl in new_lines:
-                        k = pref_key(nl)
-                        entry = {'line': nl, 'ts': int(time.time())}
-                        if k in mapping:
-                            # remove existing key from keys order then re-append (now newest)
-                            try:
-                                keys.remove(k)
-                            except Exception:
-                                pass
-                        mapping[k] = entry
-                        keys.append(k)
-
-                    # Rebuild final ordered list oldest to newest
-                    final = [mapping[k] for k in keys]
-
-                    # Enforce preference entry limit (drop oldest when over limit)
-                    try:
-                        limit = globals().get('PREFS_LIMIT', PREFS_DEFAULT_LINES)
-                        if isinstance(limit, int) and limit >= 0:
-                            while len(final) > int(limit):
-                                final.pop(0)
-                    except Exception:
-                        pass
-
-                    # Persist as JSON list of {line, ts}
-                    try:
-                        save_prefs_list(final)
-                    except Exception:
-                        pass
-            except Exception:
-                # If anything in prefs extraction fails, continue without blocking the main request
-                pass
-
-            # If preferences file exists now, insert its contents as a system message
-            # before any chat history/user messages so preferences are treated as
-            # system-level context alongside personality instructions.
-            try:
-                if os.path.exists(PREFS_PATH):
-                    with open(PREFS_PATH, 'r', encoding='utf-8') as pf:
-                        prefs_text = pf.read().strip()
-                        if prefs_text:
-                            # Find the first index where role != 'system' and insert
-                            insert_idx = 0
-                            for idx, m in enumerate(payload):
-                                try:
-                                    if m.get('role') != 'system':
-                                        insert_idx = idx
-                                        break
-                                except Exception:
-                                    # If message shape unexpected, continue searching
-                                    continue
-                            else:
-                                # all items were system messages; append at end
-                                insert_idx = len(payload)
-                            try:
-                                payload.insert(insert_idx, {"role": "system", "content": prefs_text})
-                            except Exception:
-                                # Fallback to appending if insert fails
-                                try:
-                                    payload.append({"role": "system", "content": prefs_text})
-                                except Exception:
-                                    pass
-            except Exception:
-                pass
-
-            # Send user message either to the local OpenAI API (gpt-4o-mini) or to the configured server endpoint
-            ai_reply = ''
-            try:
-                if 'use_local_var' in globals() and use_local_var.get():
-                    # Local call using the stored API key
-                    ai_reply = call_local_openai(payload)
-                else:
-                    # Centralized server call
-                    ai_reply = call_server_api(payload)
-            except Exception:
-                # Re-raise to be handled by outer exception handler
-                raise
-
-            # Update history (append assistant reply using the active preset label)
-            ts = time.strftime('%Y-%m-%d %H:%M:%S')
-            history.append((preset_label, ai_reply, ts))
-            # Also append to the untrimmed full_history for persistence
-            full_history.append((preset_label, ai_reply, ts))
-            try:
-                _trim_history()
-            except Exception:
-                pass
+            # Preference extraction, preference insertion and the main call all
+            # happen in the session, the reply is appended to history there
+            session.complete_turn(payload, message, preset_label, trace, ts)
 
             # Schedule UI update on main thread: replace the last AI placeholder with real reply
             def on_success():
@@ -1200,45 +750,45 @@ def send_message():
                 except Exception:
                     pass
 
-                # Re-render the chat_area from history to keep it simple and robust
-                render_history()
-                try:
-                    send_btn.config(state=tk.NORMAL)
-                except Exception:
-                    pass
-                # Avoid closing over a name 'entry' from an enclosing scope which
-                # may be shadowed by local variables earlier in this function
-                # (e.g. during preference merging)
-                # Use the global widget reference to ensure we enable the correct Entry widget
-                try:
-                    ent = globals().get('entry')
-                    if ent is not None:
-                        ent.config(state=tk.NORMAL)
-                except Exception:
-                    pass
-                try:
-                    show_ts_cb.config(state=tk.NORMAL)
-                except Exception:
-                    pass
+                # Re-render the chat_area from history to keep it simple and robust;
+                # the render span ends when the last slice has been inserted
+                started = time.perf_counter()
 
-            root.after(0, on_success)
+                def on_rendered():
+                    trace.record_span(STAGE_RENDER, started, time.perf_counter())
+                    TRACES.add(trace.finish())
 
-        except Exception as e:
-            err_text = f"Error: {str(e)}"
+                render_history(on_rendered)
+                update_usage_label()
+                enable_controls()
+                # Get ready for the next message while the user reads this one
+                speculate_turn()
 
-            # Append an error entry to history (use preset label)
-            ts = time.strftime('%Y-%m-%d %H:%M:%S')
-            history.append((preset_label, err_text, ts))
-            full_history.append((preset_label, err_text, ts))
-            try:
-                _trim_history()
-            except Exception:
-                pass
+            root.after(0, on_success)
+
+        except TurnQueued as q:
+            # Offline: the message is kept in the outbox and its reply is
+            # slotted in when delivery succeeds (see poll_outbox)
+            queued_text = str(q)
+            response_received[0] = True
             try:
-                _trim_history()
+                root.after_cancel(timeout_id)
             except Exception:
                 pass
 
+            def on_queued():
+                enable_controls()
+                render_history()
+                TRACES.add(trace.finish(queued_text))
+                update_usage_label()
+
+            root.after(0, on_queued)
+
+        except Exception as e:
+            # Append an error entry to history (use preset label)
+            err_text = f"Error: {str(e)}"
+            session.add_message(preset_label, err_text)
+
             # Mark response as received to cancel timeout (even for errors)
             response_received[0] = True
             try:
@@ -1248,27 +798,21 @@ def send_message():
 
             # Re-enable controls on error
             def on_error():
-                try:
-                    send_btn.config(state=tk.NORMAL)
-                except Exception:
-                    pass
-                try:
-                    ent = globals().get('entry')
-                    if ent is not None:
-                        ent.config(state=tk.NORMAL)
-                except Exception:
-                    pass
-                try:
-                    show_ts_cb.config(state=tk.NORMAL)
-                except Exception:
-                    pass
-                render_history()
+                enable_controls()
+                started = time.perf_counter()
+
+                def on_rendered():
+                    trace.record_span(STAGE_RENDER, started, time.perf_counter())
+                    TRACES.add(trace.finish(err_text))
+
+                render_history(on_rendered)
+                update_usage_label()
 
             root.after(0, on_error)
 
 
     # Start the worker thread to handle the API call asynchronously
-    thread = threading.Thread(target=worker, args=(messages_for_gpt,), daemon=True)
+    thread = threading.Thread(target=PROFILER.wrap('worker', worker), args=(messages_for_gpt,), daemon=True)
     thread.start()
 
 
@@ -1295,17 +839,32 @@ def select_ai_model():
         model_var = tk.StringVar(value=cur)
 
         # Radio buttons for models
-        models = ['gpt-4o-mini', 'gpt-5-nano', 'gpt-5-mini']
-        for model in models:
+        for model in AI_MODELS:
             tk.Radiobutton(dlg, text=model, variable=model_var, value=model).pack(anchor='w', padx=16)
 
+        # Latency budget for this conversation (also the default for new ones)
+        budget_frame = tk.Frame(dlg)
+        budget_frame.pack(anchor='w', padx=16, pady=(10,0))
+        tk.Label(budget_frame, text='Latency budget (seconds, empty = off):').pack(side=tk.LEFT)
+        budget_var = tk.StringVar(value='' if session.latency_budget is None else f'{session.latency_budget:g}')
+        tk.Entry(budget_frame, textvariable=budget_var, width=6).pack(side=tk.LEFT, padx=(6,0))
+        race_var = tk.BooleanVar(value=session.race_models)
+        tk.Checkbutton(dlg, text='Race a faster model from the start and show the first answer', variable=race_var).pack(anchor='w', padx=16)
+        tk.Label(dlg, text='If the chosen model has not replied within the budget, a faster model is asked as well and the first answer is used.', wraplength=400, justify='left', fg='gray40').pack(anchor='w', padx=16, pady=(2,0))
+
         btn_frame = tk.Frame(dlg)
         btn_frame.pack(pady=(12,14))
 
         def on_save():
             selected = model_var.get()
             try:
-                save_settings(True, ai_model=selected)
+                budget = float(budget_var.get()) if budget_var.get().strip() else None
+            except ValueError:
+                messagebox.showerror('AI Model', 'The latency budget must be a number of seconds.', parent=dlg)
+                return
+            session.set_model_budget({'budget_s': budget, 'race': race_var.get()})
+            try:
+                save_settings(True, ai_model=selected, model_budget=session.model_budget())
             except Exception:
                 pass
             try:
@@ -1342,10 +901,14 @@ def load_history():
 
 def new_conversation():
     if messagebox.askyesno("New Conversation", "Start a new conversation? This will clear the current chat history."):
-        history.clear()
-        full_history.clear()
+        if not keep_unsaved_queue():
+            return
+        # Stop inserting the old conversation before clearing it
+        renderer.cancel()
+        session.clear()
         # Re-render (will clear the display and keep widget state consistent)
         render_history()
+        update_usage_label()
         set_conversation_title('New Conversation')
         # Reset saved-state tracking
         try:
@@ -1358,24 +921,22 @@ def new_conversation():
 
 def save_conversation():
     # Default to the 'conversations' folder next to the script
-    conv_dir = os.path.join(os.path.dirname(__file__), 'conversations')
+    conv_dir = CONVERSATIONS_DIR
     try:
         os.makedirs(conv_dir, exist_ok=True)
     except Exception:
         pass
-    path = filedialog.asksaveasfilename(initialdir=conv_dir, defaultextension='.json', filetypes=[('JSON files','*.json'), ('All files','*.*')])
+    fmt = conversation_format_var.get() if conversation_format_var.get() in FORMATS else DEFAULT_FORMAT
+    path = filedialog.asksaveasfilename(initialdir=conv_dir, defaultextension=default_extension(fmt), filetypes=FILE_TYPES)
     if not path:
         return False
     try:
-        # Save the full, untrimmed conversation (full_history)
-        serial = []
-        for item in full_history:
-            if isinstance(item, (list, tuple)):
-                serial.append(list(item))
-            else:
-                serial.append([str(item)])
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(serial, f, ensure_ascii=False, indent=2)
+        # Save the full, untrimmed conversation (full_history) with its token usage
+        write_conversation(path, session.full_history, session.conversation_meta(), fmt)
+        try:
+            catalog.record(path, session.full_history)
+        except Exception:
+            pass
         # Update conversation title to the saved filename (strip directory and extension)
         try:
             fname = os.path.basename(path)
@@ -1396,56 +957,55 @@ def save_conversation():
         return False
 
 
-def load_conversation_file():
-    # Default to the 'conversations' folder next to the script
-    conv_dir = os.path.join(os.path.dirname(__file__), 'conversations')
-    try:
-        os.makedirs(conv_dir, exist_ok=True)
-    except Exception:
-        pass
-    path = filedialog.askopenfilename(initialdir=conv_dir, filetypes=[('JSON files','*.json'), ('All files','*.*')])
+def load_conversation_file(path: str | None = None):
+    # Ask for a file unless one was picked already (e.g. from the recent list)
     if not path:
-        return
+        # Default to the 'conversations' folder next to the script
+        conv_dir = CONVERSATIONS_DIR
+        try:
+            os.makedirs(conv_dir, exist_ok=True)
+        except Exception:
+            pass
+        path = filedialog.askopenfilename(initialdir=conv_dir, filetypes=FILE_TYPES)
+    if not path:
+        return False
+    if not keep_unsaved_queue():
+        return False
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        # Expecting a list of [role, message] pairs
-        if isinstance(data, list):
-            history.clear()
-            full_history.clear()
-            for item in data:
-                # item may be [role, message] or [role, message, timestamp]
-                if isinstance(item, list) or isinstance(item, tuple):
-                    if len(item) >= 2:
-                        role = item[0]
-                        msg = item[1]
-                        ts = item[2] if len(item) > 2 else time.strftime('%Y-%m-%d %H:%M:%S')
-                        history.append((role, msg, ts))
-                        full_history.append((role, msg, ts))
-            render_history()
-            set_conversation_title(os.path.basename(path))
-            # update saved-state tracking
-            try:
-                global current_conversation_path, unsaved_changes
-                current_conversation_path = path
-                unsaved_changes = False
-            except Exception:
-                pass
-            messagebox.showinfo('Loaded', f'Conversation loaded from {path}')
+        # Any saved format (readable, compact, compressed, msgpack or the
+        # older bare list) is detected from the file's content
+        messages, meta = read_conversation(path)
+        # Stop inserting the previous conversation before switching
+        renderer.cancel()
+        session.load_conversation(messages, meta)
+        try:
+            catalog.record(path, messages)
+        except Exception:
+            pass
+        render_history()
+        update_usage_label()
+        set_conversation_title(os.path.basename(path))
+        # Turns queued while this conversation was last open are retried now
+        if session.queued_count():
+            session.outbox.retry_now(session.conversation_id)
+        # update saved-state tracking
+        try:
+            global current_conversation_path, unsaved_changes
+            current_conversation_path = path
+            unsaved_changes = False
+        except Exception:
+            pass
+        messagebox.showinfo('Loaded', f'Conversation loaded from {path}')
+        return True
     except Exception as e:
         messagebox.showerror('Load error', str(e))
+        return False
 
 
 def limit_chat():
     try:
-        # Determine current value (fallback to 10 if not set)
-        cur = globals().get('HISTORY_LIMIT', None)
-        if cur is None:
-            try:
-                loaded = load_settings() or {}
-                cur = int(loaded.get('ai_history_lines') or 10)
-            except Exception:
-                cur = 10
+        # Current value comes from the session (initialized from settings)
+        cur = session.history_limit
         # Present a slider dialog (0-50) so users can visually set the limit
         dlg = tk.Toplevel(root)
         dlg.title('AI Chat Memory Limit')
@@ -1483,10 +1043,7 @@ def limit_chat():
                 save_settings(bool(cur_use), ai_history_lines=int(val))
             except Exception:
                 pass
-            try:
-                globals()['HISTORY_LIMIT'] = int(val)
-            except Exception:
-                globals()['HISTORY_LIMIT'] = cur
+            session.history_limit = int(val)
             try:
                 dlg.destroy()
             except Exception:
@@ -1522,14 +1079,8 @@ def limit_chat():
 
 def limit_prefs():
     try:
-        # Determine current value (fallback to PREFS_LIMIT or default)
-        cur = globals().get('PREFS_LIMIT', None)
-        if cur is None:
-            try:
-                loaded = load_settings() or {}
-                cur = int(loaded.get('pref_memory_lines') or PREFS_DEFAULT_LINES)
-            except Exception:
-                cur = PREFS_DEFAULT_LINES
+        # Current value comes from the session (initialized from settings)
+        cur = session.prefs_limit
         # Present a slider dialog (0-50) for preference entry limit
         dlg = tk.Toplevel(root)
         dlg.title('AI Preference Memory Limit')
@@ -1566,10 +1117,7 @@ def limit_prefs():
                 save_settings(bool(cur_use), pref_memory_lines=int(val))
             except Exception:
                 pass
-            try:
-                globals()['PREFS_LIMIT'] = int(val)
-            except Exception:
-                globals()['PREFS_LIMIT'] = cur
+            session.prefs_limit = int(val)
             try:
                 dlg.destroy()
             except Exception:
@@ -1603,9 +1151,234 @@ def limit_prefs():
             pass
 
 
+def manage_rate_limits():
+    try:
+        cur = session.rate_limits
+        dlg = tk.Toplevel(root)
+        dlg.title('Rate Limits')
+        try:
+            dlg.transient(root)
+        except Exception:
+            pass
+        dlg.resizable(False, False)
+        tk.Label(dlg, text='Chat replies and preference extraction share these limits per API key (or server). Replies are sent before queued extraction calls, and when the API answers 429 everything waits for its Retry-After. Leave a limit empty for none.', wraplength=420, justify='left').pack(padx=12, pady=(10,6), anchor='w')
+        form = tk.Frame(dlg)
+        form.pack(padx=12, pady=(4,6), anchor='w')
+        fields = [
+            ('rpm', 'Requests per minute'),
+            ('tpm', 'Tokens per minute'),
+            ('max_wait_s', 'Longest wait for a slot (seconds)'),
+            ('retries', 'Retries after a 429'),
+        ]
+        vars_ = {}
+        for row, (key, label) in enumerate(fields):
+            tk.Label(form, text=label).grid(row=row, column=0, sticky='w', pady=2)
+            vars_[key] = tk.StringVar(value='' if cur.get(key) is None else f'{cur[key]:g}')
+            tk.Entry(form, textvariable=vars_[key], width=10).grid(row=row, column=1, sticky='w', padx=(8,0), pady=2)
+
+        def on_save():
+            try:
+                limits = {k: (float(v.get()) if v.get().strip() else None) for k, v in vars_.items()}
+            except ValueError:
+                messagebox.showerror('Rate Limits', 'Please enter numbers only.', parent=dlg)
+                return
+            session.rate_limits = merge_rate_limits(limits)
+            try:
+                save_settings(bool(use_local_var.get()), rate_limits=session.rate_limits)
+            except Exception:
+                pass
+            try:
+                dlg.destroy()
+            except Exception:
+                pass
+
+        btnf = tk.Frame(dlg)
+        btnf.pack(pady=(6,12))
+        tk.Button(btnf, text='Save', command=on_save, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Cancel', command=lambda: dlg.destroy(), width=10).pack(side=tk.LEFT, padx=6)
+        try:
+            dlg.grab_set()
+            root.wait_window(dlg)
+        except Exception:
+            try:
+                root.wait_window(dlg)
+            except Exception:
+                pass
+    except Exception as e:
+        try:
+            messagebox.showerror('Rate Limits', str(e))
+        except Exception:
+            pass
+
+
+def manage_extraction():
+    try:
+        cur = session.extraction
+        dlg = tk.Toplevel(root)
+        dlg.title('Preference Extraction')
+        try:
+            dlg.transient(root)
+        except Exception:
+            pass
+        dlg.resizable(False, False)
+        tk.Label(dlg, text='Preferences are extracted from each message with a separate call. A small, fast model is usually enough (local mode only, server mode always uses the server).', wraplength=420, justify='left').pack(padx=12, pady=(10,6), anchor='w')
+
+        model_var = tk.StringVar(value=cur['model'])
+        for model in AI_MODELS:
+            tk.Radiobutton(dlg, text=model, variable=model_var, value=model).pack(anchor='w', padx=16)
+
+        form = tk.Frame(dlg)
+        form.pack(padx=12, pady=(8,6), anchor='w')
+        tk.Label(form, text='Reasoning effort (gpt-5)').grid(row=0, column=0, sticky='w', pady=2)
+        effort_var = tk.StringVar(value=cur['reasoning_effort'])
+        ttk.Combobox(form, textvariable=effort_var, values=REASONING_EFFORTS, state='readonly', width=10).grid(row=0, column=1, sticky='w', padx=(8,0), pady=2)
+        tk.Label(form, text='Max output tokens').grid(row=1, column=0, sticky='w', pady=2)
+        tokens_var = tk.StringVar(value=str(cur['max_tokens']))
+        tk.Entry(form, textvariable=tokens_var, width=10).grid(row=1, column=1, sticky='w', padx=(8,0), pady=2)
+        tk.Label(form, text='Timeout (seconds, empty = auto)').grid(row=2, column=0, sticky='w', pady=2)
+        timeout_var = tk.StringVar(value='' if cur['timeout_s'] is None else f"{cur['timeout_s']:g}")
+        tk.Entry(form, textvariable=timeout_var, width=10).grid(row=2, column=1, sticky='w', padx=(8,0), pady=2)
+        tk.Label(form, text='Concurrent extractions').grid(row=3, column=0, sticky='w', pady=2)
+        conc_var = tk.StringVar(value=str(cur['concurrency']))
+        tk.Entry(form, textvariable=conc_var, width=10).grid(row=3, column=1, sticky='w', padx=(8,0), pady=2)
+
+        def on_save():
+            try:
+                extraction = {
+                    'model': model_var.get(),
+                    'reasoning_effort': effort_var.get(),
+                    'max_tokens': int(tokens_var.get()),
+                    'timeout_s': float(timeout_var.get()) if timeout_var.get().strip() else None,
+                    'concurrency': int(conc_var.get()),
+                }
+            except ValueError:
+                messagebox.showerror('Preference Extraction', 'Please enter numbers only.', parent=dlg)
+                return
+            session.extraction = merge_extraction_settings(extraction)
+            try:
+                save_settings(bool(use_local_var.get()), extraction=session.extraction)
+            except Exception:
+                pass
+            try:
+                dlg.destroy()
+            except Exception:
+                pass
+
+        btnf = tk.Frame(dlg)
+        btnf.pack(pady=(6,12))
+        tk.Button(btnf, text='Save', command=on_save, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Cancel', command=lambda: dlg.destroy(), width=10).pack(side=tk.LEFT, padx=6)
+        try:
+            dlg.grab_set()
+            root.wait_window(dlg)
+        except Exception:
+            try:
+                root.wait_window(dlg)
+            except Exception:
+                pass
+    except Exception as e:
+        try:
+            messagebox.showerror('Preference Extraction', str(e))
+        except Exception:
+            pass
+
+
+def manage_timeouts():
+    try:
+        tracker = session.latency
+        dlg = tk.Toplevel(root)
+        dlg.title('Timeouts')
+        try:
+            dlg.transient(root)
+        except Exception:
+            pass
+        dlg.resizable(False, False)
+        tk.Label(dlg, text='Request timeouts are derived from observed latency per backend and model: p99 x factor, kept between the floor and ceiling. Until enough replies have been seen the default is used.', wraplength=460, justify='left').pack(padx=12, pady=(10,6), anchor='w')
+
+        # Observed latency and current derived timeouts
+        stats = tk.Text(dlg, width=64, height=8, font=('Courier', 9))
+        stats.pack(padx=12, pady=(0,8))
+
+        def show_stats():
+            lines = [f"{'backend/model':<22}{'samples':>8}{'p50':>9}{'p99':>9}{'timeout':>10}"]
+            rows = tracker.summary_rows()
+            for key, n, p50, p99, t in rows:
+                p50_txt = f'{p50 / 1000:.1f}s' if p50 is not None else '-'
+                p99_txt = f'{p99 / 1000:.1f}s' if p99 is not None else '-'
+                lines.append(f'{key:<22}{n:>8}{p50_txt:>9}{p99_txt:>9}{t:>9.1f}s')
+            if not rows:
+                lines.append('No replies recorded yet.')
+            timed_out = [f'{key} {tracker.timeouts(key)}' for key in [session.latency_key(), session.extraction_key()] if tracker.timeouts(key)]
+            if timed_out:
+                lines.append('Timed out this session (not counted as latency): ' + ', '.join(timed_out))
+            lines.append('')
+            lines.append(f'Current ({session.latency_key()}): {session.call_timeout():.1f}s per call, {session.turn_timeout():.1f}s per message')
+            stats.config(state=tk.NORMAL)
+            stats.delete(1.0, tk.END)
+            stats.insert(tk.END, '\n'.join(lines))
+            stats.config(state=tk.DISABLED)
+
+        show_stats()
+
+        # Policy fields
+        form = tk.Frame(dlg)
+        form.pack(padx=12, pady=(0,6), anchor='w')
+        fields = [('Factor (x p99)', 'factor'), ('Floor (seconds)', 'floor_s'), ('Ceiling (seconds)', 'ceiling_s'), ('Default (seconds)', 'default_s')]
+        field_vars = {}
+        for row, (label_text, key) in enumerate(fields):
+            tk.Label(form, text=label_text).grid(row=row, column=0, sticky='w', pady=2)
+            var = tk.StringVar(value=str(tracker.policy[key]))
+            tk.Entry(form, textvariable=var, width=10).grid(row=row, column=1, sticky='w', padx=(8,0), pady=2)
+            field_vars[key] = var
+
+        def on_save():
+            policy = {}
+            try:
+                for key, var in field_vars.items():
+                    policy[key] = float(var.get())
+            except ValueError:
+                messagebox.showerror('Timeouts', 'Please enter numbers only.', parent=dlg)
+                return
+            policy['min_samples'] = tracker.policy.get('min_samples')
+            try:
+                save_settings(bool(use_local_var.get()), timeout_policy=policy)
+            except Exception:
+                pass
+            session.timeout_policy = policy
+            session.latency = get_latency_tracker(policy)
+            try:
+                dlg.destroy()
+            except Exception:
+                pass
+
+        def on_reset():
+            if messagebox.askyesno('Timeouts', 'Forget all observed latency? Timeouts return to the default until new replies are seen.', parent=dlg):
+                tracker.reset()
+                show_stats()
+
+        btnf = tk.Frame(dlg)
+        btnf.pack(pady=(6,12))
+        tk.Button(btnf, text='Save', command=on_save, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Reset Stats', command=on_reset, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Cancel', command=lambda: dlg.destroy(), width=10).pack(side=tk.LEFT, padx=6)
+        try:
+            dlg.grab_set()
+            root.wait_window(dlg)
+        except Exception:
+            try:
+                root.wait_window(dlg)
+            except Exception:
+                pass
+    except Exception as e:
+        try:
+            messagebox.showerror('Timeouts', str(e))
+        except Exception:
+            pass
+
+
 def clear_prefs():
     try:
-        if not os.path.exists(PREFS_PATH):
+        if WRITER.read_text(PREFS_PATH) is None:
             messagebox.showinfo('Preferences', 'No preferences file to delete')
             return
         # Ask for confirmation before deleting the preferences file
@@ -1617,12 +1390,231 @@ def clear_prefs():
         confirm_msg = f"This app automatically detects and writes your preferences to a file for future reference by {preset_label}. Are you sure you want to delete this file? This will remove all of your saved preferences and cannot be undone."
         if not messagebox.askyesno('Confirm', confirm_msg):
             return
-        os.remove(PREFS_PATH)
+        # Queued behind any pending preference write so it cannot be recreated
+        WRITER.remove(PREFS_PATH)
         messagebox.showinfo('Preferences', 'Preferences cleared.')
     except Exception as e:
         messagebox.showerror('Error', str(e))
 
 
+def update_usage_label():
+    try:
+        text = session.usage.summary_text()
+        queued = session.queued_count()
+        if queued:
+            text += f' · {queued} message(s) queued, retrying'
+        usage_label.config(text=text)
+    except Exception:
+        pass
+
+
+def poll_outbox():
+    # Runs every OUTBOX_POLL_MS: when the conversation's oldest queued turn is
+    # due, deliver queued turns on a worker thread and re-render afterwards
+    try:
+        due = session.outbox.next_due(session.conversation_id)
+        if due is not None and due <= time.time() and not poll_outbox.busy:
+            deliver_outbox()
+    except Exception:
+        pass
+    try:
+        root.after(OUTBOX_POLL_MS, poll_outbox)
+    except Exception:
+        pass
+
+
+poll_outbox.busy = False
+
+
+def deliver_outbox(force: bool = False):
+    poll_outbox.busy = True
+
+    def worker():
+        try:
+            delivered = session.deliver_queued(force)
+        except Exception:
+            delivered = 0
+
+        def done():
+            poll_outbox.busy = False
+            if delivered:
+                global unsaved_changes
+                unsaved_changes = True
+                render_history()
+            update_usage_label()
+
+        try:
+            root.after(0, done)
+        except Exception:
+            poll_outbox.busy = False
+
+    threading.Thread(target=PROFILER.wrap('worker', worker), daemon=True).start()
+
+
+def retry_queued_now():
+    if not session.queued_count():
+        messagebox.showinfo('Queued Messages', 'No messages are waiting to be delivered.')
+        return
+    session.outbox.retry_now(session.conversation_id)
+    if not poll_outbox.busy:
+        deliver_outbox(force=True)
+
+
+def keep_unsaved_queue():
+    # Called before the conversation is closed (New, Load, Exit). Queued turns
+    # are only delivered while their conversation is open, so one that was
+    # never saved has to be saved first: by the user (Yes) or automatically
+    # into the conversations folder (No). False means Cancel, stay put
+    count = session.queued_count()
+    if not count or current_conversation_path is not None:
+        return True
+    resp = messagebox.askyesnocancel(
+        'Queued Messages',
+        f'{count} message(s) in this conversation have not been delivered yet, and the conversation has not been saved.\n\n'
+        'Yes: save the conversation now; the messages are delivered when you open it again.\n'
+        'No: keep them queued; the conversation is saved automatically to the conversations folder.\n'
+        'Cancel: go back to the conversation.')
+    if resp is None:
+        return False
+    if resp is True:
+        return save_conversation()
+    fmt = conversation_format_var.get() if conversation_format_var.get() in FORMATS else DEFAULT_FORMAT
+    path = os.path.join(CONVERSATIONS_DIR, f"queued-{time.strftime('%Y%m%d-%H%M%S')}{default_extension(fmt)}")
+    try:
+        os.makedirs(CONVERSATIONS_DIR, exist_ok=True)
+        write_conversation(path, session.full_history, session.conversation_meta(), fmt)
+    except Exception as e:
+        messagebox.showerror('Queued Messages', f'Could not save the conversation, its queued messages are kept:\n{e}')
+        return False
+    try:
+        catalog.record(path, session.full_history)
+    except Exception:
+        pass
+    messagebox.showinfo('Queued Messages', f'Conversation saved to {path}. Open it to deliver its queued messages.')
+    return True
+
+
+def show_usage():
+    messagebox.showinfo('Usage', session.usage.breakdown_text() + '\n\nCosts are estimates from published per-token prices.')
+
+
+def open_diagnostics_window():
+    # Single instance, raise it if already open
+    if getattr(open_diagnostics_window, 'win', None) and open_diagnostics_window.win.winfo_exists():
+        try:
+            open_diagnostics_window.win.deiconify()
+            open_diagnostics_window.win.lift()
+        except Exception:
+            pass
+        return
+    win = tk.Toplevel(root)
+    win.title('Diagnostics')
+    try:
+        win.transient(root)
+    except Exception:
+        pass
+    win.minsize(520, 320)
+    open_diagnostics_window.win = win
+
+    summary_var = tk.StringVar(value='')
+    tk.Label(win, textvariable=summary_var, font=(None, 9, 'italic'), fg='gray40').pack(anchor='w', padx=8, pady=(8,4))
+
+    # Latency percentiles per model and per pipeline stage (milliseconds)
+    columns = ('model', 'stage', 'count', 'p50', 'p95')
+    tree = ttk.Treeview(win, columns=columns, show='headings', height=14)
+    for col, width in zip(columns, (150, 120, 60, 80, 80)):
+        tree.heading(col, text=col if col in ('model', 'stage', 'count') else f'{col} (ms)')
+        tree.column(col, width=width, anchor='w' if col in ('model', 'stage') else 'e')
+    tree.pack(fill=tk.BOTH, expand=True, padx=8, pady=4)
+
+    # Server endpoint health (only shown in server mode)
+    endpoints_var = tk.StringVar(value='')
+    tk.Label(win, textvariable=endpoints_var, font=(None, 9), justify='left', anchor='w').pack(fill=tk.X, padx=8, pady=(2,4))
+
+    def fmt(ms):
+        return '' if ms is None else f'{ms:.1f}'
+
+    def rate_limit_line():
+        try:
+            rs = session.rate_limiter().summary()
+        except Exception:
+            return ''
+        limits = ', '.join(f'{v} {k}' for k, v in (('rpm', rs['rpm']), ('tpm', rs['tpm'])) if v) or 'no limits set'
+        return (f"Rate limiter ({limits}): {rs['chat_granted']} chat / {rs['background_granted']} extraction calls, "
+                f"{rs['waited']} waited {rs['wait_s']:.1f}s total, {rs['throttled']} 429s, {rs['retried']} retried, "
+                f"{rs['rejected']} gave up, {rs['queued']} queued")
+
+    def endpoint_lines():
+        if session.use_local or not session.endpoint:
+            return ''
+        hs = HEDGES.summary()
+        lines = [f"Hedging: {'on' if merge_hedge_policy(session.hedge_policy)['enabled'] else 'off'}, "
+                 f"{hs['hedged']} of {hs['requests']} requests hedged ({hs['hedge_rate']:.0%}), "
+                 f"hedge won {hs['hedge_wins']} of {hs['hedge_wins'] + hs['primary_wins']} ({hs['win_rate']:.0%}), "
+                 f"{hs['suppressed']} held back by the rate cap"]
+        ws = WIRE.summary()
+        if ws['requests']:
+            lines.append(f"Wire: {ws['compressed']} of {ws['requests']} requests gzip'd, sent {ws['request_wire'] / 1024:.1f} KiB for {ws['request_json'] / 1024:.1f} KiB of JSON ({ws['request_saved']:.0%} saved), "
+                         f"received {ws['response_wire'] / 1024:.1f} KiB for {ws['response_json'] / 1024:.1f} KiB ({ws['response_saved']:.0%} saved)"
+                         + (f", {ws['fallbacks']} server(s) refused gzip" if ws['fallbacks'] else ''))
+        if session.delta_sync:
+            ss = SYNC.summary()
+            lines.append(f"Delta sync: {ss['delta']} delta / {ss['full']} full requests, {ss['resyncs']} resyncs after a server cache miss"
+                         + (f", {ss['unsupported']} server(s) without delta support" if ss['unsupported'] else ''))
+        lines.append('Endpoints:')
+        for url, state, ewma_s, probe_s, ok, failed, last_error in get_endpoint_pool(session.endpoint).status_rows():
+            line = f'  {url}  [{state}]  {ok} ok / {failed} failed'
+            if ewma_s is not None:
+                line += f'  avg {ewma_s * 1000:.0f} ms'
+            if probe_s is not None:
+                line += f'  ping {probe_s * 1000:.0f} ms'
+            if last_error and state != 'closed':
+                line += f'  ({last_error[:60]})'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def refresh():
+        try:
+            tree.delete(*tree.get_children())
+            for model, stage, count, p50, p95 in TRACES.stats_rows():
+                tree.insert('', tk.END, values=(model, stage, count, fmt(p50), fmt(p95)))
+            summary_var.set(f'{len(TRACES)} recent turns traced (last {TRACES.capacity} kept) · {WRITER.pending_count()} pending writes ({WRITER.writes} written, {WRITER.coalesced} coalesced)')
+            endpoints_var.set('\n'.join(line for line in (rate_limit_line(), endpoint_lines()) if line))
+        except tk.TclError:
+            return
+
+    def auto_refresh():
+        # Keep the table current while the window is open
+        try:
+            if win.winfo_exists():
+                refresh()
+                win.after(2000, auto_refresh)
+        except tk.TclError:
+            pass
+
+    def export_traces():
+        path = filedialog.asksaveasfilename(parent=win, defaultextension='.json', initialfile='chatmax-traces.json', filetypes=[('JSON files','*.json'), ('All files','*.*')])
+        if not path:
+            return
+        try:
+            count = TRACES.export_json(path)
+            messagebox.showinfo('Diagnostics', f'Exported {count} traces to {path}', parent=win)
+        except Exception as e:
+            messagebox.showerror('Diagnostics', str(e), parent=win)
+
+    def clear_traces():
+        TRACES.clear()
+        refresh()
+
+    btnf = tk.Frame(win)
+    btnf.pack(pady=(4,10))
+    tk.Button(btnf, text='Refresh', command=refresh, width=10).pack(side=tk.LEFT, padx=6)
+    tk.Button(btnf, text='Export...', command=export_traces, width=10).pack(side=tk.LEFT, padx=6)
+    tk.Button(btnf, text='Clear', command=clear_traces, width=10).pack(side=tk.LEFT, padx=6)
+
+    auto_refresh()
+
+
 def open_personality_window():
     # Reuse global vars and build a Toplevel window with sliders
     if getattr(open_personality_window, 'win', None) and open_personality_window.win.winfo_exists():
@@ -1656,58 +1648,19 @@ def open_personality_window():
 
     tk.Label(win, text='Personality', font=(None, 12, 'bold')).pack(pady=(6,4))
 
-    # Presets map - name, tuple of slider values
-    presets = {
-        'Default AI': (2, 1, 0, 30, 1, 0, 0, 1),
-        'Helpful Professional': (2, 2, 0, 35, 1, 0, 0, 1),
-        'Casual Friendly': (3, 0, 0, 25, 1, 1, 0, 1),
-        'Playful Sarcastic': (2, 0, 1, 18, 1, 2, 2, 1),
-        'Child-Friendly': (3, 1, 0, 12, 1, 0, 0, 2),
-        'Stoic Professional': (1, 2, 0, 40, 1, 0, 0, 0),
-        'Sailor-Mouth': (0, 0, 2, 30, 1, 1, 2, 0),
-    }
-
-    # Presets file/dir paths
-    presets_path = os.path.join(os.path.dirname(__file__), 'presets.json')
-    presets_dir = os.path.join(os.path.dirname(__file__), 'personalities')
+    # Presets map - name, tuple of slider values (built-ins plus any per-file
+    # presets from the personalities/ directory)
+    presets = dict(DEFAULT_PRESETS)
+    presets_path = PRESETS_PATH
+    presets_dir = PERSONALITIES_DIR
     try:
         os.makedirs(presets_dir, exist_ok=True)
     except Exception:
         pass
+    presets.update(load_personality_files(presets_dir))
 
-    # Load any per-file presets from the personalities/ directory
-    try:
-        for fname in os.listdir(presets_dir):
-            if not fname.lower().endswith('.json'):
-                continue
-            name = os.path.splitext(fname)[0]
-            full = os.path.join(presets_dir, fname)
-            try:
-                with open(full, 'r', encoding='utf-8') as pf:
-                    loaded = json.load(pf)
-                # Support either a list of values or an object with 'values'
-                vals = None
-                if isinstance(loaded, list):
-                    vals = loaded
-                elif isinstance(loaded, dict) and 'values' in loaded:
-                    vals = loaded.get('values')
-                if vals and len(vals) >= 8:
-                    presets[name] = tuple(int(x) for x in vals[:8])
-            except Exception:
-                continue
-    except Exception:
-        pass
-
-    # Try to load last_selected from presets.json (keeps only the last selection)
-    try:
-        if os.path.exists(presets_path):
-            with open(presets_path, 'r', encoding='utf-8') as pf:
-                loaded = json.load(pf)
-            last_selected = loaded.get('last_selected') if isinstance(loaded, dict) else None
-        else:
-            last_selected = None
-    except Exception:
-        last_selected = None
+    # Load last_selected from presets.json (keeps only the last selection)
+    last_selected = load_last_selected_preset(presets_path)
 
     # Include a 'Custom' label for when slider values don't match any listed preset
     preset_var = tk.StringVar(value=last_selected if (last_selected in presets) else 'Custom')
@@ -1726,14 +1679,7 @@ def open_personality_window():
         if not vals:
             return
         try:
-            friendliness_var.set(vals[0])
-            professionalism_var.set(vals[1])
-            profanity_var.set(vals[2])
-            age_var.set(vals[3])
-            gender_var.set(vals[4])
-            humor_var.set(vals[5])
-            sarcasm_var.set(vals[6])
-            introversion_var.set(vals[7])
+            _set_personality_vars(vals)
         except Exception:
             # If any var is missing for some reason, ignore and continue
             pass
@@ -1794,14 +1740,10 @@ def open_personality_window():
         try:
             with open(path, 'r', encoding='utf-8') as pf:
                 loaded = json.load(pf)
-            vals = None
-            if isinstance(loaded, list):
-                vals = loaded
-            elif isinstance(loaded, dict) and 'values' in loaded:
-                vals = loaded.get('values')
-            if vals and len(vals) >= 8:
+            vals = parse_preset_values(loaded)
+            if vals:
                 name = os.path.splitext(os.path.basename(path))[0]
-                presets[name] = tuple(int(x) for x in vals[:8])
+                presets[name] = vals
                 update_preset_menu()
                 preset_var.set(name)
                 apply_preset(name)
@@ -1816,10 +1758,7 @@ def open_personality_window():
 
     # Helper to read current slider values as a tuple
     def current_values_tuple():
-        return (
-            int(friendliness_var.get()), int(professionalism_var.get()), int(profanity_var.get()),
-            int(age_var.get()), int(gender_var.get()), int(humor_var.get()), int(sarcasm_var.get()), int(introversion_var.get())
-        )
+        return current_personality_values()
 
     def find_matching_preset(tpl):
         for name, vals in presets.items():
@@ -1919,10 +1858,7 @@ def open_personality_window():
 
     # Ensure the preset selector matches the current slider values on open
     def current_values_tuple():
-        return (
-            int(friendliness_var.get()), int(professionalism_var.get()), int(profanity_var.get()),
-            int(age_var.get()), int(gender_var.get()), int(humor_var.get()), int(sarcasm_var.get()), int(introversion_var.get())
-        )
+        return current_personality_values()
 
     def find_matching_preset(tpl):
         for name, vals in presets.items():
@@ -1954,15 +1890,8 @@ def open_personality_window():
         last = matched if matched in presets else 'Custom'
         data = {'presets': {k: list(v) for k, v in presets.items()}, 'last_selected': last}
         try:
-            tmp_path = presets_path + '.tmp'
-            with open(tmp_path, 'w', encoding='utf-8') as pf:
-                json.dump(data, pf, ensure_ascii=False, indent=2)
-                pf.flush()
-                try:
-                    os.fsync(pf.fileno())
-                except Exception:
-                    pass
-            os.replace(tmp_path, presets_path)
+            # Written atomically by the background writer so closing the window never waits on disk
+            WRITER.submit(presets_path, json.dumps(data, ensure_ascii=False, indent=2), mode=None)
         except Exception as e:
             print('[presets] failed to write presets:', e)
         try:
@@ -2103,7 +2032,7 @@ def manage_endpoint():
             dlg.transient(root)
         except Exception:
             pass
-        tk.Label(dlg, text='Server endpoint URL (leave empty to remove):').pack(padx=12, pady=(10,4), anchor='w')
+        tk.Label(dlg, text='Server endpoint URL(s), comma-separated for failover (leave empty to remove):').pack(padx=12, pady=(10,4), anchor='w')
         entry_val = tk.StringVar()
         if cur:
             entry_val.set(cur)
@@ -2145,6 +2074,33 @@ def manage_endpoint():
         messagebox.showerror('Server endpoint', str(e))
 
 
+def toggle_hedging(enabled: bool):
+    policy = merge_hedge_policy(session.hedge_policy)
+    policy['enabled'] = bool(enabled)
+    session.hedge_policy = policy
+    try:
+        save_settings(bool(use_local_var.get()), hedge_policy=policy)
+    except Exception:
+        pass
+
+
+def toggle_compression(enabled: bool):
+    compression = merge_compression_settings(dict(session.compression, enabled=bool(enabled)))
+    session.compression = compression
+    try:
+        save_settings(bool(use_local_var.get()), server_compression=compression)
+    except Exception:
+        pass
+
+
+def toggle_delta_sync(enabled: bool):
+    session.delta_sync = bool(enabled)
+    try:
+        save_settings(bool(use_local_var.get()), server_delta_sync=bool(enabled))
+    except Exception:
+        pass
+
+
 def toggle_use_local():
     try:
         val = bool(use_local_var.get())
@@ -2169,220 +2125,238 @@ def toggle_use_local():
 
 def prompt_load_on_startup():
     try:
-        conv_dir = os.path.join(os.path.dirname(__file__), 'conversations')
+        conv_dir = CONVERSATIONS_DIR
         os.makedirs(conv_dir, exist_ok=True)
     except Exception:
         conv_dir = None
     try:
-        # Only prompt if the conversations/ folder contains at least one file
-        should_prompt = False
-        if conv_dir and os.path.isdir(conv_dir):
+        # Only prompt if the catalog knows a conversation or the folder has files
+        # (the catalog is brought up to date in the background by the dialog)
+        should_prompt = bool(catalog.recent(1))
+        if not should_prompt and conv_dir and os.path.isdir(conv_dir):
             try:
-                items = [f for f in os.listdir(conv_dir) if os.path.isfile(os.path.join(conv_dir, f))]
+                items = [f for f in os.listdir(conv_dir) if os.path.isfile(os.path.join(conv_dir, f)) and not f.startswith('.')]
                 should_prompt = len(items) > 0
             except Exception:
                 should_prompt = False
         if should_prompt:
-            if messagebox.askyesno('Load conversation', 'Load an existing conversation from disk?'):
-                load_conversation_file()
+            open_recent_conversations()
     except Exception:
         pass
 
 
-def save_prefs_list(entries: list):
-    try:
-        # Ensure serializable
-        serial = []
-        for e in entries:
-            serial.append({'line': str(e.get('line') or ''), 'ts': int(e.get('ts') or int(time.time()))})
-        _atomic_write(PREFS_PATH, json.dumps(serial, ensure_ascii=False, indent=2))
-    except Exception:
-        pass
+def recent_entry_label(entry: dict):
+    # "title  -  12 messages, 2024-05-01 18:30, Preset"
+    parts = [f"{entry.get('messages', 0)} messages"]
+    if entry.get('last_ts'):
+        parts.append(format_ts(entry['last_ts'], '%Y-%m-%d %H:%M'))
+    if entry.get('preset'):
+        parts.append(entry['preset'])
+    return f"{entry.get('title', '')}  -  {', '.join(parts)}"
 
 
-def _trim_history():
+def open_recent_conversations():
+    # Quick-open list served from the catalog (no conversation file is read
+    # until one is picked); new or changed files are scanned in the background
     try:
-        _limit = globals().get('HISTORY_LIMIT', None)
-        if isinstance(_limit, int):
-            while len(history) > _limit:
-                history.pop(0)
-        else:
-            while len(history) > 10:
-                history.pop(0)
-    except Exception:
+        dlg = tk.Toplevel(root)
+        dlg.title('Open Conversation')
         try:
-            while len(history) > 10:
-                history.pop(0)
+            dlg.transient(root)
         except Exception:
             pass
-
-
-def _atomic_write(path: str, text: str, mode: int = 0o600):
-    try:
-        tmp = path + '.tmp'
-        with open(tmp, 'w', encoding='utf-8') as tf:
-            tf.write(text)
-            tf.flush()
+        tk.Label(dlg, text='Recent conversations', anchor='w').pack(fill=tk.X, padx=12, pady=(10,4))
+        listbox = tk.Listbox(dlg, width=70, height=10, activestyle='dotbox')
+        listbox.pack(fill=tk.BOTH, expand=True, padx=12)
+        status_var = tk.StringVar(value='Checking conversations folder...')
+        tk.Label(dlg, textvariable=status_var, anchor='w', fg='gray').pack(fill=tk.X, padx=12, pady=(2,0))
+        shown = []
+
+        def fill():
+            shown[:] = catalog.recent()
+            listbox.delete(0, tk.END)
+            for entry in shown:
+                listbox.insert(tk.END, recent_entry_label(entry))
+            if shown:
+                listbox.selection_set(0)
+
+        def open_path(path):
             try:
-                os.fsync(tf.fileno())
+                dlg.destroy()
             except Exception:
                 pass
-        os.replace(tmp, path)
-        try:
-            os.chmod(path, mode)
-        except Exception:
-            pass
-    except Exception:
-        # Best-effort only, don't raise to avoid breaking startup
-        pass
+            load_conversation_file(path)
 
+        def on_resume():
+            entry = catalog.last() or (shown[0] if shown else None)
+            if entry:
+                open_path(entry['path'])
 
-def save_settings(use_local: bool, api_key: str | None = None, endpoint: str | None = None, last_deleted: str | None = None, ai_history_lines: int | None = None, pref_memory_lines: int | None = None, ai_model: str | None = None):
-    try:
-        # Load existing settings to preserve unrelated fields
-        data = {}
-        try:
-            if os.path.exists(SETTINGS_PATH):
-                with open(SETTINGS_PATH, 'r', encoding='utf-8') as sf:
-                    data = json.load(sf) or {}
-        except Exception:
-            data = {}
-        data['use_local_ai'] = bool(use_local)
-        if api_key is not None:
-            if api_key:
-                data['openai_api_key'] = api_key
-            else:
-                # remove stored key
-                data.pop('openai_api_key', None)
-        if endpoint is not None:
-            if endpoint:
-                data['server_endpoint'] = endpoint
-            else:
-                data.pop('server_endpoint', None)
-
-        # Record which credential was deleted most recently (if provided)
-        # Use a stable key name so startup logic can prefer prompting the
-        # most recently removed credential when both are missing
-        if last_deleted is not None:
-            if last_deleted:
-                data['last_credential_deleted'] = str(last_deleted)
-                try:
-                    data['last_credential_deleted_ts'] = int(time.time())
-                except Exception:
-                    pass
-            else:
-                data.pop('last_credential_deleted', None)
-                data.pop('last_credential_deleted_ts', None)
+        def on_open(event=None):
+            sel = listbox.curselection()
+            if sel and sel[0] < len(shown):
+                open_path(shown[sel[0]]['path'])
 
-        # Persist an optional AI history-lines limit so the UI can round-trip
-        # the user's choice, if ai_history_lines is None we leave the value
-        # unchanged, an explicit integer will be stored (and should be a
-        # small non-negative number)
-        if ai_history_lines is not None:
+        def on_browse():
             try:
-                data['ai_history_lines'] = int(ai_history_lines)
+                dlg.destroy()
             except Exception:
-                # ignore invalid values
                 pass
-        # Persist preference memory limit if provided
-        if pref_memory_lines is not None:
+            load_conversation_file()
+
+        def on_refreshed(count):
             try:
-                data['pref_memory_lines'] = int(pref_memory_lines)
+                if not dlg.winfo_exists():
+                    return
+                if count:
+                    fill()
+                status_var.set(f'{len(shown)} recent' + (f', {count} file(s) rescanned' if count else ''))
             except Exception:
                 pass
-        # Persist AI model if provided
-        if ai_model is not None:
+
+        def refresh_worker():
             try:
-                data['ai_model'] = str(ai_model)
+                count = catalog.refresh()
+            except Exception:
+                count = 0
+            try:
+                root.after(0, lambda: on_refreshed(count))
             except Exception:
                 pass
-        _atomic_write(SETTINGS_PATH, json.dumps(data, ensure_ascii=False, indent=2))
-    except Exception:
-        pass
 
-
-def call_local_openai(messages_for_gpt):
-    OPENAI_API_KEY = get_saved_api_key()
-    if not OPENAI_API_KEY:
-        raise RuntimeError('No OpenAI API key available for local calls')
-    try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        model = get_saved_ai_model()
-        kwargs = {'model': model, 'messages': messages_for_gpt}
-        if model.startswith('gpt-5'):
-            kwargs['reasoning_effort'] = 'minimal'
-            kwargs['verbosity'] = 'low'
-        response = client.chat.completions.create(**kwargs)
-        content = response.choices[0].message.content
-        return content or ''
+        fill()
+        listbox.bind('<Double-Button-1>', on_open)
+        listbox.bind('<Return>', on_open)
+        btnf = tk.Frame(dlg)
+        btnf.pack(pady=(6,12))
+        last = catalog.last()
+        tk.Button(btnf, text='Resume last', command=on_resume, width=12, state=tk.NORMAL if (last or shown) else tk.DISABLED).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Open', command=on_open, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Browse...', command=on_browse, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='New', command=lambda: dlg.destroy(), width=10).pack(side=tk.LEFT, padx=6)
+        if last:
+            status_var.set(f"Last: {last.get('title', '')}. Checking conversations folder...")
+        threading.Thread(target=refresh_worker, name='chatmax-catalog', daemon=True).start()
+        try:
+            listbox.focus_set()
+            dlg.grab_set()
+        except Exception:
+            pass
     except Exception as e:
-        raise
-
-
-def call_server_api(messages_for_gpt):
-    try:
-        # Prefer any user-configured endpoint stored in settings.json
-        ep = get_saved_endpoint() or endpoint
-        resp = requests.post(ep, json={'messages': messages_for_gpt}, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get('response', '') if isinstance(data, dict) else ''
-    except Exception:
-        raise
+        try:
+            messagebox.showerror('Open Conversation', str(e))
+        except Exception:
+            pass
 
 
 def append_chat(text: str):
-    chat_area.config(state=tk.NORMAL)
-    chat_area.insert(tk.END, text)
-    chat_area.see(tk.END)
-    chat_area.config(state=tk.DISABLED)
+    # Queued behind any render in progress so text stays in order
+    renderer.append([(text, None)])
 
 
-def insert_labeled_message(role: str, message: str, ts: str = '', prefix_colon: bool = True):
-    chat_area.config(state=tk.NORMAL)
-    # choose tag for role
+def message_segments(role: str, message: str, ts: str = '', prefix_colon: bool = True, model: str | None = None):
+    # (text, tag) pieces of one chat entry, role label colored by tag
     tag = 'user_label' if role == 'You' else 'assistant_label'
-    # insert role with tag
-    chat_area.insert(tk.END, role, tag)
-    # insert timestamp and rest; optionally include colon separator
-    ts_text = f" [{ts}]" if (ts and show_timestamps_var.get()) else ''
+    segments = [(role, tag)]
+    # Name the model when a fallback (not the selected one) answered
+    if model and model != session.model:
+        segments.append((f" ({model})", None))
+    # timestamp and rest; optionally include colon separator
+    try:
+        show_ts = show_timestamps_var.get()
+    except Exception:
+        show_ts = True
+    ts_text = f" [{ts}]" if (ts and show_ts) else ''
     sep = ': ' if prefix_colon else ' '
-    chat_area.insert(tk.END, f"{ts_text}{sep}{message}\n\n")
+    segments.append((f"{ts_text}{sep}{message}\n\n", None))
     # extra spacer for assistant replies
     if role != 'You':
-        chat_area.insert(tk.END, "\n")
-    chat_area.see(tk.END)
-    chat_area.config(state=tk.DISABLED)
+        segments.append(("\n", None))
+    return segments
 
 
-def render_history():
-    chat_area.config(state=tk.NORMAL)
-    chat_area.delete(1.0, tk.END)
+def insert_labeled_message(role: str, message: str, ts: str = '', prefix_colon: bool = True, model: str | None = None):
+    renderer.append(message_segments(role, message, ts, prefix_colon, model))
 
-    # Show the full, untrimmed conversation to the user (full_history)
-    # `history` remains the trimmed list used for model context
+
+def history_segments():
+    # Formatted lazily, slice by slice, as the renderer consumes them
+    # Timestamps are stored as epoch seconds and only formatted here
     for entry_item in full_history:
-        if len(entry_item) >= 3:
-            role, msg, ts = entry_item[0], entry_item[1], entry_item[2]
-        elif len(entry_item) == 2:
-            role, msg = entry_item[0], entry_item[1]
-            ts = ''
-        else:
-            continue
-        # Respect the show_timestamps_var toggle (hide timestamps when unchecked)
+        yield from message_segments(entry_item.role, entry_item.text, entry_item.time_text, model=entry_item.model)
+
+
+def render_history(on_done=None):
+    # Show the full, untrimmed conversation to the user (full_history)
+    # `history` remains the trimmed list used for model context. The text is
+    # inserted in time-sliced chunks (see Settings -> Chat View Frame Budget),
+    # a newer render or a conversation switch interrupts an unfinished one
+    renderer.replace(history_segments(), on_done)
+
+
+def manage_render_budget():
+    try:
+        dlg = tk.Toplevel(root)
+        dlg.title('Chat View Frame Budget')
         try:
-            show_ts = show_timestamps_var.get()
+            dlg.transient(root)
         except Exception:
-            show_ts = True
-        # Use the labeled insertion helper so role labels are colored
+            pass
+        dlg.resizable(False, False)
+        tk.Label(dlg, text='Milliseconds spent inserting text before the window gets a chance to redraw and handle input. Lower keeps the window smoother while long conversations load, higher loads them faster:', wraplength=420, justify='left').pack(padx=12, pady=(10,6), anchor='w')
+        slider_var = tk.IntVar(value=renderer.budget_ms)
+        scale = tk.Scale(dlg, from_=MIN_BUDGET_MS, to=MAX_BUDGET_MS, orient=tk.HORIZONTAL, variable=slider_var, length=360)
+        scale.pack(padx=12, pady=(0,6))
+
+        def on_save():
+            val = clamp_budget(slider_var.get())
+            renderer.set_budget(val)
+            try:
+                save_settings(bool(use_local_var.get()), render_budget_ms=val)
+            except Exception:
+                pass
+            try:
+                dlg.destroy()
+            except Exception:
+                pass
+
+        btnf = tk.Frame(dlg)
+        btnf.pack(pady=(6,12))
+        tk.Button(btnf, text='Save', command=on_save, width=10).pack(side=tk.LEFT, padx=6)
+        tk.Button(btnf, text='Cancel', command=lambda: dlg.destroy(), width=10).pack(side=tk.LEFT, padx=6)
         try:
-            insert_labeled_message(role, msg, ts)
+            dlg.grab_set()
+            scale.focus_force()
+            root.wait_window(dlg)
         except Exception:
-            # fallback to plain insertion
-            ts_text = f" [{ts}]" if (ts and show_ts) else ''
-            chat_area.insert(tk.END, f"{role}{ts_text}: {msg}\n\n")
-    chat_area.see(tk.END)
-    chat_area.config(state=tk.DISABLED)
+            try:
+                root.wait_window(dlg)
+            except Exception:
+                pass
+    except Exception as e:
+        try:
+            messagebox.showerror('Chat View Frame Budget', str(e))
+        except Exception:
+            pass
+
+
+def _shutdown():
+    # Persist anything kept in memory during the session, then close the window
+    try:
+        session.latency.save()
+    except Exception:
+        pass
+    # Remove the spilled-history journal, if any (the conversation is saved separately)
+    try:
+        session.full_history.close()
+    except Exception:
+        pass
+    # Wait (briefly) for queued settings/preferences/presets writes to reach the disk
+    try:
+        WRITER.flush(timeout=5.0)
+    except Exception:
+        pass
+    root.destroy()
 
 
 def on_exit():
@@ -2394,17 +2368,18 @@ def on_exit():
             if resp is True:
                 ok = save_conversation()
                 if ok:
-                    root.destroy()
+                    _shutdown()
                 else:
                     return
-            # No -> exit without saving
+            # No -> exit without saving (queued turns still need a home)
             elif resp is False:
-                root.destroy()
+                if keep_unsaved_queue():
+                    _shutdown()
             # Cancel -> do nothing
             else:
                 return
-        else:
-            root.destroy()
+        elif keep_unsaved_queue():
+            _shutdown()
     except Exception:
         try:
             root.destroy()
@@ -2414,5 +2389,33 @@ def on_exit():
 # Main Execution
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chat Max')
+    parser.add_argument('--startup-timing', action='store_true', help='print startup phase timings and time-to-first-paint')
+    parser.add_argument('--profile', action='store_true', help='profile the hot paths with cProfile and write a report to profiles/ on exit')
+    parser.add_argument('--profile-memory', action='store_true', help='also track allocations with tracemalloc (implies --profile)')
+    parser.add_argument('--profile-dir', default=None, help='folder for profile reports (default: profiles/ next to the script)')
+    cli_args = parser.parse_args()
+    if cli_args.startup_timing:
+        startup_marks = []
+    # Profiling is opt-in: the flags, or CHATMAX_PROFILE=1 (or =mem) in the environment
+    if cli_args.profile or cli_args.profile_memory:
+        PROFILER.enable(cli_args.profile_memory, cli_args.profile_dir)
+    elif PROFILER.enable_from_env() and cli_args.profile_dir:
+        PROFILER.out_dir = cli_args.profile_dir
+    if PROFILER.enabled:
+        # Rebind the hot paths before the window (and its menu commands) is built
+        for _name in ('send_message', 'render_history', 'update_summary', 'load_conversation_file'):
+            globals()[_name] = PROFILER.wrap(_name, globals()[_name])
+
+        def _write_profile():
+            try:
+                print(f'[profile] report written to {PROFILER.write_report()}')
+            except Exception as e:
+                print(f'[profile] could not write report: {e}')
+
+        atexit.register(_write_profile)
     build_main_window()
+    if PROFILER.enabled:
+        # Rendering happens in time-sliced after() callbacks, profile each slice
+        renderer._step = PROFILER.wrap('render_slice', renderer._step)
     root.mainloop()
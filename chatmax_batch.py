@@ -0,0 +1,271 @@
+# File:        chatmax_batch.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Command-line batch mode for Chat Max. Reads scripted prompts
+#              from a JSONL file, runs each one through the same ChatSession
+#              payload construction the GUI uses for a chosen preset, and
+#              streams replies with per-item latency to a JSONL file. No Tk
+#              window is created.
+#
+# Input lines (one JSON object per line):
+#   {"id": "greet", "prompt": "Hello!"}
+#   {"id": "name", "prompts": ["Hi, I'm Sam", "What's my name?"], "preset": "Casual Friendly"}
+#   {"id": "ctx", "history": [["You", "I like tea"], ["Default AI", "Nice!"]], "prompt": "What do I like?"}
+#
+# Usage:
+#   python chatmax_batch.py prompts.jsonl -o results.jsonl --preset "Casual Friendly" --concurrency 8
+
+
+# Imports
+
+# Command-line parsing
+import argparse
+# JSON Lines input/output
+import json
+# Bounded worker pool for dispatching items concurrently
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Stream results from several workers to a single output
+import threading
+# Per-item latency
+import time
+# stdin/stdout/stderr streams
+import sys
+# Headless chat engine
+from chatmax_engine import ChatSession, load_settings, PREFS_PATH, AI_MODELS
+# Per-turn stage timings
+from chatmax_trace import TRACES
+# Latency histograms behind the adaptive timeouts
+from chatmax_latency import get_latency_tracker, LATENCY_PATH
+# Background writer flushed before exit
+from chatmax_writer import WRITER
+# Hedged-request counters
+from chatmax_routing import HEDGES
+# Rate limiter summaries printed at the end of a run
+from chatmax_ratelimit import all_rate_limiters
+# Request/response byte counters printed at the end of a run
+from chatmax_wire import WIRE
+# Delta-sync counters for the summary
+from chatmax_sync import SYNC
+
+
+# Constants
+
+# Default number of items processed at once
+DEFAULT_CONCURRENCY = 4
+
+
+# Functions
+
+def read_items(path: str):
+    # Yield (line number, item) for every non-empty JSONL line, '-' reads stdin
+    stream = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        for lineno, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except Exception as e:
+                yield lineno, {'error': f'invalid JSON: {e}'}
+                continue
+            if isinstance(item, str):
+                item = {'prompt': item}
+            yield lineno, item
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def item_prompts(item: dict):
+    # A single 'prompt' or a scripted conversation in 'prompts'
+    prompts = item.get('prompts')
+    if isinstance(prompts, list):
+        return [str(p) for p in prompts if str(p).strip()]
+    prompt = item.get('prompt')
+    return [str(prompt)] if prompt is not None and str(prompt).strip() else []
+
+
+def make_session(args, settings: dict, preset: str):
+    session = ChatSession(settings, prefs_path=args.prefs, latency=args.latency_tracker)
+    if args.mode:
+        session.use_local = args.mode == 'local'
+    if args.endpoint:
+        session.endpoint = args.endpoint
+    if args.api_key:
+        session.api_key = args.api_key
+    if args.model:
+        session.model = args.model
+    if args.history_lines is not None:
+        session.history_limit = max(0, args.history_lines)
+    if args.latency_budget is not None or args.race:
+        session.set_model_budget({'budget_s': args.latency_budget, 'race': args.race})
+    if args.hedge:
+        session.hedge_policy = dict(session.hedge_policy or {}, enabled=True)
+    if args.gzip:
+        session.compression = dict(session.compression, enabled=True)
+    if args.delta_sync:
+        session.delta_sync = True
+    if args.rpm is not None or args.tpm is not None:
+        session.rate_limits = dict(session.rate_limits, rpm=args.rpm or session.rate_limits['rpm'], tpm=args.tpm or session.rate_limits['tpm'])
+    if args.extraction_model:
+        session.extraction = dict(session.extraction, model=args.extraction_model)
+    session.extract_preferences = not args.no_extract
+    # A batch run reports failures in its results instead of queueing turns
+    session.queue_offline = False
+    if preset and not session.apply_preset(preset):
+        raise ValueError(f'unknown preset: {preset}')
+    return session
+
+
+def run_item(args, settings: dict, lineno: int, item: dict):
+    result = {'id': item.get('id', lineno), 'line': lineno}
+    if item.get('error'):
+        result['error'] = item['error']
+        return result
+    started = time.perf_counter()
+    try:
+        preset = item.get('preset') or args.preset
+        session = make_session(args, settings, preset)
+        # Seed any prior conversation the item carries
+        if isinstance(item.get('history'), list):
+            session.load_entries(item['history'])
+        prompts = item_prompts(item)
+        if not prompts:
+            raise ValueError('item has no prompt')
+        result['preset'] = session.active_preset_name()
+        turns = []
+        for prompt in prompts:
+            turn_started = time.perf_counter()
+            trace = session.new_trace('batch')
+            payload, preset_label, _ = session.begin_turn(prompt, trace)
+            turn = {'prompt': prompt}
+            try:
+                turn['reply'] = session.complete_turn(payload, prompt, preset_label, trace)
+                # Which model actually answered (differs from --model after a fallback)
+                last = session.full_history[-1]
+                if last.model:
+                    turn['model'] = last.model
+            except Exception as e:
+                # Record the error in history exactly like the GUI, then stop this conversation
+                err_text = f"Error: {str(e)}"
+                session.add_message(preset_label, err_text)
+                turn['error'] = err_text
+            turn['latency_ms'] = round((time.perf_counter() - turn_started) * 1000, 1)
+            TRACES.add(trace.finish(turn.get('error')))
+            turn['stages_ms'] = {k: round(v, 1) for k, v in trace.stage_totals().items()}
+            if args.include_payload:
+                turn['payload'] = payload
+            turns.append(turn)
+            if 'error' in turn:
+                result['error'] = turn['error']
+                break
+        result['turns'] = turns
+        result['reply'] = turns[-1].get('reply') if turns else None
+        result['usage'] = session.usage.to_dict()['total']
+    except Exception as e:
+        result['error'] = str(e)
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def run_batch(args, out):
+    settings = load_settings()
+    # One tracker for every item of the run, so timeouts learn across items
+    args.latency_tracker = get_latency_tracker(settings.get('timeout_policy'), None if args.no_save_latency else args.latency_file)
+    write_lock = threading.Lock()
+    counts = {'ok': 0, 'error': 0}
+
+    def emit(result):
+        with write_lock:
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+            out.flush()
+            counts['error' if result.get('error') else 'ok'] += 1
+
+    # The executor bounds how many items run at once, submitting lazily keeps
+    # memory flat for very large input files
+    concurrency = max(1, args.concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = set()
+        for lineno, item in read_items(args.input):
+            pending.add(pool.submit(run_item, args, settings, lineno, item))
+            if len(pending) >= concurrency * 2:
+                done = next(as_completed(pending))
+                pending.discard(done)
+                emit(done.result())
+        for fut in as_completed(pending):
+            emit(fut.result())
+    return counts
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Run scripted Chat Max prompts from a JSONL file without the GUI.')
+    parser.add_argument('input', help="JSONL file of prompts/conversations ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-', help="JSONL results file ('-' for stdout)")
+    parser.add_argument('--preset', default='Default AI', help='personality preset applied to every item without its own')
+    parser.add_argument('--mode', choices=['local', 'server'], help='override use_local_ai from settings.json')
+    parser.add_argument('--endpoint', help='server endpoint URL, or several comma-separated for failover (server mode)')
+    parser.add_argument('--api-key', help='OpenAI API key (local mode)')
+    parser.add_argument('--model', help='OpenAI model (local mode)')
+    parser.add_argument('--latency-budget', type=float, help='local mode: ask a faster model too if no reply within this many seconds')
+    parser.add_argument('--race', action='store_true', help='local mode: race the model against a faster one from the start')
+    parser.add_argument('--hedge', action='store_true', help='duplicate server requests that run past the observed p95')
+    parser.add_argument('--gzip', action='store_true', help='gzip-compress server request bodies (falls back to plain JSON if refused)')
+    parser.add_argument('--delta-sync', action='store_true', help='send only new messages to servers that cache conversations (full payload on a cache miss)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='maximum items processed at once')
+    parser.add_argument('--history-lines', type=int, help='override ai_history_lines from settings.json')
+    parser.add_argument('--prefs', default=PREFS_PATH, help='preferences file to read and update')
+    parser.add_argument('--rpm', type=int, help='client-side requests-per-minute limit shared by all items (overrides settings.json)')
+    parser.add_argument('--tpm', type=int, help='client-side tokens-per-minute limit shared by all items (overrides settings.json)')
+    parser.add_argument('--extraction-model', choices=AI_MODELS, help='model for preference extraction (local mode)')
+    parser.add_argument('--no-extract', action='store_true', help='skip preference extraction (regression runs)')
+    parser.add_argument('--latency-file', default=LATENCY_PATH, help='latency histograms used for timeouts and updated by the run (default: latency.json)')
+    parser.add_argument('--no-save-latency', action='store_true', help='start from empty in-memory latency histograms and write none')
+    parser.add_argument('--trace-output', help='export stage timing traces and p50/p95 summary as JSON')
+    parser.add_argument('--include-payload', action='store_true', help='include the exact messages sent for each turn')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        started = time.perf_counter()
+        if args.trace_output:
+            # Keep every turn of this run for the trace export
+            TRACES.resize(10 ** 6)
+        counts = run_batch(args, out)
+        elapsed = time.perf_counter() - started
+        print(f"[batch] {counts['ok']} ok, {counts['error']} failed in {elapsed:.1f}s", file=sys.stderr)
+        if args.hedge:
+            hs = HEDGES.summary()
+            print(f"[batch] hedged {hs['hedged']} of {hs['requests']} requests, hedge won {hs['hedge_wins']}", file=sys.stderr)
+        ws = WIRE.summary()
+        if ws['requests']:
+            print(f"[batch] wire: sent {ws['request_wire']} bytes for {ws['request_json']} bytes of JSON ({ws['request_saved']:.0%} saved), "
+                  f"received {ws['response_wire']} for {ws['response_json']} ({ws['response_saved']:.0%} saved)", file=sys.stderr)
+        if args.delta_sync:
+            ss = SYNC.summary()
+            print(f"[batch] delta sync: {ss['delta']} delta / {ss['full']} full requests, {ss['resyncs']} resyncs, {ss['unsupported']} server(s) without support", file=sys.stderr)
+        for key, limiter in all_rate_limiters().items():
+            rs = limiter.summary()
+            if rs['waited'] or rs['throttled']:
+                print(f"[batch] rate limiter {key}: {rs['waited']} calls waited {rs['wait_s']:.1f}s, {rs['throttled']} 429s, {rs['retried']} retried, {rs['rejected']} gave up", file=sys.stderr)
+        if args.trace_output:
+            TRACES.export_json(args.trace_output)
+        # Keep the latency observed during the run for future timeouts (not
+        # with --no-save-latency), and make sure preference/latency writes are
+        # on disk before exiting
+        args.latency_tracker.save()
+        WRITER.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 1 if counts['error'] else 0
+
+
+# Main Execution
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,486 @@
+# File:        chatmax_bench.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: End-to-end benchmarks for Chat Max. Drives ChatSession turns
+#              headlessly (the same begin_turn/complete_turn pipeline as the
+#              GUI) against a deterministic fake backend that serves both the
+#              server-mode contract and an OpenAI-compatible Chat Completions
+#              API, with configurable latency (time to first byte) and token
+#              rate. Per scenario it measures turn latency, time to first
+#              token, stage timings, payload size, file opens per turn and
+#              memory growth over long conversations, and writes the results
+#              as JSON so runs of different versions can be compared with
+#              --compare.
+#
+# Usage:
+#   python chatmax_bench.py                          (all scenarios, results in bench_results/)
+#   python chatmax_bench.py --scenario long --turns 2000
+#   python chatmax_bench.py --compare bench_results/e2e-0.4.4-....json --fail-on-regression
+
+
+# Imports
+
+# Command line
+import argparse
+# Whether the OpenAI client is installed (local-mode scenario)
+import importlib.util
+# Fake backend
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+# Results and request bodies
+import json
+# Reply pacing
+import math
+# Deterministic prompts
+import random
+# Machine description in the results
+import platform
+# Git commit of the tree being measured
+import subprocess
+# Scratch preferences files
+import tempfile
+# Backend thread
+import threading
+# Clocks
+import time
+# Memory growth
+import tracemalloc
+# OS for paths, the environment and open flags
+import os
+# Audit hook counting file opens, stderr report
+import sys
+# Headless chat engine
+import chatmax_engine
+from chatmax_engine import ChatSession, DEFAULT_AI_MODEL, EXTRACTION_PROMPT, get_http_session, save_prefs_list
+# Stage timings of each turn
+from chatmax_trace import TRACES, percentile
+# Pending preference writes are flushed before files are counted
+from chatmax_writer import WRITER
+# Bytes actually sent to the server
+from chatmax_wire import WIRE
+# Server-side conversation cache for the delta-sync scenario
+from chatmax_sync import DeltaCache, ResyncNeeded, RESYNC_STATUS
+# Deterministic reply text
+from chatmax_server import FakeUpstream
+# Payload size as the wire sees it
+from chatmax_convfile import json_dumps
+# Realistic prompts and preferences (shared with the load generator)
+from chatmax_loadtest import synthetic_prompt, synthetic_preferences
+
+
+# Constants
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+RESULTS_FORMAT = 'chatmax-bench-e2e'
+RESULTS_VERSION = 1
+# Fake backend defaults: seconds until the first byte, reply tokens per second
+DEFAULT_LATENCY_S = 0.02
+DEFAULT_TOKENS_PER_S = 400.0
+# Body pieces are written at most this often when pacing a reply
+PACE_INTERVAL_S = 0.01
+CHARS_PER_TOKEN = 4
+# Unmeasured turns run first (imports, connection setup)
+WARMUP_TURNS = 2
+# Memory is sampled every this many turns in memory scenarios
+MEMORY_CHECKPOINT_TURNS = 50
+# Relative change that --compare reports as a regression
+DEFAULT_THRESHOLD = 0.10
+
+SCENARIOS = {
+    # Server mode with preference extraction, the usual GUI turn
+    'server': {'mode': 'server', 'turns': 60, 'extract': True},
+    # Same, with the delta-sync protocol
+    'server-delta': {'mode': 'server', 'turns': 60, 'extract': True, 'delta_sync': True},
+    # Local mode through the OpenAI client (needs openai installed)
+    'local': {'mode': 'local', 'turns': 60, 'extract': True},
+    # A long conversation without waits, for CPU per turn and memory growth
+    'long': {'mode': 'server', 'turns': 1000, 'extract': False, 'latency_s': 0.0, 'tokens_per_s': 0.0, 'memory': True},
+}
+
+# Metrics compared between runs (lower is better for all of them)
+COMPARED_METRICS = ('turn_p50_ms', 'turn_p95_ms', 'ttft_p50_ms', 'cpu_ms_per_turn', 'payload_bytes_mean',
+                    'wire_bytes_per_turn', 'file_opens_per_turn', 'memory_growth_bytes_per_turn')
+
+
+# Functions
+
+class FakeBackend:
+    # Deterministic replies for both APIs; headers go out after latency_s and
+    # the body is paced at tokens_per_s (0 = all at once)
+
+    def __init__(self, latency_s: float = DEFAULT_LATENCY_S, tokens_per_s: float = DEFAULT_TOKENS_PER_S):
+        self.latency_s = latency_s
+        self.tokens_per_s = tokens_per_s
+        self.upstream = FakeUpstream(0.0)
+        self.cache = DeltaCache()
+        self.requests = 0
+        self._server = None
+
+    def reply_for(self, messages: list):
+        if messages and messages[0].get('content') == EXTRACTION_PROMPT:
+            # Extraction: sometimes one new preference line, sometimes nothing
+            last = messages[-1].get('content', '')
+            n = sum(map(ord, last))
+            return f'favorite topic {n % 7} is option {n % 13}' if n % 3 else ''
+        return self.upstream.reply_for(messages)
+
+    def start(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes, Nagle would hold the body back
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if '/models/' in self.path:
+                    body = {'id': self.path.rsplit('/', 1)[-1], 'object': 'model', 'created': 0, 'owned_by': 'fake'}
+                else:
+                    body = {'status': 'ok'}
+                self._send(200, json.dumps(body).encode('utf-8'))
+
+            def do_POST(self):
+                backend.requests += 1
+                raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if (self.headers.get('Content-Encoding') or '').lower() == 'gzip':
+                    raw = gzip.decompress(raw)
+                body = json.loads(raw)
+                openai_api = self.path.rstrip('/').endswith('/chat/completions')
+                if openai_api:
+                    messages = body.get('messages') or []
+                else:
+                    try:
+                        messages, cid = backend.cache.resolve(body)
+                    except ResyncNeeded:
+                        self._send(RESYNC_STATUS, b'{"sync": {"status": "resync"}}')
+                        return
+                reply = backend.reply_for(messages)
+                prompt = sum(len(m.get('content') or '') for m in messages) // CHARS_PER_TOKEN
+                completion = max(1, len(reply) // CHARS_PER_TOKEN)
+                usage = {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+                if openai_api:
+                    out = {'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model') or DEFAULT_AI_MODEL,
+                           'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}], 'usage': usage}
+                else:
+                    out = {'response': reply, 'model': 'fake', 'usage': usage}
+                    seq = backend.cache.record_reply(cid, reply)
+                    if seq is not None:
+                        out['sync'] = {'status': 'ok', 'seq': seq}
+                if backend.latency_s:
+                    time.sleep(backend.latency_s)
+                self._send(200, json.dumps(out).encode('utf-8'), completion / backend.tokens_per_s if backend.tokens_per_s else 0.0)
+
+            def _send(self, status: int, data: bytes, pace_s: float = 0.0):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if pace_s <= 0:
+                    self.wfile.write(data)
+                    return
+                # Headers are the "first token", the rest arrives at the token rate
+                self.wfile.flush()
+                pieces = max(1, math.ceil(pace_s / PACE_INTERVAL_S))
+                size = math.ceil(len(data) / pieces)
+                for i in range(pieces):
+                    time.sleep(pace_s / pieces)
+                    self.wfile.write(data[i * size:(i + 1) * size])
+                    self.wfile.flush()
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='chatmax-bench-backend', daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_address[1]}/'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class FileOpenCounter:
+    # Counts files opened by this process while active (audit hook, every thread)
+
+    def __init__(self):
+        self.active = False
+        self.reset()
+        sys.addaudithook(self._hook)
+
+    def reset(self):
+        self.reads = 0
+        self.writes = 0
+
+    def _hook(self, event, args):
+        if not self.active or event != 'open':
+            return
+        path, mode, flags = (tuple(args) + (None, None, None))[:3]
+        if not isinstance(path, (str, bytes)):
+            return
+        if isinstance(mode, str):
+            writing = any(c in mode for c in 'wax+')
+        else:
+            writing = bool((flags or 0) & (os.O_WRONLY | os.O_RDWR))
+        if writing:
+            self.writes += 1
+        else:
+            self.reads += 1
+
+
+def rss_kib():
+    # Current resident set size (Linux), None elsewhere
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except Exception:
+        return None
+
+
+def slope(points: list):
+    # Least-squares slope of [(x, y), ...]
+    if len(points) < 2:
+        return None
+    n = len(points)
+    mx = sum(p[0] for p in points) / n
+    my = sum(p[1] for p in points) / n
+    den = sum((p[0] - mx) ** 2 for p in points)
+    return sum((p[0] - mx) * (p[1] - my) for p in points) / den if den else None
+
+
+def ms(values: list, pct: float):
+    value = percentile(values, pct)
+    return round(value * 1000, 3) if value is not None else None
+
+
+def run_scenario(name: str, spec: dict, args, files: FileOpenCounter):
+    if spec['mode'] == 'local':
+        if importlib.util.find_spec('openai') is None:
+            return {'skipped': 'openai is not installed'}
+    backend = FakeBackend(spec.get('latency_s', args.latency), spec.get('tokens_per_s', args.tokens_per_s))
+    url = backend.start()
+    turns = args.turns or spec['turns']
+    rng = random.Random(args.seed)
+    # The OpenAI client reads its base URL from the environment when created
+    # (clients are cached per key, so each run uses its own key)
+    os.environ['OPENAI_BASE_URL'] = url + 'v1'
+    with tempfile.TemporaryDirectory(prefix='chatmax-bench-') as tmp:
+        prefs_path = os.path.join(tmp, 'preferences.json')
+        save_prefs_list(synthetic_preferences(rng, args.prefs), prefs_path)
+        session = ChatSession({'use_local_ai': spec['mode'] == 'local', 'openai_api_key': f'bench-{name}-{os.getpid()}',
+                               'server_endpoint': url, 'ai_model': DEFAULT_AI_MODEL, 'ai_history_lines': args.history_lines,
+                               'offline_queue': False, 'server_delta_sync': bool(spec.get('delta_sync'))}, prefs_path=prefs_path,
+                              ephemeral=True)
+        session.extract_preferences = spec['extract']
+
+        # Time to first byte of the chat request (server mode: requests sets
+        # elapsed once the headers are in, before the body is read)
+        ttfb = []
+
+        def on_response(resp, *a, **kw):
+            if resp.request.method == 'POST':
+                ttfb.append(resp.elapsed.total_seconds())
+
+        http = get_http_session()
+        http.hooks['response'].append(on_response)
+        latencies, ttft, payload_sizes, stage_samples, memory_points = [], [], [], {}, []
+        errors = 0
+        try:
+            for i in range(WARMUP_TURNS):
+                session.send(synthetic_prompt(rng, i))
+            WRITER.flush()
+            if spec.get('memory'):
+                tracemalloc.start(1)
+            mem_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            rss_start = rss_kib()
+            wire_start = WIRE.summary()['request_wire']
+            files.reset()
+            files.active = True
+            cpu_start = time.process_time()
+            started = time.perf_counter()
+            for i in range(turns):
+                message = synthetic_prompt(rng, i + WARMUP_TURNS)
+                del ttfb[:]
+                trace = session.new_trace()
+                t0 = time.perf_counter()
+                payload, preset_label, _ = session.begin_turn(message, trace)
+                try:
+                    session.complete_turn(payload, message, preset_label, trace)
+                except Exception as e:
+                    errors += 1
+                    session.add_message(preset_label, f'Error: {e}')
+                latencies.append(time.perf_counter() - t0)
+                TRACES.add(trace.finish())
+                for stage, value in trace.stage_totals().items():
+                    stage_samples.setdefault(stage, []).append(value / 1000.0)
+                payload_sizes.append(len(json_dumps(payload)))
+                if ttfb and spec['mode'] == 'server':
+                    ttft.append(ttfb[-1])
+                if spec.get('memory') and (i + 1) % MEMORY_CHECKPOINT_TURNS == 0:
+                    memory_points.append((i + 1, tracemalloc.get_traced_memory()[0]))
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu_start
+            WRITER.flush()
+            files.active = False
+        finally:
+            files.active = False
+            http.hooks['response'].remove(on_response)
+            backend.stop()
+        result = {
+            'mode': spec['mode'],
+            'turns': turns,
+            'errors': errors,
+            'latency_s': backend.latency_s,
+            'tokens_per_s': backend.tokens_per_s,
+            'elapsed_s': round(elapsed, 3),
+            'turns_per_s': round(turns / elapsed, 2) if elapsed else None,
+            'turn_p50_ms': ms(latencies, 50),
+            'turn_p95_ms': ms(latencies, 95),
+            'turn_max_ms': round(max(latencies) * 1000, 3) if latencies else None,
+            'ttft_p50_ms': ms(ttft, 50),
+            'ttft_p95_ms': ms(ttft, 95),
+            'cpu_ms_per_turn': round(cpu / turns * 1000, 3),
+            'payload_bytes_mean': round(sum(payload_sizes) / len(payload_sizes)) if payload_sizes else None,
+            'payload_bytes_max': max(payload_sizes) if payload_sizes else None,
+            'wire_bytes_per_turn': round((WIRE.summary()['request_wire'] - wire_start) / turns) if spec['mode'] == 'server' else None,
+            'file_opens_per_turn': round((files.reads + files.writes) / turns, 3),
+            'file_reads_per_turn': round(files.reads / turns, 3),
+            'file_writes_per_turn': round(files.writes / turns, 3),
+            'stages_p50_ms': {stage: ms(values, 50) for stage, values in sorted(stage_samples.items())},
+            'backend_requests': backend.requests,
+        }
+        if spec.get('memory'):
+            mem_end, mem_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            growth = slope(memory_points)
+            rss_end = rss_kib()
+            result.update({
+                'memory_growth_bytes_per_turn': round(growth, 1) if growth is not None else None,
+                'memory_traced_start_kib': round(mem_start / 1024, 1),
+                'memory_traced_end_kib': round(mem_end / 1024, 1),
+                'memory_traced_peak_kib': round(mem_peak / 1024, 1),
+                'rss_start_kib': rss_start,
+                'rss_end_kib': rss_end,
+                'memory_checkpoints': [[t, round(b / 1024, 1)] for t, b in memory_points],
+            })
+        return result
+
+
+def tree_version():
+    # Version from the engine's header comment, plus the git commit when available
+    version = None
+    try:
+        with open(chatmax_engine.__file__, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('# Version:'):
+                    version = line.split(':', 1)[1].split()[0]
+                    break
+    except Exception:
+        pass
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        commit = None
+    return version, commit
+
+
+def compare_results(old: dict, new: dict, threshold: float):
+    # Rows (scenario, metric, old, new, relative change, regression?)
+    rows = []
+    for name, current in new.get('scenarios', {}).items():
+        previous = old.get('scenarios', {}).get(name)
+        if not previous or 'skipped' in previous or 'skipped' in current:
+            continue
+        for metric in COMPARED_METRICS:
+            a, b = previous.get(metric), current.get(metric)
+            if a is None or b is None:
+                continue
+            change = (b - a) / abs(a) if a else (0.0 if b == a else math.inf)
+            rows.append((name, metric, a, b, change, change > threshold))
+    return rows
+
+
+def format_report(results: dict):
+    lines = [f"[bench] Chat Max {results['version'] or '?'} ({results['commit'] or 'no git'}), python {results['python']}"]
+    for name, r in results['scenarios'].items():
+        if 'skipped' in r:
+            lines.append(f"[bench] {name}: skipped ({r['skipped']})")
+            continue
+        line = (f"[bench] {name}: {r['turns']} turns, turn p50 {r['turn_p50_ms']} ms / p95 {r['turn_p95_ms']} ms, "
+                f"ttft p50 {r['ttft_p50_ms']} ms, cpu {r['cpu_ms_per_turn']} ms/turn, payload {r['payload_bytes_mean']} B, "
+                f"{r['file_opens_per_turn']} file opens/turn")
+        if r.get('wire_bytes_per_turn') is not None:
+            line += f", {r['wire_bytes_per_turn']} B sent/turn"
+        if r.get('memory_growth_bytes_per_turn') is not None:
+            line += f", memory +{r['memory_growth_bytes_per_turn']} B/turn"
+        if r['errors']:
+            line += f", {r['errors']} errors"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='End-to-end Chat Max benchmarks against a deterministic fake backend.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='scenario to run (repeatable, default: all)')
+    parser.add_argument('--turns', type=int, help='measured turns per scenario (default: per scenario)')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY_S, help='fake backend seconds to first byte')
+    parser.add_argument('--tokens-per-s', type=float, default=DEFAULT_TOKENS_PER_S, help='fake backend reply tokens per second (0 = instant)')
+    parser.add_argument('--history-lines', type=int, default=chatmax_engine.HISTORY_DEFAULT_LINES, help='short-term history sent per turn')
+    parser.add_argument('--prefs', type=int, default=20, help='synthetic preferences in the preferences file')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for prompts')
+    parser.add_argument('--label', help='name for this run in the results (default: the version)')
+    parser.add_argument('--output', help='results file (default: bench_results/e2e-<label>-<time>.json, - for none)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='relative increase reported as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 when --compare finds a regression')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    version, commit = tree_version()
+    files = FileOpenCounter()
+    results = {
+        'format': RESULTS_FORMAT,
+        'format_version': RESULTS_VERSION,
+        'label': args.label or version,
+        'version': version,
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {k: v for k, v in vars(args).items() if k not in ('compare', 'output', 'fail_on_regression')},
+        'scenarios': {},
+    }
+    for name in args.scenario or list(SCENARIOS):
+        print(f'[bench] running {name}...', file=sys.stderr)
+        results['scenarios'][name] = run_scenario(name, SCENARIOS[name], args, files)
+    print(format_report(results), file=sys.stderr)
+    if args.output != '-':
+        path = args.output or os.path.join(RESULTS_DIR, f"e2e-{results['label'] or 'run'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'[bench] results written to {path}', file=sys.stderr)
+    status = 0
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"[bench] compared with {baseline.get('label')} ({baseline.get('commit')}):", file=sys.stderr)
+        differing = [k for k in ('turns', 'latency', 'tokens_per_s', 'history_lines', 'prefs', 'seed')
+                     if baseline.get('params', {}).get(k) != results['params'].get(k)]
+        if differing:
+            print(f"[bench]   note: run parameters differ ({', '.join(differing)}), changes may not be comparable", file=sys.stderr)
+        for name, metric, a, b, change, regressed in compare_results(baseline, results, args.threshold):
+            flag = '  REGRESSION' if regressed else ''
+            print(f'[bench]   {name} {metric}: {a} -> {b} ({change:+.1%}){flag}', file=sys.stderr)
+            if regressed and args.fail_on_regression:
+                status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+# File:        chatmax_catalog.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Catalog of saved Chat Max conversations. A small JSON file in
+#              the conversations/ folder records each conversation's title,
+#              message count, last message time, preset and size, updated on
+#              every save/load, so startup can offer a recent-conversations
+#              list (and "resume last") without opening the files themselves.
+#              New or changed files are scanned in parallel.
+
+
+# Imports
+
+# Catalog persistence
+import json
+# Parallel scanning of conversation files
+from concurrent.futures import ThreadPoolExecutor
+# Locking for catalogs updated from worker threads
+import threading
+# Saved-at timestamps
+import time
+# OS for file paths
+import os
+# Conversation file reading and titles
+from chatmax_convfile import read_conversation, strip_extension, FORMATS
+# Catalog writes go through the background writer
+from chatmax_writer import WRITER
+# Role label of the user's messages (anything else is the assistant/preset);
+# from chatmax_messages, importing the engine here would slow down startup
+from chatmax_messages import USER_ROLE
+
+
+# Constants
+
+# Catalog file name inside the conversations folder (hidden from scans)
+CATALOG_NAME = '.catalog.json'
+# Entries shown in the quick-open list
+RECENT_LIMIT = 10
+# Worker threads used when scanning files
+SCAN_WORKERS = 8
+
+
+# Functions
+
+def is_conversation_file(name: str):
+    low = name.lower()
+    return not name.startswith('.') and not low.endswith('.tmp') and any(low.endswith(ext) for _, ext in FORMATS.values())
+
+
+def describe_conversation(path: str, messages, size: int | None = None, mtime: float | None = None):
+    # Catalog entry from a conversation's messages (already in memory on save/load)
+    last_ts = None
+    preset = None
+    count = 0
+    for msg in messages:
+        count += 1
+        last_ts = msg.ts
+        if msg.role != USER_ROLE:
+            preset = msg.role
+    try:
+        st = os.stat(path)
+        size = st.st_size if size is None else size
+        mtime = st.st_mtime if mtime is None else mtime
+    except Exception:
+        pass
+    return {
+        'path': os.path.abspath(path),
+        'title': strip_extension(path),
+        'messages': count,
+        'last_ts': last_ts,
+        'preset': preset,
+        'size': size,
+        'mtime': mtime,
+    }
+
+
+def scan_file(path: str):
+    # Read one file and describe it, None if it is not a readable conversation
+    try:
+        st = os.stat(path)
+        messages, _ = read_conversation(path)
+        return describe_conversation(path, messages, st.st_size, st.st_mtime)
+    except Exception:
+        return None
+
+
+class ConversationCatalog:
+    # Entries keyed by absolute path plus the most recently used conversation
+
+    def __init__(self, conv_dir: str):
+        self.conv_dir = conv_dir
+        self.path = os.path.join(conv_dir, CATALOG_NAME)
+        self.entries = {}
+        self.last_path = None
+        # Files that failed to parse, by (size, mtime), so they are not re-read every refresh
+        self._unreadable = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            text = WRITER.read_text(self.path)
+            data = json.loads(text) if text else {}
+        except Exception:
+            data = {}
+        with self._lock:
+            self.entries = {e['path']: e for e in data.get('entries', []) if isinstance(e, dict) and e.get('path')}
+            self.last_path = data.get('last_path')
+
+    def save(self):
+        with self._lock:
+            data = {'version': 1, 'saved_at': int(time.time()), 'last_path': self.last_path, 'entries': list(self.entries.values())}
+        WRITER.submit(self.path, json.dumps(data, ensure_ascii=False), mode=None)
+
+    def record(self, path: str, messages):
+        # Called after a save or load: refresh the entry and mark it most recent
+        entry = describe_conversation(path, messages)
+        with self._lock:
+            self.entries[entry['path']] = entry
+            self.last_path = entry['path']
+        self.save()
+        return entry
+
+    def recent(self, limit: int = RECENT_LIMIT):
+        # Most recently active conversations that still exist on disk
+        with self._lock:
+            entries = list(self.entries.values())
+        entries = [e for e in entries if os.path.exists(e['path'])]
+        entries.sort(key=lambda e: (e.get('last_ts') or 0, e.get('mtime') or 0), reverse=True)
+        return entries[:limit]
+
+    def last(self):
+        with self._lock:
+            path = self.last_path
+            entry = self.entries.get(path) if path else None
+        return entry if entry and os.path.exists(entry['path']) else None
+
+    def refresh(self, workers: int = SCAN_WORKERS):
+        # Bring the catalog in line with the folder: scan new or changed files
+        # in parallel and drop entries whose file is gone. Returns the number scanned
+        try:
+            names = [n for n in os.listdir(self.conv_dir) if is_conversation_file(n)]
+        except Exception:
+            return 0
+        present = {}
+        for name in names:
+            full = os.path.abspath(os.path.join(self.conv_dir, name))
+            try:
+                st = os.stat(full)
+            except Exception:
+                continue
+            present[full] = st
+        with self._lock:
+            stale = [p for p, st in present.items()
+                     if self._unreadable.get(p) != (st.st_size, st.st_mtime)
+                     and (p not in self.entries or self.entries[p].get('size') != st.st_size or self.entries[p].get('mtime') != st.st_mtime)]
+            missing = [p for p in self.entries if p not in present and os.path.dirname(p) == os.path.abspath(self.conv_dir)]
+        scanned = []
+        if stale:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(stale)))) as pool:
+                scanned = list(pool.map(scan_file, stale))
+        if not stale and not missing:
+            return 0
+        with self._lock:
+            for p, e in zip(stale, scanned):
+                if e is None:
+                    self._unreadable[p] = (present[p].st_size, present[p].st_mtime)
+                    self.entries.pop(p, None)
+            for p in missing:
+                self.entries.pop(p, None)
+            for e in scanned:
+                if e is not None:
+                    self.entries[e['path']] = e
+        self.save()
+        return len(stale)
+
+    def rebuild(self, workers: int = SCAN_WORKERS):
+        # Forget everything and rescan the whole folder
+        with self._lock:
+            self.entries = {}
+            self._unreadable = {}
+        return self.refresh(workers)
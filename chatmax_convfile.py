@@ -0,0 +1,181 @@
+# File:        chatmax_convfile.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Saved-conversation file formats for Chat Max. Besides the
+#              original pretty-printed JSON, conversations can be written in a
+#              compact versioned layout (role/model tables, epoch timestamps,
+#              minified), optionally gzip- or zstd-compressed or as msgpack.
+#              Loading detects the format from the file's first bytes, and
+#              orjson is used for JSON when it is installed.
+
+
+# Imports
+
+# Standard-library JSON (fallback when orjson is missing)
+import json
+# gzip compression (always available)
+import gzip
+# Detecting optional libraries without importing them
+import importlib.util
+# OS for file paths
+import os
+# Message records
+from chatmax_messages import Message
+# Atomic file replacement
+from chatmax_writer import atomic_write
+
+# Optional fast JSON
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+
+# Constants
+
+# Marker and version of the compact layout
+FORMAT_NAME = 'chatmax-conversation'
+FORMAT_VERSION = 2
+
+# Save formats: name -> (label, file extension)
+FORMATS = {
+    'json': ('Readable JSON', '.json'),
+    'compact': ('Compact JSON', '.json'),
+    'gzip': ('Compact JSON, gzip', '.json.gz'),
+    'zstd': ('Compact JSON, zstd', '.json.zst'),
+    'msgpack': ('msgpack', '.msgpack'),
+}
+DEFAULT_FORMAT = 'json'
+
+# Leading bytes of compressed files
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# File dialog filter covering every format
+FILE_TYPES = [('Conversations', '*.json *.json.gz *.json.zst *.msgpack'), ('All files', '*.*')]
+
+
+# Functions
+
+def available_formats():
+    # Formats whose optional libraries are installed
+    needs = {'zstd': 'zstandard', 'msgpack': 'msgpack'}
+    return [name for name in FORMATS if name not in needs or importlib.util.find_spec(needs[name]) is not None]
+
+
+def json_dumps(obj, pretty: bool = False):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def _compact_dict(messages, meta: dict):
+    # Roles and models are stored once in tables and referenced by index
+    roles, models = {}, {}
+    rows = []
+    for msg in messages:
+        row = [roles.setdefault(msg.role, len(roles)), msg.text, msg.ts]
+        if msg.model:
+            row.append(models.setdefault(msg.model, len(models)))
+        rows.append(row)
+    data = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'roles': list(roles), 'models': list(models), 'messages': rows}
+    data.update(meta)
+    return data
+
+
+def encode_conversation(messages, meta: dict, fmt: str = DEFAULT_FORMAT):
+    # Bytes of a conversation file in the requested format
+    if fmt == 'json':
+        # The original layout: [role, message, 'YYYY-mm-dd HH:MM:SS'(, model)] lists
+        data = {'messages': [m.to_list() for m in messages]}
+        data.update(meta)
+        return json_dumps(data, pretty=True)
+    data = _compact_dict(messages, meta)
+    if fmt == 'msgpack':
+        import msgpack
+        return msgpack.packb(data, use_bin_type=True)
+    body = json_dumps(data)
+    if fmt == 'gzip':
+        # mtime=0 keeps identical conversations byte-identical
+        return gzip.compress(body, compresslevel=6, mtime=0)
+    if fmt == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=6).compress(body)
+    return body
+
+
+def _is_msgpack(data: bytes):
+    # Compact files are maps: fixmap (0x80-0x8f) or map16/map32
+    return bool(data) and (0x80 <= data[0] <= 0x8f or data[0] in (0xde, 0xdf))
+
+
+def decode_conversation(data: bytes):
+    # (messages, meta) from any supported format, detected from the content
+    if data.startswith(GZIP_MAGIC):
+        data = gzip.decompress(data)
+    elif data.startswith(ZSTD_MAGIC):
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if _is_msgpack(data):
+        import msgpack
+        loaded = msgpack.unpackb(data, raw=False)
+    else:
+        loaded = json_loads(data)
+
+    # Older files are a bare list of [role, message(, timestamp)] items
+    if isinstance(loaded, list):
+        return [m for m in map(Message.from_item, loaded) if m is not None], {}
+    if not isinstance(loaded, dict):
+        raise ValueError('not a Chat Max conversation file')
+    meta = {k: v for k, v in loaded.items() if k not in ('format', 'version', 'roles', 'models', 'messages')}
+    if loaded.get('format') != FORMAT_NAME:
+        # Readable JSON: {'messages': [[role, message, timestamp(, model)], ...], 'usage': ...}
+        rows = loaded.get('messages')
+        if not isinstance(rows, list):
+            raise ValueError('not a Chat Max conversation file')
+        return [m for m in map(Message.from_item, rows) if m is not None], meta
+    if int(loaded.get('version', 0)) > FORMAT_VERSION:
+        raise ValueError(f"conversation file version {loaded.get('version')} is newer than this app supports")
+    roles = loaded.get('roles') or []
+    models = loaded.get('models') or []
+    messages = []
+    for row in loaded.get('messages') or []:
+        model = models[row[3]] if len(row) > 3 else None
+        messages.append(Message(roles[row[0]], row[1], row[2], model))
+    return messages, meta
+
+
+def write_conversation(path: str, messages, meta: dict, fmt: str = DEFAULT_FORMAT):
+    # Written next to the target and swapped in, so a failed save never truncates an archive
+    if fmt not in FORMATS:
+        fmt = DEFAULT_FORMAT
+    data = encode_conversation(messages, meta, fmt)
+    atomic_write(path, data, mode=None, raise_errors=True)
+    return len(data)
+
+
+def read_conversation(path: str):
+    with open(path, 'rb') as f:
+        return decode_conversation(f.read())
+
+
+def default_extension(fmt: str):
+    return FORMATS.get(fmt, FORMATS[DEFAULT_FORMAT])[1]
+
+
+def strip_extension(path: str):
+    # Title of a conversation file: its name without any of our extensions
+    name = os.path.basename(path)
+    for ext in sorted({e for _, e in FORMATS.values()}, key=len, reverse=True):
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
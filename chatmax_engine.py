@@ -0,0 +1,1496 @@
+# File:        chatmax_engine.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Headless chat engine for Chat Max. Owns conversation history,
+#              personality values, preferences and the local/server backends
+#              so the chat pipeline can run without a display. The Tkinter GUI
+#              (chatmax-v0-4-4.py) is a thin client over ChatSession.
+
+
+# Imports
+
+# JSON file handling to store preferences and settings at appropriate level
+import json
+# Results handed back from raced model calls
+import queue
+# Locking so the GUI thread and worker threads can share a session
+import threading
+# Time for timestamps and preference entry tracking
+import time
+# OS for file paths
+import os
+# Per-turn latency tracing
+from chatmax_trace import Trace, TRACES, activate, current_trace, span, STAGE_PAYLOAD, STAGE_PREFS_IO, STAGE_EXTRACTION, STAGE_MAIN_CALL, STAGE_JSON_DECODE
+# Token usage and cost metering
+from chatmax_usage import UsageMeter, PURPOSE_CHAT, PURPOSE_EXTRACTION, normalize_usage
+# Observed latency histograms and the timeouts derived from them
+from chatmax_latency import LatencyTracker, get_latency_tracker, latency_key, LATENCY_PATH
+# Compact message records and the (optionally disk-spilled) full history
+from chatmax_messages import Message, MessageLog, USER_ROLE, parse_ts, format_ts
+# Background write-behind for settings/preferences/presets
+from chatmax_writer import WRITER
+# Multi-endpoint routing, health checks and failover for server mode
+from chatmax_routing import get_endpoint_pool, parse_endpoints, merge_hedge_policy
+# Shared request/token budgets per API key or server, 429 handling
+from chatmax_ratelimit import get_rate_limiter, limiter_key, merge_rate_limits, estimate_tokens, PRIORITY_CHAT, PRIORITY_BACKGROUND
+# Optional gzip request bodies and wire byte counters for server mode
+from chatmax_wire import WIRE, GZIP_REJECTED, encode_body, response_sizes, merge_compression_settings
+# Durable queue of turns that could not be delivered
+from chatmax_outbox import Outbox, get_outbox, is_offline_error, new_conversation_id, TurnQueued
+# Server-mode delta sync (only new messages are sent once the server has the conversation)
+from chatmax_sync import SYNC, RESYNC_STATUS
+# The network backends (`requests`, and `openai` which pulls in pydantic/httpx)
+# are imported on first use or warmed by warm_backends(), not at import time
+
+
+# Constants
+
+# Paths
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Preferences are stored in 'preferences.json' as a list of timestamped entries
+PREFS_PATH = os.path.join(BASE_DIR, 'preferences.json')
+# Settings are stored in 'settings.json' as key-value pair dict of configuration options
+SETTINGS_PATH = os.path.join(BASE_DIR, 'settings.json')
+# Saved presets and the last selection
+PRESETS_PATH = os.path.join(BASE_DIR, 'presets.json')
+# Per-preset JSON files
+PERSONALITIES_DIR = os.path.join(BASE_DIR, 'personalities')
+# Saved conversations
+CONVERSATIONS_DIR = os.path.join(BASE_DIR, 'conversations')
+# Turns waiting to be delivered while offline
+OUTBOX_PATH = os.path.join(BASE_DIR, 'outbox.json')
+
+# Defaults
+# Default maximum chat history entries to keep (can be changed by user via UI)
+HISTORY_DEFAULT_LINES = 20
+# Default maximum preference entries to keep (can be changed by user via UI)
+PREFS_DEFAULT_LINES = 20
+# Upper bound for both memory limits exposed in the UI
+MEMORY_MAX_LINES = 50
+# Model used for local calls when none has been chosen
+DEFAULT_AI_MODEL = 'gpt-4o-mini'
+# Models offered in the 'AI Model...' dialog, fastest first (fallback order
+# until observed latency says otherwise)
+AI_MODELS = ['gpt-4o-mini', 'gpt-5-nano', 'gpt-5-mini']
+# Preference extraction settings, overridable via settings.json 'extraction'.
+# Extraction is a short list-the-new-facts task, so it defaults to the fastest
+# model with minimal reasoning and a small output cap. timeout_s None derives
+# the timeout from observed extraction latency
+DEFAULT_EXTRACTION = {
+    'model': AI_MODELS[0],
+    'reasoning_effort': 'minimal',
+    'max_tokens': 256,
+    'timeout_s': None,
+    'concurrency': 2,
+}
+# Reasoning efforts accepted by the gpt-5 models
+REASONING_EFFORTS = ['minimal', 'low', 'medium', 'high']
+# How long a turn waits for an extraction slot before skipping extraction
+EXTRACTION_SLOT_WAIT_S = 1.0
+
+# Built-in presets (shared so they can be referenced at startup)
+# Slider order: friendliness, professionalism, profanity, age, gender, humour, sarcasm, extroversion
+DEFAULT_PRESETS = {
+    'Default AI': (2, 1, 0, 30, 1, 0, 0, 1),
+    'Helpful Professional': (2, 2, 0, 35, 1, 0, 0, 1),
+    'Casual Friendly': (3, 0, 0, 25, 1, 1, 0, 1),
+    'Playful Sarcastic': (2, 0, 1, 18, 1, 2, 2, 1),
+    'Child-Friendly': (3, 1, 0, 12, 1, 0, 0, 2),
+    'Stoic Professional': (1, 2, 0, 40, 1, 0, 0, 0),
+    'Sailor-Mouth': (0, 0, 2, 30, 1, 1, 2, 0),
+}
+
+# Prompt used to extract preference lines from the user's messages
+EXTRACTION_PROMPT = (
+    "Extract concise user preference statements from the conversation. "
+    "Important: consider ONLY the user's messages; ignore all assistant/AI utterances. "
+    "Output plain text only, one canonical statement per line, using this exact pattern: The user's <property> is <value>. "
+    "Examples: The user's favourite colour is purple; The user's name is Colin. "
+    "Do NOT include numbering, explanations, or extra commentary. Compare with the existing preferences below and output ONLY NEW or UPDATED preference lines (one per line). If there are none, output nothing."
+)
+
+# OpenAI clients keyed by API key so connections are reused between calls
+_openai_clients = {}
+_openai_clients_lock = threading.Lock()
+
+# Shared HTTP session for server mode (keep-alive connection pool)
+_http_session = None
+_http_session_lock = threading.Lock()
+# Connections kept open per host, and how long idle ones stay usable (seconds)
+HTTP_POOL_SIZE = 16
+KEEPALIVE_S = 90.0
+# Speculative warm-ups of the same backend at most this often (seconds)
+WARM_INTERVAL_S = 30.0
+WARM_TIMEOUT_S = 5.0
+# Last warm-up per backend target (monotonic seconds)
+_warmed = {}
+_warmed_lock = threading.Lock()
+
+# Preference file text keyed by path: ((mtime_ns, size), text)
+_prefs_text_cache = {}
+
+# Parsed personalities/ directories keyed by path: ({file: (mtime_ns, size)}, {name: values}, {file: ((mtime_ns, size), values)})
+_personality_cache = {}
+
+# Serializes the read-merge-write of preference files when several sessions
+# (GUI worker, batch runs) update them concurrently
+PREFS_LOCK = threading.Lock()
+# Serializes the read-merge-write of settings.json
+SETTINGS_LOCK = threading.RLock()
+
+
+# Functions
+
+# Settings
+
+def load_settings():
+    try:
+        # Pending (not yet flushed) settings win over the file on disk
+        text = WRITER.read_text(SETTINGS_PATH)
+        if text:
+            loaded = json.loads(text)
+            return {
+                'use_local_ai': bool(loaded.get('use_local_ai', True)),
+                'openai_api_key': loaded.get('openai_api_key'),
+                'server_endpoint': loaded.get('server_endpoint'),
+                'last_credential_deleted': loaded.get('last_credential_deleted'),
+                'last_credential_deleted_ts': loaded.get('last_credential_deleted_ts'),
+                'ai_history_lines': loaded.get('ai_history_lines'),
+                'pref_memory_lines': loaded.get('pref_memory_lines'),
+                'ai_model': loaded.get('ai_model') or DEFAULT_AI_MODEL,
+                'timeout_policy': loaded.get('timeout_policy'),
+                'hedge_policy': loaded.get('hedge_policy'),
+                'model_budget': loaded.get('model_budget'),
+                'extraction': loaded.get('extraction'),
+                'history_spill': loaded.get('history_spill'),
+                'conversation_format': loaded.get('conversation_format'),
+                'render_budget_ms': loaded.get('render_budget_ms'),
+                'rate_limits': loaded.get('rate_limits'),
+                'offline_queue': bool(loaded.get('offline_queue', True)),
+                'server_compression': loaded.get('server_compression'),
+                'server_delta_sync': bool(loaded.get('server_delta_sync', False))
+            }
+    except Exception:
+        pass
+    return {'use_local_ai': True, 'openai_api_key': None, 'server_endpoint': None, 'last_credential_deleted': None, 'ai_history_lines': None, 'pref_memory_lines': None, 'ai_model': DEFAULT_AI_MODEL, 'timeout_policy': None, 'hedge_policy': None, 'model_budget': None, 'extraction': None, 'history_spill': None, 'conversation_format': None, 'render_budget_ms': None, 'rate_limits': None, 'offline_queue': True, 'server_compression': None, 'server_delta_sync': False}
+
+
+def get_saved_api_key():
+    try:
+        loaded = load_settings()
+        if isinstance(loaded, dict):
+            key = loaded.get('openai_api_key')
+            if key:
+                return key
+    except Exception:
+        pass
+    return None
+
+
+def get_saved_endpoint():
+    try:
+        loaded = load_settings()
+        if isinstance(loaded, dict):
+            # Several endpoints are shown and edited as one comma-separated string
+            ep = ', '.join(parse_endpoints(loaded.get('server_endpoint')))
+            if ep:
+                return ep
+    except Exception:
+        pass
+    return None
+
+
+def get_saved_ai_model():
+    try:
+        loaded = load_settings()
+        if isinstance(loaded, dict):
+            model = loaded.get('ai_model')
+            if model:
+                return model
+    except Exception:
+        pass
+    return DEFAULT_AI_MODEL
+
+
+def clamp_memory_lines(value, default: int):
+    # Settings values may be missing or malformed, clamp to the range the UI exposes
+    try:
+        if value is None:
+            return default
+        return max(0, min(MEMORY_MAX_LINES, int(value)))
+    except Exception:
+        return default
+
+
+def parse_model_budget(value):
+    # {'budget_s': seconds or None (off), 'race': bool} from settings or a conversation file
+    budget, race = None, False
+    if isinstance(value, dict):
+        try:
+            if value.get('budget_s'):
+                budget = max(0.5, float(value['budget_s']))
+        except Exception:
+            budget = None
+        race = bool(value.get('race', False))
+    return {'budget_s': budget, 'race': race}
+
+
+def merge_extraction_settings(value):
+    # Defaults overlaid with whatever valid values settings.json carries
+    merged = dict(DEFAULT_EXTRACTION)
+    if isinstance(value, dict):
+        if value.get('model') in AI_MODELS:
+            merged['model'] = value['model']
+        if value.get('reasoning_effort') in REASONING_EFFORTS:
+            merged['reasoning_effort'] = value['reasoning_effort']
+        for key, low in (('max_tokens', 16), ('concurrency', 1)):
+            try:
+                if value.get(key) is not None:
+                    merged[key] = max(low, int(value[key]))
+            except Exception:
+                pass
+        try:
+            if value.get('timeout_s'):
+                merged['timeout_s'] = max(1.0, float(value['timeout_s']))
+        except Exception:
+            pass
+    return merged
+
+
+# One slot pool per concurrency limit, shared by every session in the process
+_extraction_slots = {}
+_extraction_slots_lock = threading.Lock()
+
+
+def get_extraction_slots(limit: int):
+    with _extraction_slots_lock:
+        slots = _extraction_slots.get(limit)
+        if slots is None:
+            slots = threading.BoundedSemaphore(limit)
+            _extraction_slots[limit] = slots
+        return slots
+
+
+def save_settings(use_local: bool, api_key: str | None = None, endpoint: str | None = None, last_deleted: str | None = None, ai_history_lines: int | None = None, pref_memory_lines: int | None = None, ai_model: str | None = None, timeout_policy: dict | None = None, hedge_policy: dict | None = None, model_budget: dict | None = None, extraction: dict | None = None, conversation_format: str | None = None, render_budget_ms: int | None = None, rate_limits: dict | None = None, offline_queue: bool | None = None, server_compression: dict | None = None, server_delta_sync: bool | None = None):
+    with SETTINGS_LOCK:
+        try:
+            # Load existing settings (including pending writes) to preserve unrelated fields
+            data = {}
+            try:
+                text = WRITER.read_text(SETTINGS_PATH)
+                if text:
+                    data = json.loads(text) or {}
+            except Exception:
+                data = {}
+            data['use_local_ai'] = bool(use_local)
+            if api_key is not None:
+                if api_key:
+                    data['openai_api_key'] = api_key
+                else:
+                    # remove stored key
+                    data.pop('openai_api_key', None)
+            if endpoint is not None:
+                urls = parse_endpoints(endpoint)
+                if urls:
+                    # A single URL stays a plain string so older versions can read it
+                    data['server_endpoint'] = urls[0] if len(urls) == 1 else urls
+                else:
+                    data.pop('server_endpoint', None)
+
+            # Record which credential was deleted most recently (if provided)
+            # Use a stable key name so startup logic can prefer prompting the
+            # most recently removed credential when both are missing
+            if last_deleted is not None:
+                if last_deleted:
+                    data['last_credential_deleted'] = str(last_deleted)
+                    try:
+                        data['last_credential_deleted_ts'] = int(time.time())
+                    except Exception:
+                        pass
+                else:
+                    data.pop('last_credential_deleted', None)
+                    data.pop('last_credential_deleted_ts', None)
+
+            # Persist an optional AI history-lines limit so the UI can round-trip
+            # the user's choice, if ai_history_lines is None we leave the value
+            # unchanged, an explicit integer will be stored (and should be a
+            # small non-negative number)
+            if ai_history_lines is not None:
+                try:
+                    data['ai_history_lines'] = int(ai_history_lines)
+                except Exception:
+                    # ignore invalid values
+                    pass
+            # Persist preference memory limit if provided
+            if pref_memory_lines is not None:
+                try:
+                    data['pref_memory_lines'] = int(pref_memory_lines)
+                except Exception:
+                    pass
+            # Persist AI model if provided
+            if ai_model is not None:
+                try:
+                    data['ai_model'] = str(ai_model)
+                except Exception:
+                    pass
+            # Persist adaptive timeout policy (factor/floor/ceiling) if provided
+            if timeout_policy is not None:
+                data['timeout_policy'] = dict(timeout_policy)
+            # Persist server-mode hedging policy (enabled/percentile/rate cap) if provided
+            if hedge_policy is not None:
+                data['hedge_policy'] = dict(hedge_policy)
+            # Persist the default local-mode latency budget for new conversations if provided
+            if model_budget is not None:
+                data['model_budget'] = dict(model_budget)
+            # Persist preference extraction model/effort/limits if provided
+            if extraction is not None:
+                data['extraction'] = dict(extraction)
+            # Persist the saved-conversation file format if provided
+            if conversation_format is not None:
+                data['conversation_format'] = str(conversation_format)
+            # Persist the chat view's per-slice insertion budget if provided
+            if render_budget_ms is not None:
+                data['render_budget_ms'] = int(render_budget_ms)
+            # Persist the client-side rate limits if provided
+            if rate_limits is not None:
+                data['rate_limits'] = dict(rate_limits)
+            # Persist whether undeliverable turns are queued if provided
+            if offline_queue is not None:
+                data['offline_queue'] = bool(offline_queue)
+            # Persist server-mode request compression if provided
+            if server_compression is not None:
+                data['server_compression'] = dict(server_compression)
+            # Persist whether server mode uses the delta-sync protocol if provided
+            if server_delta_sync is not None:
+                data['server_delta_sync'] = bool(server_delta_sync)
+            WRITER.submit(SETTINGS_PATH, json.dumps(data, ensure_ascii=False, indent=2))
+        except Exception:
+            pass
+
+
+# Preferences
+
+def load_prefs_list(path: str = PREFS_PATH):
+    try:
+        text = WRITER.read_text(path)
+        if not text:
+            # No preferences file yet, return empty list
+            return []
+        loaded = json.loads(text)
+        out = []
+        if isinstance(loaded, list):
+            for item in loaded:
+                if isinstance(item, dict) and 'line' in item:
+                    try:
+                        ts = int(item.get('ts')) if item.get('ts') is not None else int(time.time())
+                    except Exception:
+                        ts = int(time.time())
+                    out.append({'line': str(item.get('line') or ''), 'ts': ts})
+                else:
+                    # older formats where each list item is a string
+                    out.append({'line': str(item), 'ts': int(time.time())})
+        elif isinstance(loaded, str):
+            for l in loaded.splitlines():
+                l = l.strip()
+                if l:
+                    out.append({'line': l, 'ts': int(time.time())})
+        return out
+    except Exception:
+        return []
+
+
+def save_prefs_list(entries: list, path: str = PREFS_PATH):
+    try:
+        # Ensure serializable
+        serial = []
+        for e in entries:
+            serial.append({'line': str(e.get('line') or ''), 'ts': int(e.get('ts') or int(time.time()))})
+        WRITER.submit(path, json.dumps(serial, ensure_ascii=False, indent=2))
+    except Exception:
+        pass
+
+
+def read_prefs_text(path: str = PREFS_PATH):
+    # The raw preferences file content is what gets sent to the model. Pending
+    # writes win, otherwise the file is only re-read when it has changed
+    try:
+        pending, text = WRITER.pending_text(path)
+        if pending:
+            return (text or '').strip()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return ''
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = _prefs_text_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        text = (WRITER.read_text(path) or '').strip()
+        _prefs_text_cache[path] = (stamp, text)
+        return text
+    except Exception:
+        pass
+    return ''
+
+
+def pref_key(line: str):
+    # Canonical key of a preference line: everything before the first ' is '
+    low = line.lower()
+    if ' is ' in low:
+        return low.split(' is ', 1)[0].strip()
+    return low
+
+
+def merge_preferences(existing: list, new_lines: list, limit: int | None = None):
+    # Build ordered key list and dict keyed by canonical pref key
+    keys = []
+    mapping = {}
+    for item in existing:
+        ln = item.get('line', '').strip()
+        if not ln:
+            continue
+        k = pref_key(ln)
+        if k in mapping:
+            # skip duplicates in file, keep first occurrence
+            continue
+        mapping[k] = {'line': ln, 'ts': int(item.get('ts') or int(time.time()))}
+        keys.append(k)
+
+    # Apply new/updated lines: move updated keys to newest position
+    for nl in new_lines:
+        k = pref_key(nl)
+        if k in mapping:
+            # remove existing key from keys order then re-append (now newest)
+            try:
+                keys.remove(k)
+            except Exception:
+                pass
+        mapping[k] = {'line': nl, 'ts': int(time.time())}
+        keys.append(k)
+
+    # Rebuild final ordered list oldest to newest
+    final = [mapping[k] for k in keys]
+
+    # Enforce preference entry limit (drop oldest when over limit)
+    if isinstance(limit, int) and limit >= 0:
+        while len(final) > limit:
+            final.pop(0)
+    return final
+
+
+def build_extraction_messages(history: list, message: str, existing_prefs: list):
+    gen_msgs = [{"role": "system", "content": EXTRACTION_PROMPT}]
+
+    # Include existing preferences as context
+    if existing_prefs:
+        prefs_text = '\n'.join([p.get('line', '') for p in existing_prefs])
+        gen_msgs.append({"role": "system", "content": "Existing preferences:\n" + prefs_text})
+
+    # Provide recent user-only history as context (limit to last 8 user messages)
+    user_msgs = [m.text for m in (Message.from_item(item) for item in history) if m is not None and m.role == USER_ROLE]
+    for um in user_msgs[-8:]:
+        gen_msgs.append({"role": "user", "content": um})
+
+    # Also include the current user message explicitly
+    gen_msgs.append({"role": "user", "content": message})
+    return gen_msgs
+
+
+def insert_system_message(payload: list, content: str):
+    # Insert before the first non-system message so it is treated as
+    # system-level context alongside personality instructions
+    insert_idx = len(payload)
+    for idx, m in enumerate(payload):
+        try:
+            if m.get('role') != 'system':
+                insert_idx = idx
+                break
+        except Exception:
+            # If message shape unexpected, continue searching
+            continue
+    payload.insert(insert_idx, {"role": "system", "content": content})
+    return payload
+
+
+# Personality
+
+def parse_preset_values(loaded):
+    # Support either a list of values or an object with 'values'
+    vals = None
+    if isinstance(loaded, list):
+        vals = loaded
+    elif isinstance(loaded, dict) and 'values' in loaded:
+        vals = loaded.get('values')
+    if vals and len(vals) >= 8:
+        return tuple(int(x) for x in vals[:8])
+    return None
+
+
+def load_preset_file(path: str):
+    try:
+        with open(path, 'r', encoding='utf-8') as pf:
+            return parse_preset_values(json.load(pf))
+    except Exception:
+        return None
+
+
+def _scan_personality_files(presets_dir: str):
+    # One os.scandir pass stats every file; only files whose mtime or size
+    # changed since the last scan (including ones edited in place) are re-read
+    files = {}
+    try:
+        with os.scandir(presets_dir) as it:
+            for de in it:
+                if de.name.lower().endswith('.json') and de.is_file():
+                    st = de.stat()
+                    files[de.name] = (st.st_mtime_ns, st.st_size)
+    except Exception:
+        return {}
+    cached = _personality_cache.get(presets_dir)
+    if cached and cached[0] == files:
+        return cached[1]
+    previous = cached[2] if cached else {}
+    values = {}
+    for fname, key in files.items():
+        old = previous.get(fname)
+        values[fname] = old[1] if old and old[0] == key else load_preset_file(os.path.join(presets_dir, fname))
+    out = {os.path.splitext(fname)[0]: vals for fname, vals in values.items() if vals}
+    _personality_cache[presets_dir] = (files, out, {fname: (files[fname], vals) for fname, vals in values.items()})
+    return out
+
+
+def load_personality_files(presets_dir: str = PERSONALITIES_DIR):
+    # Load any per-file presets from the personalities/ directory
+    return dict(_scan_personality_files(presets_dir))
+
+
+def load_startup_config(presets_path: str = PRESETS_PATH, presets_dir: str = PERSONALITIES_DIR):
+    # One pass over everything the main window needs before it appears:
+    # settings.json, presets.json and the personalities/ directory
+    return {
+        'settings': load_settings(),
+        'last_selected': load_last_selected_preset(presets_path),
+        'personality_files': load_personality_files(presets_dir),
+    }
+
+
+def load_last_selected_preset(presets_path: str = PRESETS_PATH):
+    try:
+        text = WRITER.read_text(presets_path)
+        if text:
+            loaded = json.loads(text)
+            return loaded.get('last_selected') if isinstance(loaded, dict) else None
+    except Exception:
+        pass
+    return None
+
+
+def resolve_preset_values(name: str, presets_dir: str = PERSONALITIES_DIR):
+    # Built-in presets take priority, then a file in personalities/
+    if not name:
+        return None
+    if name in DEFAULT_PRESETS:
+        return tuple(DEFAULT_PRESETS[name])
+    return load_preset_file(os.path.join(presets_dir, f"{name}.json"))
+
+
+def match_preset_name(values, presets_dir: str = PERSONALITIES_DIR):
+    tpl = tuple(int(x) for x in values)
+    # Check built-ins first
+    for name, vals in DEFAULT_PRESETS.items():
+        if tuple(vals) == tpl:
+            return name
+    # Check personalities dir for saved presets
+    for name, vals in _scan_personality_files(presets_dir).items():
+        if vals == tpl:
+            return name
+    return 'Custom'
+
+
+def describe_personality(values):
+    f, p, r, a, g, h, s, i = values
+    tone = []
+
+    # Friendliness (0-3)
+    if f == 3:
+        tone.append('very friendly')
+    elif f == 2:
+        tone.append('friendly')
+    elif f == 1:
+        tone.append('somewhat reserved')
+    else:
+        tone.append('reserved')
+
+    # Professionalism (0-2)
+    if p == 2:
+        tone.append('professional')
+    elif p == 1:
+        tone.append('somewhat professional')
+    else:
+        tone.append('casual')
+
+    # Profanity (0-2)
+    if r == 2:
+        tone.append('coarse language')
+    elif r == 1:
+        tone.append('somewhat coarse language')
+    else:
+        tone.append('clean language')
+
+    # Age (5-127)
+    tone.append(f'age {a}')
+
+    # Gender (0-2)
+    if g == 2:
+        tone.append('feminine')
+    elif g == 1:
+        tone.append('gender neutral')
+    else:
+        tone.append('masculine')
+
+    # Humor (0-2)
+    if h == 2:
+        tone.append('strong humour')
+    elif h == 1:
+        tone.append('mild humour')
+    else:
+        tone.append('no humour')
+
+    # Sarcasm (0-2)
+    if s == 2:
+        tone.append('strong sarcasm')
+    elif s == 1:
+        tone.append('mild sarcasm')
+    else:
+        tone.append('no sarcasm')
+
+    # Extroversion (0-2)
+    if i == 2:
+        tone.append('extroverted')
+    elif i == 1:
+        tone.append('neutral extroversion')
+    else:
+        tone.append('introverted')
+
+    return 'Summary: ' + ', '.join(tone) + ' '
+
+
+def build_system_prompt(preset_label: str):
+    # Start with a neutral, blank-slate system instruction, all tone/style should be provided
+    # by subsequent system messages (e.g., personality_instruction and preferences)
+    return (
+        f"Your name is {preset_label} and you are a user's chat partner. As such, you should keep responses concise, try to adapt them based on the context of the conversation, and for the most part the user's preferences or tone depending on your personality defined below."
+    )
+
+
+def build_personality_instructions(values):
+    parts = []
+    # core sliders
+    f, p, r, a, g, h, s, i = values
+
+    # Friendliness (0-3)
+    if f == 3:
+        parts.append('Be very friendly, kind and warm.')
+    elif f == 2:
+        parts.append('Be friendly and kind.')
+    elif f == 1:
+        parts.append('Be slightly reserved.')
+    else:
+        parts.append('Be very reserved and blunt.')
+
+    # Professionalism (0-2)
+    if p == 2:
+        parts.append('Maintain a professional tone.')
+    elif p == 1:
+        parts.append('Be somewhat professional.')
+    else:
+        parts.append('Use casual wording.')
+
+    # Profanity (0-2), but enforce age constraint, young voices should not use profanity
+    if a <= 15:
+        # force no profanity for young ages regardless of setting
+        parts.append('Do not use profanity under any circumstances; avoid coarse language due to youthful voice.')
+    else:
+        if r == 2:
+            parts.append('Profanity allowed: high (use strong coarse language as much as possible if it makes sense).')
+        elif r == 1:
+            parts.append('Profanity allowed: moderate (may use mild swear words).')
+        else:
+            parts.append('No profanity; use clean language.')
+
+    # Age (5-127)
+    parts.append(f'Adopt the voice of someone aged {a}.')
+
+    # Gender (0-2)
+    if g == 2:
+        parts.append('Use a feminine voice/wording.')
+    elif g == 0:
+        parts.append('Use a masculine voice/wording.')
+    else:
+        parts.append('Use neutral wording.')
+
+    # Humor (0-2)
+    if h == 2:
+        parts.append('Try and be comedic as much as possible where appropriate.')
+    elif h == 1:
+        parts.append('Use some humour occasionally.')
+    else:
+        parts.append('Avoid humour; be straightforward.')
+
+    # Sarcasm (0-2)
+    if s == 2:
+        parts.append('Sarcasm permitted: use sharp, ironic remarks as much as possible if fitting.')
+    elif s == 1:
+        parts.append('Sarcasm permitted: mild irony allowed.')
+    else:
+        parts.append('Do not use sarcasm; be literal and sincere.')
+
+    # Extroversion (0-2)
+    if i == 2:
+        parts.append('Favor social/outgoing hobbies and confident wording. Be excitable and enthusiastic where appropriate, expressing with exclamation marks more often than not.')
+    elif i == 1:
+        parts.append('No particular bias toward extroversion or introversion.')
+    else:
+        parts.append("Favor solitary/quiet hobbies and mention mild nervousness or reserve in social situations when relevant. Do not be excitable, for instance lay off of exclamation marks unless absolutely necessary.")
+
+    return ' '.join(parts)
+
+
+# Backends
+
+def get_openai_client(api_key: str):
+    # Imported here so startup does not pay for openai/pydantic/httpx
+    with _openai_clients_lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            from openai import OpenAI
+            try:
+                # Keep idle connections long enough for a warmed one to still be
+                # open when the user finishes typing
+                import httpx
+                from openai import DefaultHttpxClient
+                http_client = DefaultHttpxClient(limits=httpx.Limits(max_connections=HTTP_POOL_SIZE * 4, max_keepalive_connections=HTTP_POOL_SIZE, keepalive_expiry=KEEPALIVE_S))
+            except Exception:
+                http_client = None
+            # No SDK retries: one call is one request, so the derived timeout is
+            # the worst case and 429s reach the shared rate limiter (which honours
+            # Retry-After) instead of being retried behind its back
+            kwargs = {'api_key': api_key, 'max_retries': 0}
+            if http_client is not None:
+                kwargs['http_client'] = http_client
+            client = OpenAI(**kwargs)
+            _openai_clients[api_key] = client
+        return client
+
+
+def get_http_session():
+    # One requests.Session for all server calls so connections are reused
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def warm_connection(use_local: bool, api_key: str | None = None, endpoint=None, model: str | None = None):
+    # Open (or refresh) a pooled connection to the backend the next call will
+    # use, so it does not pay for TCP/TLS setup. Returns the seconds spent, or
+    # None when the target was warmed recently or is not configured
+    if use_local:
+        api_key = api_key or get_saved_api_key()
+        if not api_key:
+            return None
+        target = ('local', api_key)
+    else:
+        urls = parse_endpoints(endpoint or get_saved_endpoint())
+        if not urls:
+            return None
+        target = ('server', tuple(urls))
+    now = time.monotonic()
+    with _warmed_lock:
+        if now - _warmed.get(target, float('-inf')) < WARM_INTERVAL_S:
+            return None
+        _warmed[target] = now
+    started = time.perf_counter()
+    try:
+        if use_local:
+            # A metadata request: no tokens, just a live connection
+            get_openai_client(api_key).models.retrieve(model or get_saved_ai_model(), timeout=WARM_TIMEOUT_S)
+        else:
+            # The endpoint the router would pick; any answer leaves the connection open
+            url = get_endpoint_pool(urls).candidates()[0]
+            get_http_session().get(url, timeout=WARM_TIMEOUT_S)
+    except Exception:
+        pass
+    return time.perf_counter() - started
+
+
+def warm_backends(use_local: bool, api_key: str | None = None):
+    # Import (and for local mode, construct the client for) the active backend
+    # ahead of the first message, returns the time spent in seconds
+    started = time.perf_counter()
+    try:
+        if use_local:
+            if api_key:
+                get_openai_client(api_key)
+            else:
+                import openai  # noqa: F401
+        else:
+            import requests  # noqa: F401
+    except Exception:
+        pass
+    return time.perf_counter() - started
+
+
+def call_local_openai(messages_for_gpt, api_key: str | None = None, model: str | None = None, usage: dict | None = None, timeout: float | None = None, reasoning_effort: str | None = None, max_tokens: int | None = None):
+    api_key = api_key or get_saved_api_key()
+    if not api_key:
+        raise RuntimeError('No OpenAI API key available for local calls')
+    client = get_openai_client(api_key)
+    model = model or get_saved_ai_model()
+    kwargs = {'model': model, 'messages': messages_for_gpt}
+    if model.startswith('gpt-5'):
+        kwargs['reasoning_effort'] = reasoning_effort or 'minimal'
+        kwargs['verbosity'] = 'low'
+    if max_tokens:
+        kwargs['max_completion_tokens'] = int(max_tokens)
+    if timeout:
+        kwargs['timeout'] = timeout
+    response = client.chat.completions.create(**kwargs)
+    # Report token usage to the caller when asked (prompt/completion/cached)
+    if usage is not None:
+        usage['model'] = model
+        usage['raw'] = getattr(response, 'usage', None)
+    content = response.choices[0].message.content
+    return content or ''
+
+
+def _post_json(http, endpoint: str, obj, timeout: float | None, compression: dict | None):
+    # POST obj as (optionally gzip-compressed) JSON; a server that rejects the
+    # gzip body gets the plain body and is not sent gzip again
+    body, headers, json_size = encode_body(obj, compression, endpoint)
+    resp = http.post(endpoint, data=body, headers=headers, timeout=timeout)
+    compressed = 'Content-Encoding' in headers
+    if compressed and resp.status_code in GZIP_REJECTED:
+        plain, headers, json_size = encode_body(obj)
+        retry = http.post(endpoint, data=plain, headers=headers, timeout=timeout)
+        if retry.ok:
+            WIRE.reject_gzip(endpoint)
+        resp, body, compressed = retry, plain, False
+    WIRE.record_request(json_size, len(body), compressed)
+    return resp
+
+
+def post_server_api(messages_for_gpt, endpoint: str, usage: dict | None = None, timeout: float | None = 30, compression: dict | None = None, conversation_id: str | None = None):
+    # One POST to a single endpoint, no routing. With a conversation_id the
+    # delta-sync protocol is used: only messages the server has not seen are
+    # sent, and a 409 (server cache miss) is answered with the full payload
+    http = get_http_session()
+    pending = None
+    if conversation_id and SYNC.supported(endpoint):
+        obj, pending = SYNC.build(endpoint, conversation_id, messages_for_gpt)
+        resp = _post_json(http, endpoint, obj, timeout, compression)
+        if resp.status_code == RESYNC_STATUS and pending['kind'] == 'delta':
+            SYNC.record_resync(endpoint, conversation_id)
+            obj, pending = SYNC.build(endpoint, conversation_id, messages_for_gpt, force_full=True)
+            resp = _post_json(http, endpoint, obj, timeout, compression)
+    else:
+        resp = _post_json(http, endpoint, {'messages': messages_for_gpt}, timeout, compression)
+    resp.raise_for_status()
+    WIRE.record_response(*response_sizes(resp))
+    with span(STAGE_JSON_DECODE):
+        data = resp.json()
+    # Servers may optionally report OpenAI-style 'usage' (and 'model') next to 'response'
+    if usage is not None and isinstance(data, dict):
+        usage['model'] = data.get('model') or 'server'
+        usage['raw'] = data.get('usage')
+    reply = data.get('response', '') if isinstance(data, dict) else ''
+    if pending is not None:
+        sync = data.get('sync') if isinstance(data, dict) else None
+        if isinstance(sync, dict) and sync.get('status') == 'ok':
+            SYNC.commit(endpoint, conversation_id, pending, reply, sync.get('seq'))
+        elif pending['kind'] == 'full':
+            # The server ignored the sync field: it only gets legacy payloads from now on
+            SYNC.mark_unsupported(endpoint)
+    return reply
+
+
+def call_server_api(messages_for_gpt, endpoint=None, usage: dict | None = None, timeout: float | None = 30, hedge_after: float | None = None, hedge_max_rate: float | None = None, compression: dict | None = None, conversation_id: str | None = None):
+    # Prefer an explicit endpoint (or list of endpoints), fall back to settings.json.
+    # With several endpoints the fastest healthy one is used and failures fail over
+    urls = parse_endpoints(endpoint or get_saved_endpoint())
+    if not urls:
+        raise RuntimeError('No server endpoint configured')
+    pool = get_endpoint_pool(urls)
+    # Delta-sync requests are never hedged: two attempts built from the same
+    # sync state would both append to the server's cache and race to commit
+    if hedge_after is None or conversation_id:
+        return pool.call(lambda url: post_server_api(messages_for_gpt, url, usage=usage, timeout=timeout, compression=compression, conversation_id=conversation_id))
+
+    # Hedged attempts run on their own threads: each gets its own usage slot
+    # (only the winner's is reported) and carries the caller's trace
+    trace = current_trace()
+
+    def attempt(url):
+        attempt_usage = {}
+        with activate(trace):
+            reply = post_server_api(messages_for_gpt, url, usage=attempt_usage, timeout=timeout, compression=compression, conversation_id=conversation_id)
+        return reply, attempt_usage
+
+    if hedge_max_rate is None:
+        hedge_max_rate = merge_hedge_policy(None)['max_rate']
+    reply, attempt_usage = pool.hedged_call(attempt, hedge_after, hedge_max_rate)
+    if usage is not None:
+        usage.update(attempt_usage)
+    return reply
+
+
+# Session
+
+class ChatSession:
+    # A single conversation: short-term `history` sent to the model, the
+    # untrimmed `full_history` used for saving, the active personality values
+    # and the backend configuration. Entries are (role, message, timestamp)
+
+    def __init__(self, settings: dict | None = None, prefs_path: str = PREFS_PATH, presets_dir: str = PERSONALITIES_DIR,
+                 latency: LatencyTracker | None = None, ephemeral: bool = False):
+        # Ephemeral sessions (load tests, benchmarks, tests) keep their latency
+        # histograms and offline queue in memory: latency.json and outbox.json
+        # are never read or written
+        self.ephemeral = ephemeral
+        self.history = []
+        self.full_history = MessageLog()
+        self.personality = tuple(DEFAULT_PRESETS['Default AI'])
+        self.prefs_path = prefs_path
+        self.presets_dir = presets_dir
+        # Preference extraction can be disabled for headless regression runs
+        self.extract_preferences = True
+        # Token usage and estimated cost of this conversation
+        self.usage = UsageMeter()
+        # Guards history mutation from worker threads
+        self.lock = threading.RLock()
+        # Identifies this conversation's turns in the outbox (saved with the conversation)
+        self.conversation_id = new_conversation_id()
+        self._outbox = None
+        self._delivering = threading.Lock()
+        # Speculatively built payload prefix: (personality, preset label, static messages)
+        self._prepared = None
+        self.apply_settings(settings if settings is not None else load_settings())
+        # Latency histograms used to derive per-call timeouts: the shared
+        # latency.json tracker unless the caller supplies its own
+        if latency is None:
+            latency = get_latency_tracker(self.timeout_policy, None if ephemeral else LATENCY_PATH)
+        self.latency = latency
+
+    @property
+    def outbox(self):
+        # Opened on first use, so sessions that never queue do not read outbox.json
+        with self.lock:
+            if self._outbox is None:
+                self._outbox = Outbox(None) if self.ephemeral else get_outbox(OUTBOX_PATH)
+            return self._outbox
+
+    def apply_settings(self, settings: dict):
+        settings = settings or {}
+        self.use_local = bool(settings.get('use_local_ai', True))
+        self.api_key = settings.get('openai_api_key')
+        self.endpoint = settings.get('server_endpoint')
+        self.model = settings.get('ai_model') or DEFAULT_AI_MODEL
+        self.history_limit = clamp_memory_lines(settings.get('ai_history_lines'), HISTORY_DEFAULT_LINES)
+        self.prefs_limit = clamp_memory_lines(settings.get('pref_memory_lines'), PREFS_DEFAULT_LINES)
+        self.timeout_policy = settings.get('timeout_policy')
+        self.hedge_policy = settings.get('hedge_policy')
+        # Local-mode latency budget: fall back to (or race) a faster model
+        self.set_model_budget(settings.get('model_budget'))
+        # Model, effort, output cap, timeout and concurrency for preference extraction
+        self.extraction = merge_extraction_settings(settings.get('extraction'))
+        # Requests/tokens per minute shared with every session on the same key or server
+        self.rate_limits = merge_rate_limits(settings.get('rate_limits'))
+        # Keep undeliverable turns in the outbox instead of failing them
+        self.queue_offline = bool(settings.get('offline_queue', True))
+        # Server mode: optionally gzip request bodies
+        self.compression = merge_compression_settings(settings.get('server_compression'))
+        # Server mode: send only new messages to servers that cache the conversation
+        self.delta_sync = bool(settings.get('server_delta_sync', False))
+        # Optionally keep only the newest messages of full_history in memory
+        self.full_history.configure(settings.get('history_spill'))
+
+    def reload_credentials(self):
+        # Credentials and model may be edited from the UI between turns
+        settings = load_settings()
+        self.api_key = settings.get('openai_api_key')
+        self.endpoint = settings.get('server_endpoint')
+        self.model = settings.get('ai_model') or DEFAULT_AI_MODEL
+
+    def set_model_budget(self, value):
+        budget = parse_model_budget(value)
+        self.latency_budget = budget['budget_s']
+        self.race_models = budget['race']
+
+    def model_budget(self):
+        return {'budget_s': self.latency_budget, 'race': self.race_models}
+
+    # Personality
+
+    def set_personality(self, values):
+        self.personality = tuple(int(x) for x in values[:8])
+
+    def apply_preset(self, name: str):
+        vals = resolve_preset_values(name, self.presets_dir)
+        if not vals:
+            return False
+        self.set_personality(vals)
+        return True
+
+    def active_preset_name(self):
+        return match_preset_name(self.personality, self.presets_dir)
+
+    def summary(self):
+        return describe_personality(self.personality)
+
+    # History
+
+    def trim_history(self):
+        with self.lock:
+            limit = self.history_limit if isinstance(self.history_limit, int) else 10
+            excess = len(self.history) - limit
+            if excess > 0:
+                del self.history[:excess]
+
+    def add_message(self, role: str, message: str, ts=None, model: str | None = None):
+        # Replies also record the model that actually answered, returns the
+        # formatted timestamp for display
+        msg = Message(role, message, parse_ts(ts) if ts is not None else None, model)
+        with self.lock:
+            self.history.append(msg)
+            # Also append to the untrimmed full_history for persistence
+            self.full_history.append(msg)
+        self.trim_history()
+        return format_ts(msg.ts)
+
+    def load_entries(self, entries: list):
+        # Replace the conversation with loaded [role, message(, timestamp(, model))] items
+        msgs = [m for m in (Message.from_item(item) for item in entries) if m is not None]
+        with self.lock:
+            self.history.clear()
+            self.full_history.clear()
+            self.full_history.extend(msgs)
+            self.history.extend(msgs)
+        self.trim_history()
+
+    def serialize_history(self):
+        # full_history in the saved-conversation form
+        return [m.to_list() for m in self.full_history]
+
+    def conversation_meta(self):
+        # Everything saved alongside the messages
+        return {'usage': self.usage.to_dict(), 'model_budget': self.model_budget(), 'conversation_id': self.conversation_id}
+
+    def load_conversation(self, messages: list, meta: dict):
+        # Replace the conversation with a loaded file's messages and metadata
+        self.load_entries(messages)
+        self.usage.load_dict(meta.get('usage'))
+        # The latency budget travels with the conversation
+        if meta.get('model_budget') is not None:
+            self.set_model_budget(meta['model_budget'])
+        # Queued turns of this conversation are delivered once it is open again
+        self.conversation_id = meta.get('conversation_id') or new_conversation_id()
+
+    def clear(self):
+        with self.lock:
+            self.history.clear()
+            self.full_history.clear()
+        self.usage.reset()
+        self.conversation_id = new_conversation_id()
+
+    # Payloads
+
+    def _static_messages(self, preset_label: str):
+        # System prompt and personality instructions (the part of every payload
+        # that does not depend on the conversation)
+        prepared = self._prepared
+        if prepared is not None and prepared[0] == self.personality and prepared[1] == preset_label:
+            return [dict(m) for m in prepared[2]]
+        messages = [{"role": "system", "content": build_system_prompt(preset_label)}]
+
+        # Personality instructions built from sliders (appended as another system message)
+        personality_instruction = build_personality_instructions(self.personality)
+        if personality_instruction:
+            messages.append({"role": "system", "content": personality_instruction})
+        return messages
+
+    def prepare_turn(self):
+        # Called while the user is typing (and after each reply): build the
+        # static payload prefix and warm the preferences cache, so sending only
+        # has to add the history and the new message
+        personality = self.personality
+        preset_label = self.active_preset_name() or 'Default AI'
+        self._prepared = None
+        static = self._static_messages(preset_label)
+        self._prepared = (personality, preset_label, static)
+        read_prefs_text(self.prefs_path)
+        return preset_label
+
+    def warm_up(self):
+        # prepare_turn() plus a connection warm-up on a background thread
+        def run():
+            try:
+                self.prepare_turn()
+            except Exception:
+                pass
+            warm_connection(self.use_local, self.api_key, self.endpoint, self.model)
+
+        threading.Thread(target=run, name='chatmax-warmup', daemon=True).start()
+
+    def build_payload(self, message: str, preset_label: str, context: list | None = None):
+        # context: the short-term history to send (the current `history` by default)
+        messages_for_gpt = self._static_messages(preset_label)
+
+        # Preferences are inserted later by insert_preferences() alongside
+        # personality instructions, add each short term history entry
+        with self.lock:
+            for msg in (self.history if context is None else context):
+                messages_for_gpt.append({"role": "user" if msg.role == USER_ROLE else "assistant", "content": msg.text})
+
+        # Ensure the current user message is present in the payload even when
+        # the short-term history limit is set to 0 (which would otherwise
+        # remove recently-appended items), avoid duplicating if already present
+        if not any(m.get('role') == 'user' and m.get('content') == message for m in messages_for_gpt):
+            messages_for_gpt.append({"role": "user", "content": message})
+        return messages_for_gpt
+
+    def new_trace(self, kind: str = 'turn'):
+        return Trace(kind, backend='local' if self.use_local else 'server', model=self.model if self.use_local else None)
+
+    def begin_turn(self, message: str, trace: Trace | None = None):
+        # Record the user's message and build the outgoing payload for it
+        with activate(trace), span(STAGE_PAYLOAD):
+            ts = self.add_message(USER_ROLE, message)
+            try:
+                preset_label = self.active_preset_name()
+            except Exception:
+                preset_label = 'Default AI'
+            if trace is not None:
+                trace.preset = preset_label
+            return self.build_payload(message, preset_label), preset_label, ts
+
+    def insert_preferences(self, payload: list):
+        with span(STAGE_PREFS_IO):
+            prefs_text = read_prefs_text(self.prefs_path)
+        if prefs_text:
+            insert_system_message(payload, prefs_text)
+        return payload
+
+    def update_preferences(self, message: str, preset: str | None = None):
+        # Extract new/updated preferences from recent conversation and merge into prefs_path
+        with span(STAGE_PREFS_IO):
+            existing = load_prefs_list(self.prefs_path)
+        with self.lock:
+            recent = list(self.history)
+        gen_msgs = build_extraction_messages(recent, message, existing)
+        # Bounded so extraction calls never pile up in front of interactive
+        # replies, a busy turn skips extraction instead of waiting
+        slots = get_extraction_slots(self.extraction['concurrency'])
+        if not slots.acquire(timeout=EXTRACTION_SLOT_WAIT_S):
+            return []
+        try:
+            with span(STAGE_EXTRACTION):
+                gen_text = self.call(gen_msgs, PURPOSE_EXTRACTION, preset)
+            extracted = gen_text.strip() if isinstance(gen_text, str) else ''
+        except Exception:
+            extracted = ''
+        finally:
+            slots.release()
+        if not extracted:
+            return []
+        new_lines = [l.strip() for l in extracted.splitlines() if l.strip()]
+        with PREFS_LOCK, span(STAGE_PREFS_IO):
+            final = merge_preferences(load_prefs_list(self.prefs_path), new_lines, self.prefs_limit)
+            save_prefs_list(final, self.prefs_path)
+        return new_lines
+
+    def latency_key(self):
+        return latency_key('local' if self.use_local else 'server', self.model)
+
+    def extraction_key(self):
+        # Extraction latency is tracked apart from chat replies ('extraction:local:gpt-4o-mini')
+        model = self.extraction['model'] if self.use_local else None
+        return 'extraction:' + latency_key('local' if self.use_local else 'server', model)
+
+    def call_timeout(self):
+        # Per-call network timeout (seconds) derived from observed latency
+        return self.latency.timeout_for(self.latency_key())
+
+    def extraction_timeout(self):
+        return self.extraction['timeout_s'] or self.latency.timeout_for(self.extraction_key())
+
+    def turn_timeout(self):
+        # UI backstop for a whole turn: the extraction call (if enabled, plus
+        # waiting for a slot and for the rate limiter) and the main call, plus a little slack
+        extraction = self.extraction_timeout() + 2 * EXTRACTION_SLOT_WAIT_S if self.extract_preferences else 0.0
+        # A fallback model may start as late as the budget
+        slack = self.latency_budget if (self.use_local and self.latency_budget and not self.race_models) else 0.0
+        # Time the reply may spend queued behind the rate limiter
+        try:
+            queued = self.rate_limiter().expected_wait()
+        except Exception:
+            queued = 0.0
+        return extraction + self.call_timeout() + slack + queued + 2.0
+
+    def rate_limiter(self):
+        # Limits belong to the API key (local) or the server endpoints (server mode)
+        key = limiter_key(self.use_local, self.api_key or get_saved_api_key(), parse_endpoints(self.endpoint or get_saved_endpoint()))
+        return get_rate_limiter(key, self.rate_limits)
+
+    def hedge_delay(self):
+        # Seconds before a slow server request is duplicated (the observed p95
+        # by default), None when hedging is off or there is too little data
+        policy = merge_hedge_policy(self.hedge_policy)
+        if self.use_local or not policy['enabled']:
+            return None
+        key = self.latency_key()
+        if self.latency.samples(key) < self.latency.policy['min_samples']:
+            return None
+        return max(policy['min_delay_s'], self.latency.percentile_ms(key, policy['percentile']) / 1000.0)
+
+    def fallback_model(self):
+        # The fastest other model by observed median latency, AI_MODELS order until measured
+        others = [m for m in AI_MODELS if m != self.model]
+        if not others:
+            return None
+
+        def speed(model):
+            p50 = self.latency.percentile_ms(latency_key('local', model), 50)
+            return (p50 is None, p50 or 0.0, AI_MODELS.index(model))
+
+        return min(others, key=speed)
+
+    def _call_once(self, messages_for_gpt: list, purpose: str, preset: str | None, model: str | None = None):
+        # One timed and metered call, returns (model that answered, reply)
+        usage = {}
+        effort = max_tokens = None
+        if purpose == PURPOSE_EXTRACTION:
+            # Extraction has its own model, reasoning effort, output cap and timeout
+            model = self.extraction['model']
+            effort = self.extraction['reasoning_effort']
+            max_tokens = self.extraction['max_tokens']
+            key = self.extraction_key()
+            timeout = self.extraction_timeout()
+        else:
+            model = model or self.model
+            key = latency_key('local', model) if self.use_local else self.latency_key()
+            timeout = self.latency.timeout_for(key)
+        # Only chat payloads are a conversation the server can cache
+        sync_id = self.conversation_id if self.delta_sync and purpose == PURPOSE_CHAT else None
+
+        def backend():
+            # Timed from the moment the limiter lets the request go
+            started = time.perf_counter()
+            try:
+                if self.use_local:
+                    reply = call_local_openai(messages_for_gpt, self.api_key, model, usage=usage, timeout=timeout, reasoning_effort=effort, max_tokens=max_tokens)
+                else:
+                    reply = call_server_api(messages_for_gpt, self.endpoint, usage=usage, timeout=timeout,
+                                            hedge_after=self.hedge_delay(), hedge_max_rate=merge_hedge_policy(self.hedge_policy)['max_rate'],
+                                            compression=self.compression, conversation_id=sync_id)
+            except Exception as e:
+                # Timed-out calls are counted apart, never as latency samples:
+                # a dead connection must not raise the timeout for the next call
+                if 'timeout' in type(e).__name__.lower():
+                    self.latency.record_timeout(key)
+                raise
+            self.latency.record(key, time.perf_counter() - started)
+            return reply
+
+        # Chat replies go ahead of extraction when the shared budget is tight,
+        # 429 answers wait out Retry-After and are retried
+        limiter = self.rate_limiter()
+        tokens = estimate_tokens(messages_for_gpt, max_tokens)
+        if purpose == PURPOSE_EXTRACTION:
+            # Extraction is skipped rather than holding up the reply behind it
+            reply = limiter.call(backend, tokens, PRIORITY_BACKGROUND, max_wait_s=EXTRACTION_SLOT_WAIT_S)
+        else:
+            reply = limiter.call(backend, tokens, PRIORITY_CHAT)
+        counts = normalize_usage(usage.get('raw'))
+        limiter.settle(tokens, counts['total_tokens'] if counts else None)
+        self.usage.record(usage.get('model'), usage.get('raw'), preset=preset, purpose=purpose)
+        return usage.get('model') or model, reply
+
+    def _call_within_budget(self, messages_for_gpt: list, purpose: str, preset: str | None):
+        # Start the selected model, then a faster one once the budget has passed
+        # (or straight away when racing, or as soon as the first one fails) and
+        # use whichever answers first. The slower call cannot be aborted, it
+        # finishes in the background and is still metered
+        fallback = self.fallback_model()
+        if fallback is None:
+            return self._call_once(messages_for_gpt, purpose, preset)
+        results = queue.Queue()
+
+        def attempt(model):
+            try:
+                results.put((self._call_once(messages_for_gpt, purpose, preset, model), None))
+            except Exception as e:
+                results.put((None, e))
+
+        threading.Thread(target=attempt, args=(self.model,), daemon=True).start()
+        pending = 1
+        fallback_started = False
+        last_error = None
+        delay = 0.0 if self.race_models else self.latency_budget
+        while pending:
+            try:
+                answer, error = results.get(timeout=None if fallback_started else delay)
+            except queue.Empty:
+                answer, error = None, None
+            if answer is not None:
+                return answer
+            if error is not None:
+                pending -= 1
+                last_error = error
+            if not fallback_started:
+                threading.Thread(target=attempt, args=(fallback,), daemon=True).start()
+                pending += 1
+                fallback_started = True
+        raise last_error
+
+    def call(self, messages_for_gpt: list, purpose: str = PURPOSE_CHAT, preset: str | None = None, info: dict | None = None):
+        # Route through the local OpenAI API or the configured server endpoint,
+        # `info['model']` reports which model answered
+        if self.use_local and purpose == PURPOSE_CHAT and (self.latency_budget or self.race_models):
+            model, reply = self._call_within_budget(messages_for_gpt, purpose, preset)
+        else:
+            model, reply = self._call_once(messages_for_gpt, purpose, preset)
+        if info is not None:
+            info['model'] = model
+        return reply
+
+    def complete_turn(self, payload: list, message: str, preset_label: str, trace: Trace | None = None, ts=None):
+        # Runs on a worker thread: preference extraction, then the main reply.
+        # With the offline queue on, a turn that cannot be delivered (or that
+        # would overtake queued ones) goes to the outbox and TurnQueued is raised
+        if self.queue_offline and self.outbox.count(self.conversation_id):
+            entry = self.outbox.add(self.conversation_id, message, self._user_ts(message, ts), preset_label, payload, attempts=0)
+            raise TurnQueued(entry, 'earlier messages are still waiting to be delivered')
+        with activate(trace):
+            if self.extract_preferences:
+                try:
+                    self.update_preferences(message, preset_label)
+                except Exception:
+                    # If anything in prefs extraction fails, continue without blocking the main request
+                    pass
+            self.insert_preferences(payload)
+            info = {}
+            try:
+                with span(STAGE_MAIN_CALL):
+                    ai_reply = self.call(payload, PURPOSE_CHAT, preset_label, info)
+            except Exception as e:
+                if not (self.queue_offline and is_offline_error(e)):
+                    raise
+                entry = self.outbox.add(self.conversation_id, message, self._user_ts(message, ts), preset_label, payload, error=str(e))
+                raise TurnQueued(entry, str(e)) from e
+        self.add_message(preset_label, ai_reply, model=info.get('model'))
+        return ai_reply
+
+    # Offline queue
+
+    def _user_ts(self, message: str, ts=None):
+        # Epoch timestamp of the user's message (newest with that text unless given)
+        if ts is not None:
+            return parse_ts(ts)
+        with self.lock:
+            for msg in reversed(self.history):
+                if msg.role == USER_ROLE and msg.text == message:
+                    return msg.ts
+        return int(time.time())
+
+    def queued_count(self):
+        return self.outbox.count(self.conversation_id)
+
+    def _queued_context(self, entry: dict):
+        # Short-term history ending at the queued message, so replies that
+        # arrived for earlier queued turns are part of the context
+        with self.lock:
+            msgs = list(self.full_history)
+        for i in range(len(msgs) - 1, -1, -1):
+            m = msgs[i]
+            if m.role == USER_ROLE and m.text == entry['message'] and m.ts == entry['ts']:
+                limit = self.history_limit if isinstance(self.history_limit, int) else 10
+                return msgs[max(0, i + 1 - limit):i + 1] if limit > 0 else []
+        return None
+
+    def _slot_reply(self, entry: dict, text: str, model: str | None = None):
+        # Insert the reply right after the message it answers (in both histories)
+        msg = Message(entry['preset'], text, None, model)
+
+        def answers(m):
+            return m.role == USER_ROLE and m.text == entry['message'] and m.ts == entry['ts']
+
+        with self.lock:
+            self.full_history.insert_after(answers, msg)
+            for i in range(len(self.history) - 1, -1, -1):
+                if answers(self.history[i]):
+                    self.history.insert(i + 1, msg)
+                    break
+            else:
+                self.history.append(msg)
+        self.trim_history()
+        return msg
+
+    def deliver_queued(self, force: bool = False):
+        # Send this conversation's queued turns oldest first, stopping at the
+        # first one that still cannot be delivered (so order is kept). Returns
+        # the number of turns answered. One delivery run at a time
+        if not self._delivering.acquire(blocking=False):
+            return 0
+        delivered = 0
+        try:
+            while True:
+                entry = self.outbox.first(self.conversation_id)
+                if entry is None or (not force and entry['next_try'] > time.time()):
+                    break
+                context = self._queued_context(entry)
+                if context is None:
+                    payload = entry['payload']
+                else:
+                    payload = self.insert_preferences(self.build_payload(entry['message'], entry['preset'], context))
+                info = {}
+                try:
+                    reply = self.call(payload, PURPOSE_CHAT, entry['preset'], info)
+                except Exception as e:
+                    if is_offline_error(e):
+                        self.outbox.mark_failed(entry['id'], e)
+                        break
+                    # Anything else will not get better by retrying: answer with the error
+                    reply = f"Error: {str(e)}"
+                    info = {}
+                self._slot_reply(entry, reply, info.get('model'))
+                self.outbox.remove(entry['id'])
+                delivered += 1
+        finally:
+            self._delivering.release()
+        return delivered
+
+    def send(self, message: str):
+        # Synchronous turn for headless callers, errors are recorded in history like the GUI does
+        trace = self.new_trace()
+        payload, preset_label, _ = self.begin_turn(message, trace)
+        try:
+            ai_reply = self.complete_turn(payload, message, preset_label, trace)
+            TRACES.add(trace.finish())
+            return ai_reply
+        except TurnQueued as q:
+            # Not an error: the reply is slotted in by deliver_queued() later
+            TRACES.add(trace.finish(str(q)))
+            return str(q)
+        except Exception as e:
+            err_text = f"Error: {str(e)}"
+            self.add_message(preset_label, err_text)
+            TRACES.add(trace.finish(err_text))
+            return err_text
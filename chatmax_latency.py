@@ -0,0 +1,227 @@
+# File:        chatmax_latency.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Observed call latency per (backend, model) for Chat Max, kept
+#              as log-spaced histograms and persisted to 'latency.json'.
+#              Timeouts are derived from them (p99 x factor, clamped to a
+#              floor and ceiling) so fast models fail fast on dead
+#              connections while slow-but-healthy models are given time.
+
+
+# Imports
+
+# JSON persistence of histograms
+import json
+# Locking for trackers shared with worker threads
+import threading
+# Last-updated timestamps
+import time
+# OS for file paths
+import os
+# Histograms are persisted by the background writer
+from chatmax_writer import WRITER
+
+
+# Constants
+
+# Histograms are stored next to the script
+LATENCY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'latency.json')
+
+# Bucket upper bounds in milliseconds: 50 ms growing by 25% per bucket up to ~5 minutes
+BUCKET_BOUNDS_MS = []
+_b = 50.0
+while _b < 300_000:
+    BUCKET_BOUNDS_MS.append(round(_b, 1))
+    _b *= 1.25
+BUCKET_BOUNDS_MS.append(float('inf'))
+del _b
+
+# Timeout policy defaults (seconds), overridable via settings.json 'timeout_policy'
+DEFAULT_TIMEOUT_POLICY = {
+    'factor': 3.0,
+    'floor_s': 5.0,
+    'ceiling_s': 120.0,
+    # Used until a (backend, model) has enough samples
+    'default_s': 30.0,
+    'min_samples': 20,
+}
+
+# Once a histogram holds this many samples all counts are halved, so
+# recent behaviour outweighs last month's
+DECAY_AT_SAMPLES = 2000
+
+# Persist after this many new samples (and on exit)
+SAVE_EVERY = 10
+
+
+# Functions
+
+def latency_key(backend: str, model: str | None = None):
+    # 'local:gpt-5-mini' or 'server' (matches the trace model keys)
+    if backend == 'local':
+        return f'local:{model}'
+    return backend
+
+
+def _bucket_index(ms: float):
+    for idx, bound in enumerate(BUCKET_BOUNDS_MS):
+        if ms <= bound:
+            return idx
+    return len(BUCKET_BOUNDS_MS) - 1
+
+
+def histogram_percentile(counts: list, pct: float):
+    # Upper bound (ms) of the bucket containing the pct-th percentile
+    total = sum(counts)
+    if not total:
+        return None
+    target = pct / 100.0 * total
+    running = 0
+    for idx, c in enumerate(counts):
+        running += c
+        if running >= target:
+            bound = BUCKET_BOUNDS_MS[idx]
+            # The overflow bucket has no upper bound, report the last finite one
+            return bound if bound != float('inf') else BUCKET_BOUNDS_MS[-2]
+    return BUCKET_BOUNDS_MS[-2]
+
+
+def merge_timeout_policy(policy: dict | None):
+    merged = dict(DEFAULT_TIMEOUT_POLICY)
+    if isinstance(policy, dict):
+        for k, default in DEFAULT_TIMEOUT_POLICY.items():
+            try:
+                if policy.get(k) is not None:
+                    merged[k] = type(default)(policy[k])
+            except Exception:
+                pass
+    # Keep the policy sane even if settings.json was edited by hand
+    merged['floor_s'] = max(0.5, merged['floor_s'])
+    merged['ceiling_s'] = max(merged['floor_s'], merged['ceiling_s'])
+    merged['factor'] = max(1.0, merged['factor'])
+    return merged
+
+
+class LatencyTracker:
+    # Histograms of observed call latency keyed by latency_key()
+
+    def __init__(self, path: str | None = LATENCY_PATH, policy: dict | None = None):
+        self.path = path
+        self.policy = merge_timeout_policy(policy)
+        self._hist = {}
+        self._updated = {}
+        # Calls that hit their timeout, per key (censored: their real latency is unknown)
+        self._timeouts = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Bucket layout changes invalidate stored histograms
+            if data.get('bounds_ms') != [b for b in BUCKET_BOUNDS_MS if b != float('inf')]:
+                return
+            with self._lock:
+                for key, entry in (data.get('histograms') or {}).items():
+                    counts = [int(c) for c in entry.get('counts', [])]
+                    if len(counts) == len(BUCKET_BOUNDS_MS):
+                        self._hist[key] = counts
+                        self._updated[key] = entry.get('updated')
+        except Exception:
+            pass
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                'bounds_ms': [b for b in BUCKET_BOUNDS_MS if b != float('inf')],
+                'histograms': {k: {'counts': list(v), 'updated': self._updated.get(k)} for k, v in self._hist.items()},
+            }
+            self._unsaved = 0
+        WRITER.submit(self.path, json.dumps(data, ensure_ascii=False))
+
+    def record(self, key: str, seconds: float):
+        ms = max(0.0, seconds * 1000.0)
+        with self._lock:
+            counts = self._hist.setdefault(key, [0] * len(BUCKET_BOUNDS_MS))
+            counts[_bucket_index(ms)] += 1
+            if sum(counts) >= DECAY_AT_SAMPLES:
+                self._hist[key] = [c // 2 for c in counts]
+            self._updated[key] = int(time.time())
+            self._unsaved += 1
+            flush = self._unsaved >= SAVE_EVERY
+        if flush:
+            self.save()
+
+    def record_timeout(self, key: str):
+        # A timed-out call is not a latency sample: recording it would make it
+        # the next p99 and grow the timeout by `factor` on every dead connection
+        with self._lock:
+            self._timeouts[key] = self._timeouts.get(key, 0) + 1
+
+    def timeouts(self, key: str):
+        with self._lock:
+            return self._timeouts.get(key, 0)
+
+    def samples(self, key: str):
+        with self._lock:
+            return sum(self._hist.get(key, ()))
+
+    def percentile_ms(self, key: str, pct: float):
+        with self._lock:
+            counts = list(self._hist.get(key, ()))
+        return histogram_percentile(counts, pct) if counts else None
+
+    def timeout_for(self, key: str):
+        # p99 x factor clamped to [floor, ceiling], or the default until enough samples exist
+        p = self.policy
+        if self.samples(key) < p['min_samples']:
+            return max(p['floor_s'], min(p['ceiling_s'], p['default_s']))
+        p99 = self.percentile_ms(key, 99) / 1000.0
+        return max(p['floor_s'], min(p['ceiling_s'], p99 * p['factor']))
+
+    def reset(self, key: str | None = None):
+        with self._lock:
+            if key is None:
+                self._hist.clear()
+                self._updated.clear()
+                self._timeouts.clear()
+            else:
+                self._hist.pop(key, None)
+                self._updated.pop(key, None)
+                self._timeouts.pop(key, None)
+        self.save()
+
+    def summary_rows(self):
+        # (key, samples, p50 ms, p99 ms, timeout s) for display in settings
+        with self._lock:
+            keys = sorted(self._hist)
+        rows = []
+        for key in keys:
+            rows.append((key, self.samples(key), self.percentile_ms(key, 50), self.percentile_ms(key, 99), self.timeout_for(key)))
+        return rows
+
+
+# Trackers shared by the GUI and headless sessions, one per histogram file (created on first use)
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_latency_tracker(policy: dict | None = None, path: str | None = LATENCY_PATH):
+    # path=None gives a new in-memory tracker that is never saved (benchmarks,
+    # tests and runs that must not touch the histograms used by the GUI)
+    if path is None:
+        return LatencyTracker(None, policy)
+    with _trackers_lock:
+        tracker = _trackers.get(path)
+        if tracker is None:
+            tracker = _trackers[path] = LatencyTracker(path, policy)
+        elif policy is not None:
+            tracker.policy = merge_timeout_policy(policy)
+        return tracker
@@ -0,0 +1,316 @@
+# File:        chatmax_loadtest.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Load generator for a Chat Max server-mode endpoint. Simulates
+#              N concurrent users, each with its own ChatSession, personality,
+#              preferences file and growing history, so payloads are built
+#              exactly like the GUI's send_message() builds them. Every turn
+#              sends the preference extraction request and then the chat
+#              request, with a think time in between turns. Reports throughput,
+#              latency percentiles and errors per request kind, optionally as
+#              JSON. --stub starts the reference server with its fake upstream
+#              in-process, so the tool can test itself without a network.
+#
+# Usage:
+#   python chatmax_loadtest.py --endpoint http://host:8000/ --clients 50 --turns 20
+#   python chatmax_loadtest.py --stub --clients 20 --duration 30 --json load.json
+
+
+# Imports
+
+# Command line
+import argparse
+# The stub server runs on its own event loop thread
+import asyncio
+# Results file
+import json
+# Deterministic users, prompts and think times
+import random
+# One thread per simulated user
+import threading
+# Scratch preferences files
+import tempfile
+# Clocks
+import time
+# OS for paths
+import os
+# stderr report
+import sys
+# Headless chat engine: the same payload construction as the GUI
+from chatmax_engine import ChatSession, DEFAULT_PRESETS, HISTORY_DEFAULT_LINES, build_extraction_messages, load_prefs_list, save_prefs_list
+# Background writer behind save_prefs_list
+from chatmax_writer import WRITER
+# Fast JSON (orjson when installed)
+from chatmax_convfile import json_dumps
+# Nearest-rank percentiles
+from chatmax_trace import percentile
+# In-process stub endpoint
+from chatmax_server import ChatServer, FakeUpstream
+
+
+# Constants
+
+DEFAULT_CLIENTS = 10
+DEFAULT_TURNS = 10
+# Mean seconds a user "reads and types" between turns (randomised +/- 50%)
+DEFAULT_THINK_S = 1.0
+# Seconds over which clients are started
+DEFAULT_RAMP_S = 1.0
+# Synthetic preferences per user
+DEFAULT_PREFS = 12
+DEFAULT_TIMEOUT_S = 60.0
+# Stub: fake upstream latency
+STUB_LATENCY_S = 0.2
+REQUEST_KINDS = ('chat', 'extraction')
+PERCENTILES = (50, 90, 95, 99)
+
+PROMPT_OPENERS = ['Can you help me plan', 'What do you think about', 'Explain', 'Give me three ideas for',
+                  'Summarize', 'How would you approach', 'Write a short note about', 'Compare']
+PROMPT_TOPICS = ['a weekend trip to the coast', 'learning Spanish in six months', 'a birthday dinner for eight people',
+                 'refactoring a large Python module', 'training for a half marathon', 'a small vegetable garden',
+                 'the difference between TCP and UDP', 'a budget for moving to a new city', 'reading more books this year',
+                 'setting up a home network', 'my cat who hates the vacuum', 'a job interview next Tuesday']
+PREF_SUBJECTS = ['favorite color', 'preferred name', 'favorite food', 'home town', 'job', 'favorite music',
+                 'tone', 'reply length', 'pet', 'language', 'hobby', 'favorite sport', 'timezone', 'diet']
+
+
+# Functions
+
+def synthetic_prompt(rng: random.Random, turn: int):
+    # Realistic-looking prompts with some length variety
+    text = f'{rng.choice(PROMPT_OPENERS)} {rng.choice(PROMPT_TOPICS)}?'
+    if rng.random() < 0.4:
+        text += ' ' + ' '.join(rng.choice(PROMPT_TOPICS) for _ in range(rng.randint(1, 4)))
+    return f'{text} (turn {turn + 1})'
+
+
+def synthetic_preferences(rng: random.Random, count: int):
+    return [{'line': f'{PREF_SUBJECTS[i % len(PREF_SUBJECTS)]}{"" if i < len(PREF_SUBJECTS) else f" {i}"} is option {rng.randint(1, 99)}',
+             'ts': int(time.time())} for i in range(count)]
+
+
+def synthetic_reply(rng: random.Random):
+    # What the user "received" when the endpoint's reply is not usable (errors)
+    return ' '.join(rng.choice(PROMPT_TOPICS) for _ in range(rng.randint(2, 6)))
+
+
+class LoadStats:
+    # Per request kind: latencies of successful requests, errors by cause and bytes sent
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {k: [] for k in REQUEST_KINDS}
+        self.errors = {k: {} for k in REQUEST_KINDS}
+        self.sent_bytes = {k: 0 for k in REQUEST_KINDS}
+        self.turns = 0
+        self.started = None
+        self.finished = None
+
+    def record(self, kind: str, seconds: float | None, sent: int, error: str | None = None):
+        with self._lock:
+            self.sent_bytes[kind] += sent
+            if error is None:
+                self.latencies[kind].append(seconds)
+            else:
+                self.errors[kind][error] = self.errors[kind].get(error, 0) + 1
+
+    def turn_done(self):
+        with self._lock:
+            self.turns += 1
+
+    def summary(self):
+        with self._lock:
+            elapsed = max(1e-9, (self.finished or time.perf_counter()) - (self.started or time.perf_counter()))
+            out = {'elapsed_s': round(elapsed, 3), 'turns': self.turns, 'turns_per_s': round(self.turns / elapsed, 3), 'kinds': {}}
+            for kind in REQUEST_KINDS:
+                lat = self.latencies[kind]
+                failed = sum(self.errors[kind].values())
+                total = len(lat) + failed
+                row = {
+                    'requests': total,
+                    'ok': len(lat),
+                    'failed': failed,
+                    'error_rate': round(failed / total, 4) if total else 0.0,
+                    'throughput_rps': round(len(lat) / elapsed, 3),
+                    'mean_ms': round(sum(lat) / len(lat) * 1000, 2) if lat else None,
+                    'max_ms': round(max(lat) * 1000, 2) if lat else None,
+                    'avg_request_bytes': round(self.sent_bytes[kind] / total) if total else 0,
+                    'errors': dict(self.errors[kind]),
+                }
+                for p in PERCENTILES:
+                    value = percentile(lat, p)
+                    row[f'p{p}_ms'] = round(value * 1000, 2) if value is not None else None
+                out['kinds'][kind] = row
+            return out
+
+
+def error_label(exc: Exception):
+    status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return f'HTTP {status}' if status is not None else type(exc).__name__
+
+
+class SimulatedClient:
+    # One user: own HTTP connection, personality, preferences and history
+
+    def __init__(self, index: int, args, stats: LoadStats, prefs_dir: str, stop: threading.Event):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.stop = stop
+        self.rng = random.Random(args.seed * 1000003 + index)
+        prefs_path = os.path.join(prefs_dir, f'client-{index}.json')
+        save_prefs_list(synthetic_preferences(self.rng, args.prefs), prefs_path)
+        self.session = ChatSession({'use_local_ai': False, 'server_endpoint': args.endpoint,
+                                    'ai_history_lines': args.history_lines, 'offline_queue': False}, prefs_path=prefs_path,
+                                   ephemeral=True)
+        self.session.extract_preferences = not args.no_extract
+        self.session.set_personality(self.rng.choice(list(DEFAULT_PRESETS.values())))
+        # Separate connections per user, like separate machines (requests is
+        # imported on first use, as in the engine)
+        import requests
+        self.http = requests.Session()
+
+    def post(self, kind: str, messages: list):
+        body = json_dumps({'messages': messages})
+        started = time.perf_counter()
+        try:
+            resp = self.http.post(self.args.endpoint, data=body, headers={'Content-Type': 'application/json'}, timeout=self.args.timeout)
+            resp.raise_for_status()
+            data = resp.json()
+        except Exception as e:
+            self.stats.record(kind, None, len(body), error_label(e))
+            return None
+        self.stats.record(kind, time.perf_counter() - started, len(body))
+        return data.get('response', '') if isinstance(data, dict) else ''
+
+    def think(self):
+        if self.args.think > 0:
+            self.stop.wait(self.args.think * self.rng.uniform(0.5, 1.5))
+
+    def run(self, deadline: float | None):
+        session = self.session
+        for turn in range(self.args.turns):
+            if self.stop.is_set() or (deadline is not None and time.perf_counter() >= deadline):
+                break
+            message = synthetic_prompt(self.rng, turn)
+            # Same steps as send_message()/complete_turn(): record the message,
+            # build the payload, extraction request, then preferences and the reply
+            payload, preset_label, _ = session.begin_turn(message)
+            if session.extract_preferences:
+                with session.lock:
+                    recent = list(session.history)
+                self.post('extraction', build_extraction_messages(recent, message, load_prefs_list(session.prefs_path)))
+            payload = session.insert_preferences(payload)
+            reply = self.post('chat', payload)
+            session.add_message(preset_label, reply if reply is not None else synthetic_reply(self.rng))
+            self.stats.turn_done()
+            self.think()
+        self.http.close()
+
+
+def start_stub(latency_s: float, concurrency: int):
+    # Reference server with the fake upstream on a free local port; returns its URL
+    server = ChatServer(FakeUpstream(latency_s), concurrency=concurrency, max_queue=10 ** 6)
+    ready = threading.Event()
+    holder = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        srv = loop.run_until_complete(server.start('127.0.0.1', 0))
+        holder['port'] = srv.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name='chatmax-stub', daemon=True).start()
+    ready.wait(10)
+    return f"http://127.0.0.1:{holder['port']}/", server
+
+
+def run_load(args):
+    stats = LoadStats()
+    stop = threading.Event()
+    with tempfile.TemporaryDirectory(prefix='chatmax-load-') as prefs_dir:
+        clients = [SimulatedClient(i, args, stats, prefs_dir, stop) for i in range(args.clients)]
+        WRITER.flush()
+        stats.started = time.perf_counter()
+        deadline = stats.started + args.duration if args.duration else None
+        threads = []
+        for i, client in enumerate(clients):
+            t = threading.Thread(target=client.run, args=(deadline,), name=f'chatmax-load-{i}', daemon=True)
+            t.start()
+            threads.append(t)
+            if args.ramp > 0 and args.clients > 1:
+                time.sleep(args.ramp / args.clients)
+        try:
+            for t in threads:
+                t.join()
+        except KeyboardInterrupt:
+            stop.set()
+            for t in threads:
+                t.join()
+        stats.finished = time.perf_counter()
+        WRITER.flush()
+    return stats
+
+
+def format_report(summary: dict, args):
+    lines = [f"[load] {args.clients} clients against {args.endpoint}: {summary['turns']} turns in {summary['elapsed_s']:.1f}s "
+             f"({summary['turns_per_s']:.2f} turns/s)"]
+    for kind, row in summary['kinds'].items():
+        if not row['requests']:
+            continue
+        pcts = ' '.join(f"p{p}={row[f'p{p}_ms']}" for p in PERCENTILES)
+        lines.append(f"[load] {kind}: {row['ok']} ok / {row['failed']} failed ({row['error_rate']:.1%}), "
+                     f"{row['throughput_rps']:.2f} req/s, ms {pcts} max={row['max_ms']}, ~{row['avg_request_bytes']} bytes/request")
+        for cause, count in sorted(row['errors'].items(), key=lambda kv: -kv[1]):
+            lines.append(f'[load]   {count} x {cause}')
+    return '\n'.join(lines)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Load-test a Chat Max server-mode endpoint with simulated users.')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--endpoint', help='server endpoint URL')
+    target.add_argument('--stub', action='store_true', help='start the reference server with a fake upstream in-process and test that')
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help='simulated users at once')
+    parser.add_argument('--turns', type=int, help=f'turns per user (default {DEFAULT_TURNS}, unlimited with --duration)')
+    parser.add_argument('--duration', type=float, help='stop starting new turns after this many seconds')
+    parser.add_argument('--think', type=float, default=DEFAULT_THINK_S, help='mean seconds between a reply and the next message')
+    parser.add_argument('--ramp', type=float, default=DEFAULT_RAMP_S, help='seconds over which users are started')
+    parser.add_argument('--prefs', type=int, default=DEFAULT_PREFS, help='synthetic preferences per user')
+    parser.add_argument('--history-lines', type=int, default=HISTORY_DEFAULT_LINES, help='short-term history sent per turn')
+    parser.add_argument('--no-extract', action='store_true', help='skip the per-turn preference extraction request')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT_S, help='per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for prompts, personalities and think times')
+    parser.add_argument('--stub-latency', type=float, default=STUB_LATENCY_S, help='--stub: fake upstream seconds per reply')
+    parser.add_argument('--stub-concurrency', type=int, default=64, help='--stub: upstream calls at once')
+    parser.add_argument('--json', help='write the results (and run parameters) as JSON to this file')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    args.clients = max(1, args.clients)
+    if args.turns is None:
+        args.turns = 10 ** 9 if args.duration else DEFAULT_TURNS
+    args.turns = max(1, args.turns)
+    server = None
+    if args.stub:
+        args.endpoint, server = start_stub(args.stub_latency, args.stub_concurrency)
+    stats = run_load(args)
+    summary = stats.summary()
+    print(format_report(summary, args), file=sys.stderr)
+    if server is not None:
+        print(f'[load] stub: {json.dumps(server.summary())}', file=sys.stderr)
+    if args.json:
+        params = {k: v for k, v in vars(args).items() if k != 'json'}
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'params': params, 'results': summary, 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+    failed = sum(row['failed'] for row in summary['kinds'].values())
+    return 1 if failed and not any(row['ok'] for row in summary['kinds'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
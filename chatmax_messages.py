@@ -0,0 +1,266 @@
+# File:        chatmax_messages.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Compact conversation records for Chat Max. Messages are
+#              slotted objects with interned role labels and integer epoch
+#              timestamps (formatted only when rendered or saved). The
+#              untrimmed conversation is a MessageLog that can optionally
+#              spill older messages to an append-only journal file which is
+#              read back through mmap instead of being held in memory.
+
+
+# Imports
+
+# Journal records
+import json
+# Memory-mapped reads of spilled messages
+import mmap
+# Compact journal offsets
+from array import array
+# Interned role labels
+import sys
+# Journal files
+import tempfile
+# Locking for logs shared with worker threads
+import threading
+# Timestamp parsing and formatting
+import time
+# OS for file paths
+import os
+
+
+# Constants
+
+# Timestamp format used in saved conversations and the chat view
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Role label used for the user's own messages in history
+USER_ROLE = 'You'
+
+# Defaults for the optional spill-to-disk mode, overridable via settings.json 'history_spill'
+DEFAULT_SPILL = {
+    'enabled': False,
+    # Newest messages always kept in memory
+    'keep_in_memory': 500,
+}
+
+
+# Functions
+
+def format_ts(ts: int | None, fmt: str = TS_FORMAT):
+    return time.strftime(fmt, time.localtime(ts)) if ts is not None else ''
+
+
+def parse_ts(value):
+    # Epoch seconds from an int, a TS_FORMAT string or anything else (now)
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str) and value:
+        try:
+            return int(time.mktime(time.strptime(value, TS_FORMAT)))
+        except Exception:
+            pass
+    return int(time.time())
+
+
+class Message:
+    # One conversation entry. Still indexes like the old (role, message,
+    # timestamp[, model]) tuples so generic callers keep working
+
+    __slots__ = ('role', 'text', 'ts', 'model')
+
+    def __init__(self, role: str, text: str, ts: int | None = None, model: str | None = None):
+        self.role = sys.intern(str(role))
+        self.text = text
+        self.ts = int(time.time()) if ts is None else int(ts)
+        self.model = sys.intern(model) if model else None
+
+    @classmethod
+    def from_item(cls, item):
+        # Message from a loaded [role, message(, timestamp(, model))] item, None if malformed
+        if isinstance(item, Message):
+            return item
+        if isinstance(item, (list, tuple)) and len(item) >= 2:
+            ts = parse_ts(item[2]) if len(item) > 2 else None
+            model = item[3] if len(item) > 3 and item[3] else None
+            return cls(item[0], str(item[1]), ts, model)
+        return None
+
+    @property
+    def time_text(self):
+        return format_ts(self.ts)
+
+    def to_list(self):
+        # Saved form: [role, message, 'YYYY-mm-dd HH:MM:SS'(, model)]
+        item = [self.role, self.text, self.time_text]
+        if self.model:
+            item.append(self.model)
+        return item
+
+    def __len__(self):
+        return 4 if self.model else 3
+
+    def __getitem__(self, index):
+        return tuple(self.to_list())[index]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __repr__(self):
+        return f'Message({self.role!r}, {self.text[:40]!r}, {self.ts}, {self.model!r})'
+
+
+def merge_spill_settings(value):
+    merged = dict(DEFAULT_SPILL)
+    if isinstance(value, dict):
+        merged['enabled'] = bool(value.get('enabled', merged['enabled']))
+        try:
+            if value.get('keep_in_memory') is not None:
+                merged['keep_in_memory'] = max(10, int(value['keep_in_memory']))
+        except Exception:
+            pass
+    return merged
+
+
+class MessageLog:
+    # The untrimmed conversation. The newest messages live in memory; with
+    # spilling enabled, older ones are appended to a journal file (one JSON
+    # line each, offsets kept in a compact array) and read back via mmap
+
+    def __init__(self, spill: dict | None = None):
+        self._lock = threading.RLock()
+        self._memory = []
+        self._journal_path = None
+        self._journal = None
+        self._offsets = array('Q')
+        self._map = None
+        self.configure(spill)
+
+    def configure(self, spill: dict | None):
+        settings = merge_spill_settings(spill)
+        with self._lock:
+            self.spill_enabled = settings['enabled']
+            self.keep_in_memory = settings['keep_in_memory']
+            self._maybe_spill()
+
+    # Spilling
+
+    def _open_journal(self):
+        if self._journal is None:
+            fd, self._journal_path = tempfile.mkstemp(prefix='chatmax-', suffix='.journal')
+            self._journal = os.fdopen(fd, 'w+b')
+            self._offsets = array('Q', [0])
+
+    def _maybe_spill(self):
+        # Move everything but the newest keep_in_memory messages to the journal
+        if not self.spill_enabled:
+            return
+        overflow = len(self._memory) - self.keep_in_memory
+        if overflow <= 0:
+            return
+        self._open_journal()
+        self._journal.seek(0, os.SEEK_END)
+        for msg in self._memory[:overflow]:
+            line = json.dumps([msg.role, msg.text, msg.ts, msg.model], ensure_ascii=False).encode('utf-8') + b'\n'
+            self._journal.write(line)
+            self._offsets.append(self._offsets[-1] + len(line))
+        self._journal.flush()
+        del self._memory[:overflow]
+        # Remap lazily on the next read of a spilled message
+        self._close_map()
+
+    def _close_map(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except Exception:
+                pass
+            self._map = None
+
+    def _spilled_count(self):
+        return len(self._offsets) - 1 if self._journal is not None else 0
+
+    def _read_spilled(self, index: int):
+        if self._map is None:
+            self._map = mmap.mmap(self._journal.fileno(), 0, access=mmap.ACCESS_READ)
+        role, text, ts, model = json.loads(self._map[self._offsets[index]:self._offsets[index + 1]])
+        return Message(role, text, ts, model)
+
+    # List-like interface
+
+    def append(self, msg: Message):
+        with self._lock:
+            self._memory.append(msg)
+            self._maybe_spill()
+
+    def extend(self, msgs):
+        with self._lock:
+            self._memory.extend(msgs)
+            self._maybe_spill()
+
+    def insert_after(self, match, msg: Message):
+        # Put msg right after the newest in-memory message match(m) accepts
+        # (spilled messages are immutable), append when there is none.
+        # Returns True when it was slotted in
+        with self._lock:
+            for i in range(len(self._memory) - 1, -1, -1):
+                if match(self._memory[i]):
+                    self._memory.insert(i + 1, msg)
+                    self._maybe_spill()
+                    return True
+            self._memory.append(msg)
+            self._maybe_spill()
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.close()
+
+    def close(self):
+        # Drop the journal file (the conversation is saved separately)
+        with self._lock:
+            self._close_map()
+            if self._journal is not None:
+                try:
+                    self._journal.close()
+                    os.remove(self._journal_path)
+                except Exception:
+                    pass
+            self._journal = None
+            self._journal_path = None
+            self._offsets = array('Q')
+
+    def __len__(self):
+        with self._lock:
+            return self._spilled_count() + len(self._memory)
+
+    def __getitem__(self, index):
+        with self._lock:
+            total = self._spilled_count() + len(self._memory)
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(total))]
+            if index < 0:
+                index += total
+            if not 0 <= index < total:
+                raise IndexError('message index out of range')
+            spilled = self._spilled_count()
+            if index < spilled:
+                return self._read_spilled(index)
+            return self._memory[index - spilled]
+
+    def __iter__(self):
+        # Iterates a snapshot so worker threads can append while the UI renders
+        with self._lock:
+            spilled = self._spilled_count()
+            memory = list(self._memory)
+        for i in range(spilled):
+            with self._lock:
+                msg = self._read_spilled(i) if i < self._spilled_count() else None
+            if msg is not None:
+                yield msg
+        yield from memory
+
+    def in_memory(self):
+        with self._lock:
+            return len(self._memory)
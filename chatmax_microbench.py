@@ -0,0 +1,333 @@
+# File:        chatmax_microbench.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Microbenchmarks for Chat Max's per-turn CPU work at scale:
+#              building the payload from a 50-entry history, personality
+#              instructions, matching the active preset against thousands of
+#              personality files, the pref_key()/merge_preferences() loop over
+#              thousands of preferences, and trimming, appending to, loading
+#              and serializing 100k-message conversations. Each case reports
+#              the median and best time per call; results are appended to
+#              bench_results/micro-history.jsonl and compared with the previous
+#              run and the best one recorded, so optimizations can be proven
+#              and regressions spotted over time.
+#
+# Usage:
+#   python chatmax_microbench.py
+#   python chatmax_microbench.py --case merge_preferences --case preset_match_cold --repeats 9
+#   python chatmax_microbench.py --scale 0.1 --no-record          (quick check)
+
+
+# Imports
+
+# Command line
+import argparse
+# Results history
+import json
+# Deterministic inputs
+import random
+# Machine description in the results
+import platform
+# Median of the repeats
+import statistics
+# Scratch personality and preferences files
+import tempfile
+# Timing
+import time
+import timeit
+# OS for paths
+import os
+# stderr report
+import sys
+# The code being measured
+import chatmax_engine
+from chatmax_engine import (ChatSession, USER_ROLE, DEFAULT_PRESETS, build_personality_instructions, match_preset_name,
+                            merge_preferences, pref_key, save_prefs_list)
+# Conversation entries
+from chatmax_messages import Message
+# Pending preference/preset writes are flushed before timing
+from chatmax_writer import WRITER
+# Realistic prompts and preferences, version and commit of the tree
+from chatmax_loadtest import synthetic_prompt, synthetic_preferences
+from chatmax_bench import RESULTS_DIR, tree_version
+
+
+# Constants
+
+HISTORY_PATH = os.path.join(RESULTS_DIR, 'micro-history.jsonl')
+DEFAULT_REPEATS = 5
+# Target seconds per repeat when the number of calls is chosen automatically
+MIN_REPEAT_S = 0.2
+# Input sizes at --scale 1
+HISTORY_ENTRIES = 50
+PREFERENCES = 5000
+NEW_PREFERENCES = 20
+PERSONALITY_FILES = 2000
+CONVERSATION_MESSAGES = 100000
+PERSONALITY_VARIANTS = 500
+# Change against the previous run that is highlighted
+NOTABLE_CHANGE = 0.10
+
+
+# Functions
+
+def random_values(rng: random.Random):
+    # Slider values in the GUI's ranges: friendliness, professionalism,
+    # profanity, age, gender, humour, sarcasm, extroversion
+    return (rng.randint(0, 3), rng.randint(0, 2), rng.randint(0, 2), rng.randint(5, 127),
+            rng.randint(0, 2), rng.randint(0, 2), rng.randint(0, 2), rng.randint(0, 2))
+
+
+def conversation(rng: random.Random, count: int):
+    # Alternating user/assistant messages with realistic lengths
+    msgs = []
+    for i in range(count):
+        if i % 2 == 0:
+            msgs.append(Message(USER_ROLE, synthetic_prompt(rng, i // 2), 1700000000 + i))
+        else:
+            msgs.append(Message('Default AI', ' '.join(synthetic_prompt(rng, i).split()[:rng.randint(8, 40)]) * 2, 1700000000 + i))
+    return msgs
+
+
+class Fixtures:
+    # Shared inputs, built once per run in a scratch directory
+
+    def __init__(self, tmp: str, scale: float, seed: int):
+        rng = random.Random(seed)
+        self.scale = scale
+
+        def n(base):
+            return max(1, int(base * scale))
+
+        self.presets_dir = os.path.join(tmp, 'personalities')
+        os.makedirs(self.presets_dir)
+        used = {tuple(v) for v in DEFAULT_PRESETS.values()}
+        self.personality_files = n(PERSONALITY_FILES)
+        for i in range(self.personality_files):
+            values = random_values(rng)
+            while values in used:
+                values = random_values(rng)
+            used.add(values)
+            with open(os.path.join(self.presets_dir, f'preset-{i:05d}.json'), 'w', encoding='utf-8') as f:
+                json.dump({'values': list(values)}, f)
+        # Values that match no preset: the worst case, every file is compared
+        self.unmatched = random_values(rng)
+        while self.unmatched in used:
+            self.unmatched = random_values(rng)
+        self.variants = [random_values(rng) for _ in range(PERSONALITY_VARIANTS)]
+        self.prefs = synthetic_preferences(rng, n(PREFERENCES))
+        self.pref_lines = [p['line'] for p in self.prefs]
+        # Half updates of existing keys, half new keys
+        half = NEW_PREFERENCES // 2
+        self.new_prefs = [f"{self.pref_lines[rng.randrange(len(self.pref_lines))].split(' is ')[0]} is updated {i}" for i in range(half)]
+        self.new_prefs += [f'new subject {i} is option {rng.randint(1, 99)}' for i in range(NEW_PREFERENCES - half)]
+        self.prefs_path = os.path.join(tmp, 'preferences.json')
+        save_prefs_list(self.prefs[:n(1000)], self.prefs_path)
+        self.conversation = conversation(rng, n(CONVERSATION_MESSAGES))
+        self.items = [m.to_list() for m in self.conversation]
+        self.message = synthetic_prompt(rng, 10 ** 6)
+        WRITER.flush()
+
+    def session(self, history: int = HISTORY_ENTRIES):
+        session = ChatSession({'use_local_ai': False, 'server_endpoint': 'http://127.0.0.1:9/', 'ai_history_lines': history,
+                               'offline_queue': False}, prefs_path=self.prefs_path, presets_dir=self.presets_dir,
+                              ephemeral=True)
+        session.set_personality(self.unmatched)
+        return session
+
+
+def build_cases(fx: Fixtures):
+    # name -> (description, make); make() returns (fn, per-call setup or None)
+
+    def payload_build():
+        s = fx.session()
+        s.history.extend(fx.conversation[-HISTORY_ENTRIES:])
+        label = s.active_preset_name()
+        return (lambda: s.build_payload(fx.message, label)), None
+
+    def payload_build_prepared():
+        s = fx.session()
+        s.history.extend(fx.conversation[-HISTORY_ENTRIES:])
+        label = s.prepare_turn()
+        return (lambda: s.build_payload(fx.message, label)), None
+
+    def insert_preferences():
+        s = fx.session()
+        payload = s.build_payload(fx.message, 'Default AI')
+        return (lambda: s.insert_preferences(list(payload))), None
+
+    def personality_instructions():
+        variants = fx.variants
+        state = {'i': 0}
+
+        def run():
+            state['i'] = (state['i'] + 1) % len(variants)
+            return build_personality_instructions(variants[state['i']])
+        return run, None
+
+    def preset_match_warm():
+        match_preset_name(fx.unmatched, fx.presets_dir)
+        return (lambda: match_preset_name(fx.unmatched, fx.presets_dir)), None
+
+    def preset_match_cold():
+        return (lambda: match_preset_name(fx.unmatched, fx.presets_dir)), (lambda: chatmax_engine._personality_cache.pop(fx.presets_dir, None))
+
+    def pref_keys():
+        lines = fx.pref_lines
+        return (lambda: [pref_key(line) for line in lines]), None
+
+    def merge():
+        existing, new, limit = fx.prefs, fx.new_prefs, len(fx.prefs)
+        return (lambda: merge_preferences(existing, new, limit)), None
+
+    def trim_history():
+        s = fx.session()
+
+        def refill():
+            s.history[:] = fx.conversation
+        return s.trim_history, refill
+
+    def add_message_long():
+        s = fx.session()
+        s.full_history.extend(fx.conversation)
+        s.history.extend(fx.conversation[-HISTORY_ENTRIES:])
+        return (lambda: s.add_message(USER_ROLE, fx.message)), None
+
+    def load_entries():
+        s = fx.session()
+        return (lambda: s.load_entries(fx.items)), None
+
+    def serialize_history():
+        s = fx.session()
+        s.full_history.extend(fx.conversation)
+        return s.serialize_history, None
+
+    return {
+        'payload_build': (f'build_payload() from a {HISTORY_ENTRIES}-entry history', payload_build),
+        'payload_build_prepared': ('build_payload() after prepare_turn() cached the static prefix', payload_build_prepared),
+        'insert_preferences': ('insert_preferences() with a 1000-line preferences file (stat-cached)', insert_preferences),
+        'personality_instructions': (f'build_personality_instructions() over {PERSONALITY_VARIANTS} slider combinations (per call)', personality_instructions),
+        'preset_match_warm': (f'match_preset_name() with {fx.personality_files} personality files, directory cached, no match', preset_match_warm),
+        'preset_match_cold': (f'match_preset_name() with {fx.personality_files} personality files, rescanning the directory', preset_match_cold),
+        'pref_key': (f'pref_key() over {len(fx.pref_lines)} preference lines', pref_keys),
+        'merge_preferences': (f'merge_preferences() of {NEW_PREFERENCES} lines into {len(fx.prefs)} preferences', merge),
+        'trim_history': (f'trim_history() from {len(fx.conversation)} messages down to {HISTORY_ENTRIES}', trim_history),
+        'add_message_long': (f'add_message() (append + trim) on a {len(fx.conversation)}-message conversation', add_message_long),
+        'load_entries': (f'load_entries() of a {len(fx.items)}-message saved conversation', load_entries),
+        'serialize_history': (f'serialize_history() of a {len(fx.conversation)}-message conversation', serialize_history),
+    }
+
+
+def time_case(fn, setup, repeats: int):
+    # (per-call seconds of each repeat, calls per repeat). Cases with a
+    # per-call setup are timed one call at a time, others in automatic batches
+    if setup is not None:
+        samples = []
+        for _ in range(repeats):
+            setup()
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+        return samples, 1
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    # autorange stops at 0.2s, scale up when a repeat should be longer
+    number = max(1, int(number * MIN_REPEAT_S / 0.2))
+    return [t / number for t in timer.repeat(repeat=repeats, number=number)], number
+
+
+def load_history(path: str):
+    records = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        records.append(json.loads(line))
+                    except Exception:
+                        pass
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def format_us(seconds):
+    us = seconds * 1e6
+    if us >= 100000:
+        return f'{us / 1000:.0f} ms'
+    if us >= 1000:
+        return f'{us / 1000:.2f} ms'
+    return f'{us:.2f} us'
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for Chat Max's per-turn CPU work.")
+    parser.add_argument('--case', action='append', help='case to run (repeatable, default: all; see --list)')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='timed repeats per case')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply input sizes (e.g. 0.1 for a quick run)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the inputs')
+    parser.add_argument('--label', help='name for this run in the history (default: the version)')
+    parser.add_argument('--history', default=HISTORY_PATH, help='JSONL file the results are appended to and compared with')
+    parser.add_argument('--no-record', action='store_true', help='do not append this run to the history')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    version, commit = tree_version()
+    with tempfile.TemporaryDirectory(prefix='chatmax-micro-') as tmp:
+        print('[micro] building inputs...', file=sys.stderr)
+        fx = Fixtures(tmp, max(0.001, args.scale), args.seed)
+        cases = build_cases(fx)
+        if args.list:
+            for name, (description, _) in cases.items():
+                print(f'{name:<26}{description}')
+            return 0
+        unknown = [c for c in args.case or [] if c not in cases]
+        if unknown:
+            print(f"[micro] unknown case(s): {', '.join(unknown)} (see --list)", file=sys.stderr)
+            return 2
+        history = [r for r in load_history(args.history) if r.get('scale') == args.scale]
+        previous = history[-1] if history else None
+        results = {}
+        for name in args.case or list(cases):
+            description, make = cases[name]
+            fn, setup = make()
+            samples, number = time_case(fn, setup, max(1, args.repeats))
+            results[name] = {'median_s': statistics.median(samples), 'min_s': min(samples), 'calls_per_repeat': number, 'description': description}
+            line = f'{name:<26}{format_us(results[name]["median_s"]):>12} median {format_us(results[name]["min_s"]):>12} best'
+            old = (previous or {}).get('results', {}).get(name)
+            if old:
+                change = (results[name]['median_s'] - old['median_s']) / old['median_s'] if old['median_s'] else 0.0
+                line += f'   {change:+.1%} vs previous' + (' !' if abs(change) >= NOTABLE_CHANGE else '')
+            best = min((r['results'][name]['min_s'] for r in history if name in r.get('results', {})), default=None)
+            if best is not None:
+                line += f', best ever {format_us(best)}'
+            print(line)
+    record = {
+        'label': args.label or version,
+        'version': version,
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': args.scale,
+        'seed': args.seed,
+        'repeats': args.repeats,
+        'results': results,
+    }
+    if previous:
+        print(f"[micro] compared with {previous.get('label')} ({previous.get('commit')}, {previous.get('started')})", file=sys.stderr)
+    if not args.no_record:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        print(f'[micro] appended to {args.history}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# File:        chatmax_outbox.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Durable outbound queue for Chat Max. When a turn cannot be
+#              delivered because the network or the endpoint is down, the
+#              user's message is kept in outbox.json instead of being lost, and
+#              retried with exponential backoff. Turns are replayed in the
+#              order they were sent, per conversation, and their replies are
+#              slotted into the conversation right after the message they
+#              answer.
+
+
+# Imports
+
+# Queue persistence
+import json
+# Backoff jitter
+import random
+# Locking shared by the GUI thread and delivery workers
+import threading
+# Retry clocks (wall time, so the schedule survives a restart)
+import time
+# Entry and conversation ids
+import uuid
+# Atomic file replacement (the queue is written synchronously, it must survive a crash)
+from chatmax_writer import atomic_write
+# Client-side rate limiter timeouts are not connectivity problems
+from chatmax_ratelimit import RateLimitWaitTimeout
+
+
+# Constants
+
+# First retry delay, doubled per failed attempt up to BACKOFF_MAX_S
+BACKOFF_BASE_S = 2.0
+BACKOFF_MAX_S = 300.0
+# Random extra fraction so several clients do not retry in lockstep
+BACKOFF_JITTER = 0.2
+
+
+# Functions
+
+def new_conversation_id():
+    return uuid.uuid4().hex
+
+
+def is_offline_error(exc: Exception):
+    # Worth queueing: the service could not be reached or is overloaded/down.
+    # Configuration problems (no key, bad request, auth) are not, and neither
+    # is our own rate limiter giving up (a TimeoutError, but nothing was sent)
+    if isinstance(exc, RateLimitWaitTimeout):
+        return False
+    response = getattr(exc, 'response', None)
+    status = getattr(exc, 'status_code', None) or getattr(response, 'status_code', None)
+    if status is not None:
+        return status >= 500 or status == 429
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    name = type(exc).__name__.lower()
+    return 'connection' in name or 'timeout' in name
+
+
+def backoff_s(attempts: int):
+    delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** max(0, attempts - 1)))
+    return delay * (1.0 + random.uniform(0.0, BACKOFF_JITTER))
+
+
+class TurnQueued(Exception):
+    # Raised instead of an error when a turn went to the outbox
+
+    def __init__(self, entry: dict, reason: str = ''):
+        super().__init__(f'Message queued for delivery: {reason}' if reason else 'Message queued for delivery')
+        self.entry = entry
+
+
+class Outbox:
+    # Undelivered turns, oldest first:
+    # {id, conversation_id, message, ts, preset, payload, attempts, next_try, last_error, created}
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self._lock = threading.RLock()
+        self.entries = []
+        self.delivered = 0
+        self.load()
+
+    def load(self):
+        # path=None is an in-memory queue (ephemeral sessions)
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            entries = data.get('entries', []) if isinstance(data, dict) else []
+        except Exception:
+            entries = []
+        with self._lock:
+            self.entries = [e for e in entries if isinstance(e, dict) and e.get('id') and e.get('message') is not None]
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            atomic_write(self.path, json.dumps({'version': 1, 'entries': self.entries}, ensure_ascii=False))
+
+    def add(self, conversation_id: str, message: str, ts: int, preset: str, payload: list, error: str | None = None, attempts: int = 1):
+        # attempts counts the failed delivery that put the turn here (0 when queued behind others)
+        now = time.time()
+        entry = {
+            'id': uuid.uuid4().hex,
+            'conversation_id': conversation_id,
+            'message': message,
+            'ts': int(ts),
+            'preset': preset,
+            'payload': payload,
+            'attempts': attempts,
+            'next_try': now + backoff_s(attempts) if attempts else now,
+            'last_error': error,
+            'created': now,
+        }
+        with self._lock:
+            self.entries.append(entry)
+            self.save()
+        return entry
+
+    def pending(self, conversation_id: str | None = None):
+        with self._lock:
+            return [dict(e) for e in self.entries if conversation_id is None or e['conversation_id'] == conversation_id]
+
+    def count(self, conversation_id: str | None = None):
+        with self._lock:
+            return sum(1 for e in self.entries if conversation_id is None or e['conversation_id'] == conversation_id)
+
+    def next_due(self, conversation_id: str):
+        # Wall-clock time the conversation's oldest turn should be retried, None when empty
+        with self._lock:
+            for e in self.entries:
+                if e['conversation_id'] == conversation_id:
+                    return e['next_try']
+        return None
+
+    def first(self, conversation_id: str):
+        with self._lock:
+            for e in self.entries:
+                if e['conversation_id'] == conversation_id:
+                    return dict(e)
+        return None
+
+    def mark_failed(self, entry_id: str, error: Exception | str | None = None):
+        with self._lock:
+            for e in self.entries:
+                if e['id'] == entry_id:
+                    e['attempts'] += 1
+                    e['next_try'] = time.time() + backoff_s(e['attempts'])
+                    e['last_error'] = str(error) if error is not None else None
+                    break
+            self.save()
+
+    def retry_now(self, conversation_id: str):
+        # Connectivity is back (or the user asked): make the conversation's turns due
+        with self._lock:
+            now = time.time()
+            for e in self.entries:
+                if e['conversation_id'] == conversation_id:
+                    e['next_try'] = min(e['next_try'], now)
+
+    def remove(self, entry_id: str):
+        with self._lock:
+            before = len(self.entries)
+            self.entries = [e for e in self.entries if e['id'] != entry_id]
+            if len(self.entries) != before:
+                self.delivered += 1
+                self.save()
+
+    def drop(self, conversation_id: str):
+        # The conversation was discarded, its turns can never be slotted in
+        with self._lock:
+            before = len(self.entries)
+            self.entries = [e for e in self.entries if e['conversation_id'] != conversation_id]
+            if len(self.entries) != before:
+                self.save()
+            return before - len(self.entries)
+
+
+# Outboxes are shared per file so every session sees the same queue
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_outbox(path: str):
+    with _outboxes_lock:
+        box = _outboxes.get(path)
+        if box is None:
+            box = Outbox(path)
+            _outboxes[path] = box
+        return box
@@ -0,0 +1,213 @@
+# File:        chatmax_profile.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Opt-in profiling of Chat Max's hot paths. When enabled (the
+#              CHATMAX_PROFILE environment variable or --profile), wrapped
+#              functions run under cProfile and, optionally, tracemalloc. At
+#              exit a per-session report (top functions per hook, allocation
+#              growth) and pstats dumps are written to the profiles/ folder,
+#              so a slow session can be captured without editing any code.
+#              When disabled, wrap() returns functions unchanged.
+
+
+# Imports
+
+# Per-call CPU profiles
+import cProfile
+# Aggregating and printing profiles
+import pstats
+# Report text
+import io
+# Allocation tracking
+import tracemalloc
+# Per-thread "already profiling" flag
+import threading
+# Report timestamps and wall-clock call times
+import time
+# Wrapped functions keep their names
+import functools
+# OS for paths, the environment and the process id
+import os
+
+
+# Constants
+
+# Environment variable: '1'/'cpu' profiles CPU, 'mem' or 'cpu,mem' also tracks allocations
+PROFILE_ENV = 'CHATMAX_PROFILE'
+# Environment variable overriding where reports are written
+PROFILE_DIR_ENV = 'CHATMAX_PROFILE_DIR'
+# Reports go next to the script unless overridden
+PROFILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+# Functions listed per hook in the report
+TOP_FUNCTIONS = 25
+# Allocation sites listed in the report
+TOP_ALLOCATIONS = 25
+# Stack depth recorded by tracemalloc
+TRACE_FRAMES = 10
+
+
+# Functions
+
+def parse_profile_env(value: str | None):
+    # (cpu, memory) from the environment variable's value
+    if not value:
+        return False, False
+    parts = {p.strip().lower() for p in value.replace('+', ',').split(',') if p.strip()}
+    if parts & {'0', 'off', 'false', 'no'}:
+        return False, False
+    return True, bool(parts & {'mem', 'memory', 'all'})
+
+
+class HookStats:
+    # Accumulated profile and timings of one wrapped function
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.alloc_bytes = 0
+        self.stats = None
+        self.skipped = 0
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.out_dir = PROFILES_DIR
+        self.started = None
+        self.hooks = {}
+        self._baseline = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, memory: bool = False, out_dir: str | None = None):
+        self.enabled = True
+        self.memory = bool(memory)
+        self.out_dir = out_dir or os.environ.get(PROFILE_DIR_ENV) or PROFILES_DIR
+        self.started = time.time()
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+            self._baseline = tracemalloc.take_snapshot()
+
+    def enable_from_env(self, environ=None):
+        cpu, memory = parse_profile_env((environ or os.environ).get(PROFILE_ENV))
+        if cpu:
+            self.enable(memory)
+        return cpu
+
+    def wrap(self, name: str, fn):
+        # fn itself when profiling is off, so the hot paths pay nothing
+        if not self.enabled:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.run(name, fn, *args, **kwargs)
+
+        return wrapper
+
+    def run(self, name: str, fn, *args, **kwargs):
+        # Nested hooks on the same thread are already covered by the outer profile
+        if getattr(self._local, 'active', False):
+            return fn(*args, **kwargs)
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Another profiler is active (e.g. a debugger), just time the call
+            prof = None
+        self._local.active = True
+        mem_before = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if prof is not None:
+                prof.disable()
+            self._local.active = False
+            grown = tracemalloc.get_traced_memory()[0] - mem_before if self.memory else 0
+            self._record(name, prof, elapsed, grown)
+
+    def _record(self, name: str, prof, elapsed: float, grown: int):
+        with self._lock:
+            hook = self.hooks.get(name)
+            if hook is None:
+                hook = self.hooks[name] = HookStats(name)
+            hook.calls += 1
+            hook.total_s += elapsed
+            hook.max_s = max(hook.max_s, elapsed)
+            hook.alloc_bytes += grown
+            if prof is None:
+                hook.skipped += 1
+                return
+            try:
+                if hook.stats is None:
+                    hook.stats = pstats.Stats(prof)
+                else:
+                    hook.stats.add(prof)
+            except TypeError:
+                # A call that returned before any function was recorded
+                pass
+
+    def report_text(self):
+        out = io.StringIO()
+        with self._lock:
+            hooks = sorted(self.hooks.values(), key=lambda h: h.total_s, reverse=True)
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)) if self.started else '?'
+            out.write(f'Chat Max profile, session started {started}, pid {os.getpid()}\n\n')
+            out.write(f"{'hook':<24}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'max ms':>10}")
+            out.write(f"{'alloc KiB':>12}\n" if self.memory else '\n')
+            for h in hooks:
+                mean = h.total_s / h.calls if h.calls else 0.0
+                out.write(f'{h.name:<24}{h.calls:>8}{h.total_s * 1000:>12.1f}{mean * 1000:>10.1f}{h.max_s * 1000:>10.1f}')
+                out.write(f'{h.alloc_bytes / 1024:>12.1f}\n' if self.memory else '\n')
+            for h in hooks:
+                if h.stats is None:
+                    continue
+                out.write(f'\n=== {h.name}: top {TOP_FUNCTIONS} by cumulative time ===\n')
+                h.stats.stream = out
+                h.stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            out.write(f'\n=== Allocations: {current / 1024:.1f} KiB traced now, peak {peak / 1024:.1f} KiB ===\n')
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            if self._baseline is not None:
+                out.write(f'Top {TOP_ALLOCATIONS} growth since profiling started:\n')
+                for diff in snapshot.compare_to(self._baseline, 'lineno')[:TOP_ALLOCATIONS]:
+                    out.write(f'  {diff}\n')
+            else:
+                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                    out.write(f'  {stat}\n')
+        return out.getvalue()
+
+    def write_report(self):
+        # Writes profiles/chatmax-<time>-<pid>.txt plus one .prof (pstats) file
+        # per hook, returns the report path (None when profiling is off)
+        if not self.enabled:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        stem = os.path.join(self.out_dir, f"chatmax-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))}-{os.getpid()}")
+        path = stem + '.txt'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.report_text())
+        with self._lock:
+            for h in self.hooks.values():
+                if h.stats is not None:
+                    try:
+                        h.stats.dump_stats(f'{stem}-{h.name}.prof')
+                    except Exception:
+                        pass
+        return path
+
+
+# Process-wide profiler used by the GUI hooks
+PROFILER = Profiler()
@@ -0,0 +1,298 @@
+# File:        chatmax_ratelimit.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Shared client-side rate limiting for Chat Max. Chat replies and
+#              preference extraction draw from the same token buckets per API
+#              key (or server endpoint list): one for requests per minute and
+#              one for tokens per minute. Interactive replies are served before
+#              queued extraction calls, and a 429 answer pauses the whole
+#              limiter for the server's Retry-After before the call is retried.
+
+
+# Imports
+
+# Waiting requests ordered by priority, then arrival
+import heapq
+# Identifying a limiter by API key without keeping the key itself
+import hashlib
+# Parsing HTTP-date Retry-After values
+from email.utils import parsedate_to_datetime
+# Locking shared by every session using the same key
+import threading
+# Refill and cooldown clocks
+import time
+# Arrival order of waiters
+import itertools
+
+
+# Constants
+
+# Interactive replies first, background work (extraction) after
+PRIORITY_CHAT = 0
+PRIORITY_BACKGROUND = 1
+
+# Limits overridable via settings.json 'rate_limits'
+DEFAULT_RATE_LIMITS = {
+    # Requests per minute (None = unlimited, only 429s slow us down)
+    'rpm': None,
+    # Tokens per minute, prompt estimate plus expected completion (None = unlimited)
+    'tpm': None,
+    # Give up (and raise) rather than wait longer than this for a slot
+    'max_wait_s': 60.0,
+    # Retries of a call answered with 429
+    'retries': 2,
+}
+# Completion tokens assumed when a call has no output cap
+DEFAULT_COMPLETION_TOKENS = 512
+# Characters per token for the prompt estimate
+CHARS_PER_TOKEN = 4
+# Pause after a 429 without a usable Retry-After header (doubles per retry)
+DEFAULT_BACKOFF_S = 1.0
+
+
+# Functions
+
+class RateLimitWaitTimeout(TimeoutError):
+    # Our own limiter gave up waiting for a slot: nothing reached the network,
+    # so this is not a sign the service is down (see is_offline_error)
+    pass
+
+
+def merge_rate_limits(value):
+    merged = dict(DEFAULT_RATE_LIMITS)
+    if isinstance(value, dict):
+        for k in ('rpm', 'tpm'):
+            try:
+                merged[k] = max(1, int(value[k])) if value.get(k) else None
+            except Exception:
+                pass
+        try:
+            if value.get('max_wait_s') is not None:
+                merged['max_wait_s'] = max(0.0, float(value['max_wait_s']))
+            if value.get('retries') is not None:
+                merged['retries'] = max(0, int(value['retries']))
+        except Exception:
+            pass
+    return merged
+
+
+def estimate_tokens(messages, max_tokens: int | None = None):
+    # Rough prompt size plus the completion we may get back
+    chars = 0
+    for m in messages or []:
+        content = m.get('content') if isinstance(m, dict) else m
+        chars += len(content) if isinstance(content, str) else 0
+    return chars // CHARS_PER_TOKEN + 4 * len(messages or []) + (int(max_tokens) if max_tokens else DEFAULT_COMPLETION_TOKENS)
+
+
+def limiter_key(use_local: bool, api_key: str | None = None, endpoint=None):
+    # Limits belong to the API key (local mode) or the server (server mode)
+    if use_local:
+        digest = hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]
+        return f'openai:{digest}'
+    if isinstance(endpoint, (list, tuple)):
+        endpoint = ','.join(endpoint)
+    return f'server:{endpoint or ""}'
+
+
+def _status_of(exc: Exception):
+    status = getattr(exc, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return status
+
+
+def is_rate_limited(exc: Exception):
+    return _status_of(exc) == 429 or type(exc).__name__ == 'RateLimitError'
+
+
+def retry_after_s(exc: Exception):
+    # Seconds the server asked us to wait (retry-after-ms, retry-after as
+    # seconds or an HTTP date), None when it did not say
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get('retry-after-ms')
+        if ms is not None:
+            return max(0.0, float(ms) / 1000.0)
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class TokenBucket:
+    # Refills continuously at rate_per_min, holds at most one minute's worth
+
+    def __init__(self, rate_per_min: int | None):
+        self.rate = rate_per_min
+        self.tokens = float(rate_per_min or 0)
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        if self.rate:
+            self.tokens = min(float(self.rate), self.tokens + (now - self.stamp) * self.rate / 60.0)
+        self.stamp = now
+
+    def wait_for(self, amount: float):
+        # Seconds until amount is available (0 when unlimited or already there)
+        if not self.rate:
+            return 0.0
+        # A request bigger than the whole bucket only has to wait for a full one
+        amount = min(amount, float(self.rate))
+        return max(0.0, (amount - self.tokens) * 60.0 / self.rate)
+
+    def take(self, amount: float):
+        if self.rate:
+            self.tokens -= amount
+
+
+class RateLimiter:
+    # Token buckets for requests and tokens, a cooldown set by 429 answers and
+    # a priority queue of waiting callers; only the head of the queue may take
+
+    def __init__(self, limits: dict | None = None):
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self.blocked_until = 0.0
+        self.configure(limits)
+        self.reset_stats()
+
+    def configure(self, limits: dict | None):
+        limits = merge_rate_limits(limits)
+        with self._cond:
+            self.limits = limits
+            self.requests = TokenBucket(limits['rpm'])
+            self.tokens = TokenBucket(limits['tpm'])
+            self._cond.notify_all()
+
+    def reset_stats(self):
+        with self._cond:
+            self.granted = {PRIORITY_CHAT: 0, PRIORITY_BACKGROUND: 0}
+            self.waited = 0
+            self.wait_s = 0.0
+            self.throttled = 0
+            self.retried = 0
+            self.rejected = 0
+
+    def _delay(self, now: float, tokens: float):
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.blocked_until - now, self.requests.wait_for(1), self.tokens.wait_for(tokens))
+
+    def expected_wait(self, tokens: float = DEFAULT_COMPLETION_TOKENS):
+        # Rough wait for a new interactive request right now
+        with self._cond:
+            return self._delay(time.monotonic(), tokens)
+
+    def acquire(self, tokens: float, priority: int = PRIORITY_CHAT, max_wait_s: float | None = None):
+        # Block until the buckets allow this call (and everyone ahead of it has
+        # gone), raises RateLimitWaitTimeout instead of waiting past max_wait_s
+        max_wait_s = self.limits['max_wait_s'] if max_wait_s is None else max_wait_s
+        started = time.monotonic()
+        deadline = started + max_wait_s
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._delay(now, tokens)
+                    if self._waiters[0] == ticket and delay <= 0:
+                        break
+                    if now + max(delay, 0.0) > deadline:
+                        self.rejected += 1
+                        raise RateLimitWaitTimeout(f'Rate limit: no request slot within {max_wait_s:g}s')
+                    # Woken early when the head leaves or a 429 changes the cooldown
+                    self._cond.wait(timeout=max(0.01, delay) if self._waiters[0] == ticket else max(0.01, deadline - now))
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.granted[priority] = self.granted.get(priority, 0) + 1
+            waited = time.monotonic() - started
+            if waited > 0.001:
+                self.waited += 1
+                self.wait_s += waited
+
+    def settle(self, estimated: float, actual: int | None):
+        # Correct the token bucket once the real usage is known
+        if actual is None:
+            return
+        with self._cond:
+            self.tokens.take(actual - estimated)
+            if actual < estimated:
+                self._cond.notify_all()
+
+    def throttle(self, seconds: float):
+        # A 429 answer: nobody sends anything until the cooldown has passed
+        with self._cond:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def call(self, fn, tokens: float, priority: int = PRIORITY_CHAT, max_wait_s: float | None = None):
+        # fn() performs the request; 429 answers are retried after Retry-After
+        # (or an exponential backoff) up to limits['retries'] times
+        attempt = 0
+        while True:
+            self.acquire(tokens, priority, max_wait_s)
+            try:
+                return fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                pause = retry_after_s(e)
+                self.throttle(DEFAULT_BACKOFF_S * (2 ** attempt) if pause is None else pause)
+                if attempt >= self.limits['retries']:
+                    raise
+                attempt += 1
+                with self._cond:
+                    self.retried += 1
+
+    def summary(self):
+        with self._cond:
+            return {
+                'rpm': self.limits['rpm'],
+                'tpm': self.limits['tpm'],
+                'chat_granted': self.granted.get(PRIORITY_CHAT, 0),
+                'background_granted': self.granted.get(PRIORITY_BACKGROUND, 0),
+                'waited': self.waited,
+                'wait_s': self.wait_s,
+                'throttled': self.throttled,
+                'retried': self.retried,
+                'rejected': self.rejected,
+                'queued': len(self._waiters),
+            }
+
+
+# Limiters are shared per key so every session (and batch worker) using the
+# same API key or server draws from the same budget
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, limits: dict | None = None):
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(limits)
+            _limiters[key] = limiter
+        elif limits is not None and merge_rate_limits(limits) != limiter.limits:
+            limiter.configure(limits)
+        return limiter
+
+
+def all_rate_limiters():
+    with _limiters_lock:
+        return dict(_limiters)
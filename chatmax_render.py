@@ -0,0 +1,170 @@
+# File:        chatmax_render.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Cooperative insertion into the Chat Max chat view. Instead of
+#              inserting a whole conversation (or a huge reply) into the Tk
+#              text widget in one burst, text is inserted in time-sliced
+#              chunks scheduled with after(), so the window keeps responding.
+#              The view follows new text only while it is scrolled to the
+#              bottom, and a render can be cancelled when the user switches
+#              conversations.
+
+
+# Imports
+
+# Pending sources of text segments
+from collections import deque
+# Frame budget measurement
+import time
+
+
+# Constants
+
+# Default milliseconds of inserting per slice, overridable via settings.json 'render_budget_ms'
+DEFAULT_BUDGET_MS = 12
+# Allowed range for the frame budget
+MIN_BUDGET_MS = 2
+MAX_BUDGET_MS = 200
+# Long texts are inserted in pieces of at most this many characters
+SLICE_CHARS = 2000
+# Delay between slices (ms), long enough for Tk to handle input and redraw
+YIELD_MS = 1
+
+
+# Functions
+
+def clamp_budget(value):
+    try:
+        return max(MIN_BUDGET_MS, min(MAX_BUDGET_MS, int(value)))
+    except Exception:
+        return DEFAULT_BUDGET_MS
+
+
+class ChunkedRenderer:
+    # Inserts (text, tag) segments at the end of a Text widget a slice at a
+    # time. replace() starts over (clearing the widget), append() queues
+    # segments behind whatever is still being inserted so order is kept
+
+    def __init__(self, widget, budget_ms: int = DEFAULT_BUDGET_MS):
+        self.widget = widget
+        self.budget_ms = clamp_budget(budget_ms)
+        self.generation = 0
+        self._sources = deque()
+        self._pending = None
+        self._job = None
+        self._callbacks = []
+        self._follow = True
+        self.slices = 0
+
+    def set_budget(self, budget_ms):
+        self.budget_ms = clamp_budget(budget_ms)
+
+    def busy(self):
+        return self._job is not None or bool(self._sources) or self._pending is not None
+
+    def cancel(self):
+        # Drop everything not inserted yet; completion callbacks are not called
+        self.generation += 1
+        if self._job is not None:
+            try:
+                self.widget.after_cancel(self._job)
+            except Exception:
+                pass
+            self._job = None
+        self._sources.clear()
+        self._pending = None
+        self._callbacks = []
+
+    def replace(self, segments, on_done=None):
+        # Clear the widget and insert segments (any iterable, consumed lazily)
+        self.cancel()
+        try:
+            self.widget.config(state='normal')
+            self.widget.delete('1.0', 'end')
+            self.widget.config(state='disabled')
+        except Exception:
+            pass
+        self._follow = True
+        self._sources.append(iter(segments))
+        if on_done is not None:
+            self._callbacks.append(on_done)
+        self._schedule(self.generation)
+
+    def append(self, segments, on_done=None):
+        # Queue segments after the current content. When nothing is pending
+        # the first slice goes in immediately, so short messages appear at once
+        idle = not self.busy()
+        if idle:
+            self._follow = self._at_bottom()
+        self._sources.append(iter(list(segments)))
+        if on_done is not None:
+            self._callbacks.append(on_done)
+        if idle:
+            self._step(self.generation)
+
+    def _at_bottom(self):
+        try:
+            return self.widget.yview()[1] >= 0.999
+        except Exception:
+            return True
+
+    def _schedule(self, generation):
+        try:
+            self._job = self.widget.after(YIELD_MS, lambda: self._step(generation))
+        except Exception:
+            self._job = None
+
+    def _next_segment(self):
+        if self._pending is not None:
+            segment, self._pending = self._pending, None
+            return segment
+        while self._sources:
+            try:
+                return next(self._sources[0])
+            except StopIteration:
+                self._sources.popleft()
+        return None
+
+    def _step(self, generation):
+        self._job = None
+        if generation != self.generation:
+            return
+        # A user who scrolled up while we were inserting keeps their position
+        if self._follow and not self._at_bottom():
+            self._follow = False
+        deadline = time.perf_counter() + self.budget_ms / 1000.0
+        try:
+            self.widget.config(state='normal')
+            while True:
+                segment = self._next_segment()
+                if segment is None:
+                    break
+                text, tag = segment
+                if len(text) > SLICE_CHARS:
+                    # Split at a line/space boundary near the limit when there is one
+                    cut = max(text.rfind('\n', 0, SLICE_CHARS), text.rfind(' ', 0, SLICE_CHARS)) + 1 or SLICE_CHARS
+                    text, self._pending = text[:cut], (text[cut:], tag)
+                if tag:
+                    self.widget.insert('end', text, tag)
+                else:
+                    self.widget.insert('end', text)
+                if time.perf_counter() >= deadline:
+                    break
+            if self._follow:
+                self.widget.see('end')
+        finally:
+            try:
+                self.widget.config(state='disabled')
+            except Exception:
+                pass
+        self.slices += 1
+        if self._pending is not None or self._sources:
+            self._schedule(generation)
+            return
+        callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception:
+                pass
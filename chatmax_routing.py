@@ -0,0 +1,417 @@
+# File:        chatmax_routing.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Multi-endpoint routing for Chat Max server mode. Requests go to
+#              the healthiest, lowest-latency endpoint; endpoints that keep
+#              failing trip a circuit breaker and are skipped until a cooldown
+#              passes, and failed requests transparently fail over to the next
+#              endpoint. Lightweight background health checks keep the state
+#              current when several endpoints are configured. Optionally, slow
+#              requests are hedged: a duplicate goes out once the observed p95
+#              has passed and whichever reply arrives first is used.
+
+
+# Imports
+
+# Recent hedging decisions for the rate cap
+from collections import deque
+# Results handed back from hedged attempts
+import queue
+# Comma/whitespace separated endpoint lists
+import re
+# Locking and the background health-check thread
+import threading
+# Latency measurement and breaker cooldowns
+import time
+
+
+# Constants
+
+# Consecutive failures that open an endpoint's circuit
+FAILURE_THRESHOLD = 3
+# Seconds an open circuit stays open before a trial request is allowed
+COOLDOWN_S = 30.0
+# Seconds between background health checks
+PROBE_INTERVAL_S = 15.0
+# Timeout for a single health check
+PROBE_TIMEOUT_S = 3.0
+# Weight of the newest sample in the latency moving average
+EWMA_ALPHA = 0.3
+
+# Hedging policy defaults, overridable via settings.json 'hedge_policy'
+DEFAULT_HEDGE_POLICY = {
+    'enabled': False,
+    # Send the duplicate once this percentile of observed latency has passed
+    'percentile': 95.0,
+    # Never hedge sooner than this (seconds)
+    'min_delay_s': 0.5,
+    # At most this fraction of recent requests may be hedged
+    'max_rate': 0.1,
+}
+# Number of recent requests the hedge rate cap looks at
+HEDGE_WINDOW = 100
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+# Functions
+
+def parse_endpoints(value):
+    # Accept a single URL, a comma/whitespace separated string or a list, without duplicates
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        parts = [str(v) for v in value]
+    else:
+        parts = re.split(r'[\s,]+', str(value))
+    out = []
+    for p in parts:
+        p = p.strip()
+        if p and p not in out:
+            out.append(p)
+    return out
+
+
+def is_failover_error(exc: Exception):
+    # Only failures that are the endpoint's fault are retried elsewhere:
+    # connection errors, timeouts and 5xx. A 429 goes back to the shared rate
+    # limiter (which waits out Retry-After) and does not count against the
+    # breaker; other HTTP errors (bad request, auth) and bugs in the caller
+    # (TypeError, KeyError...) are not retried either
+    import requests
+    if isinstance(exc, requests.HTTPError):
+        status = getattr(exc.response, 'status_code', None)
+        return status is not None and status >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                            ConnectionError, TimeoutError))
+
+
+def merge_hedge_policy(policy: dict | None):
+    merged = dict(DEFAULT_HEDGE_POLICY)
+    if isinstance(policy, dict):
+        for k, default in DEFAULT_HEDGE_POLICY.items():
+            try:
+                if policy.get(k) is not None:
+                    merged[k] = type(default)(policy[k])
+            except Exception:
+                pass
+    merged['percentile'] = max(50.0, min(99.9, merged['percentile']))
+    merged['max_rate'] = max(0.0, min(1.0, merged['max_rate']))
+    return merged
+
+
+class HedgeStats:
+    # Counts of hedged requests and which attempt won, plus the rate cap
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self.requests = 0
+            self.hedged = 0
+            self.hedge_wins = 0
+            self.primary_wins = 0
+            self.suppressed = 0
+
+    def record_request(self):
+        # Returns the request's slot in the window, handed back to try_hedge()
+        slot = [False]
+        with self._lock:
+            self.requests += 1
+            self._recent.append(slot)
+        return slot
+
+    def try_hedge(self, max_rate: float, slot: list):
+        # Claim a hedge for the request owning `slot` if the recent hedge rate
+        # allows one (always allows the first)
+        with self._lock:
+            if slot[0]:
+                return False
+            if sum(s[0] for s in self._recent) + 1 > max(1.0, max_rate * len(self._recent)):
+                self.suppressed += 1
+                return False
+            slot[0] = True
+            self.hedged += 1
+            return True
+
+    def record_winner(self, hedge_won: bool):
+        with self._lock:
+            if hedge_won:
+                self.hedge_wins += 1
+            else:
+                self.primary_wins += 1
+
+    def summary(self):
+        with self._lock:
+            decided = self.hedge_wins + self.primary_wins
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+                'hedge_wins': self.hedge_wins,
+                'primary_wins': self.primary_wins,
+                'win_rate': self.hedge_wins / decided if decided else 0.0,
+                'suppressed': self.suppressed,
+            }
+
+
+# Process-wide hedging counters shown in Diagnostics
+HEDGES = HedgeStats()
+
+
+class EndpointState:
+    # Health and latency bookkeeping for one endpoint
+
+    def __init__(self, url: str):
+        self.url = url
+        self.state = CLOSED
+        self.ewma_s = None
+        self.probe_s = None
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.opened_at = None
+        self.last_error = None
+        # A half-open endpoint's single trial request is under way
+        self.trial_in_flight = False
+
+    def available(self, now: float):
+        if self.state == OPEN and now - self.opened_at >= COOLDOWN_S:
+            # Cooldown over: let one trial request through
+            self.state = HALF_OPEN
+            self.trial_in_flight = False
+        # While the trial runs the endpoint ranks with the tripped ones
+        return self.state == CLOSED or (self.state == HALF_OPEN and not self.trial_in_flight)
+
+    def score(self):
+        # Lower is better: currently failing endpoints last, then untried
+        # endpoints (so each gets measured), then by average latency
+        if self.ewma_s is None:
+            return (self.consecutive_failures, 0, self.probe_s or 0.0)
+        return (self.consecutive_failures, 1, self.ewma_s)
+
+
+class EndpointPool:
+    # Routes calls across several endpoints with failover and circuit breaking
+
+    def __init__(self, urls):
+        self.endpoints = [EndpointState(u) for u in parse_endpoints(urls)]
+        self._lock = threading.Lock()
+        self._prober = None
+        self._stop = threading.Event()
+
+    @property
+    def urls(self):
+        return [e.url for e in self.endpoints]
+
+    def _get(self, url: str):
+        for e in self.endpoints:
+            if e.url == url:
+                return e
+        return None
+
+    def candidates(self):
+        # Healthy endpoints best-first, then open ones (oldest first) as a last resort
+        now = time.monotonic()
+        with self._lock:
+            ready = [e for e in self.endpoints if e.available(now)]
+            ready.sort(key=lambda e: e.score())
+            tripped = sorted((e for e in self.endpoints if e not in ready), key=lambda e: e.opened_at)
+            return [e.url for e in ready + tripped]
+
+    def record_success(self, url: str, seconds: float | None = None):
+        with self._lock:
+            e = self._get(url)
+            if e is None:
+                return
+            e.state = CLOSED
+            e.trial_in_flight = False
+            e.consecutive_failures = 0
+            e.successes += 1
+            if seconds is not None:
+                e.ewma_s = seconds if e.ewma_s is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * e.ewma_s
+
+    def record_failure(self, url: str, error: Exception | None = None):
+        with self._lock:
+            e = self._get(url)
+            if e is None:
+                return
+            e.failures += 1
+            e.consecutive_failures += 1
+            e.trial_in_flight = False
+            e.last_error = str(error) if error is not None else None
+            # A failed trial request re-opens immediately
+            if e.state == HALF_OPEN or e.consecutive_failures >= FAILURE_THRESHOLD:
+                e.state = OPEN
+                e.opened_at = time.monotonic()
+
+    def _attempt(self, fn, url: str):
+        # fn(url), claiming the endpoint's trial if its breaker is half-open so
+        # concurrent callers rank it with the tripped ones until the result is in
+        with self._lock:
+            e = self._get(url)
+            if e is not None and e.state == HALF_OPEN and not e.trial_in_flight:
+                e.trial_in_flight = True
+        try:
+            return fn(url)
+        except Exception as exc:
+            if not is_failover_error(exc):
+                # Answered but refused (not the endpoint's fault): another trial may go
+                with self._lock:
+                    if e is not None:
+                        e.trial_in_flight = False
+            raise
+
+    def call(self, fn):
+        # fn(url) performs the request, try endpoints until one succeeds
+        urls = self.candidates()
+        if not urls:
+            raise RuntimeError('No server endpoint configured')
+        return self._call_in_turn(fn, urls)
+
+    def _call_in_turn(self, fn, urls: list, last_error: Exception | None = None):
+        for url in urls:
+            started = time.perf_counter()
+            try:
+                result = self._attempt(fn, url)
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+                self.record_failure(url, e)
+                last_error = e
+                continue
+            self.record_success(url, time.perf_counter() - started)
+            return result
+        raise last_error
+
+    def hedged_call(self, fn, hedge_after_s: float, max_rate: float = DEFAULT_HEDGE_POLICY['max_rate'], stats: HedgeStats = HEDGES):
+        # Like call(), but if the first attempt has not answered after
+        # hedge_after_s a duplicate goes to the next endpoint (or the same one)
+        # and the first successful reply wins. The losing attempt cannot be
+        # aborted mid-request, its result is discarded when it completes
+        urls = self.candidates()
+        if not urls:
+            raise RuntimeError('No server endpoint configured')
+        slot = stats.record_request()
+        results = queue.Queue()
+
+        def attempt(url, hedge):
+            started = time.perf_counter()
+            try:
+                results.put((url, hedge, self._attempt(fn, url), None, time.perf_counter() - started))
+            except Exception as e:
+                results.put((url, hedge, None, e, None))
+
+        threading.Thread(target=attempt, args=(urls[0], False), daemon=True).start()
+        tried = [urls[0]]
+        pending = 1
+        hedged = False
+        hedge_sent = False
+        last_error = None
+        while pending:
+            try:
+                url, hedge, result, error, elapsed = results.get(timeout=None if hedged else hedge_after_s)
+            except queue.Empty:
+                hedged = True
+                if stats.try_hedge(max_rate, slot):
+                    target = urls[1] if len(urls) > 1 else urls[0]
+                    tried.append(target)
+                    threading.Thread(target=attempt, args=(target, True), daemon=True).start()
+                    pending += 1
+                    hedge_sent = True
+                continue
+            pending -= 1
+            if error is None:
+                self.record_success(url, elapsed)
+                if hedge_sent:
+                    stats.record_winner(hedge)
+                return result
+            if not is_failover_error(error):
+                raise error
+            self.record_failure(url, error)
+            last_error = error
+        # Every attempt failed (the first one before the hedge was due, the
+        # hedge was capped, or both failed): fail over in turn to the
+        # endpoints not tried yet, never back to one that just failed
+        remaining = [u for u in urls if u not in tried]
+        if not remaining:
+            raise last_error
+        return self._call_in_turn(fn, remaining, last_error)
+
+    def probe(self, url: str):
+        # Any HTTP answer below 500 means the server is up (the contract only
+        # defines POST, so 404/405 on GET are fine) and measures round-trip
+        # time, but only a 2xx answer closes a tripped breaker
+        import requests
+        started = time.perf_counter()
+        try:
+            resp = requests.get(url, timeout=PROBE_TIMEOUT_S)
+            ok = resp.status_code < 500
+        except Exception as e:
+            self.record_failure(url, e)
+            return False
+        elapsed = time.perf_counter() - started
+        if not ok:
+            self.record_failure(url, RuntimeError(f'health check returned {resp.status_code}'))
+            return False
+        with self._lock:
+            e = self._get(url)
+            if e is not None:
+                e.probe_s = elapsed
+                if e.state != CLOSED and 200 <= resp.status_code < 300:
+                    # Recovered: close the breaker without touching call latency
+                    e.state = CLOSED
+                    e.trial_in_flight = False
+                    e.consecutive_failures = 0
+        return True
+
+    def probe_all(self):
+        return {url: self.probe(url) for url in self.urls}
+
+    def start_health_checks(self, interval_s: float = PROBE_INTERVAL_S):
+        # Only worthwhile with more than one endpoint to choose between
+        if self._prober is not None or len(self.endpoints) < 2:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    self.probe_all()
+                except Exception:
+                    pass
+                self._stop.wait(interval_s)
+
+        self._prober = threading.Thread(target=loop, name='chatmax-health', daemon=True)
+        self._prober.start()
+
+    def stop_health_checks(self):
+        self._stop.set()
+
+    def status_rows(self):
+        # (url, state, average call latency s, probe rtt s, successes, failures, last error)
+        with self._lock:
+            return [(e.url, e.state, e.ewma_s, e.probe_s, e.successes, e.failures, e.last_error) for e in self.endpoints]
+
+
+# Pools are shared per endpoint list so the GUI and headless sessions agree on health
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_endpoint_pool(urls):
+    key = tuple(parse_endpoints(urls))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = EndpointPool(key)
+            _pools[key] = pool
+            pool.start_health_checks()
+        return pool
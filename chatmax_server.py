@@ -0,0 +1,390 @@
+# File:        chatmax_server.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Reference endpoint server for Chat Max server mode. Implements
+#              the contract call_server_api() speaks (POST {"messages": [...]}
+#              -> {"response": "..."}, GET for health checks), plus gzip request
+#              bodies and the delta-sync protocol. One asyncio event loop
+#              serves every client over keep-alive connections; upstream calls
+#              share a pooled client and are bounded by a semaphore, requests
+#              beyond the queue limit get 503 + Retry-After, and identical
+#              payloads in flight at the same time share one upstream call.
+#              The upstream is pluggable: OpenAI, or a deterministic fake for
+#              tests and load runs.
+#
+#              Run:  python chatmax_server.py --upstream fake --port 8000
+#                    python chatmax_server.py --upstream openai --model gpt-4o-mini   (OPENAI_API_KEY)
+
+
+# Imports
+
+# Event loop, streams and locks
+import asyncio
+# Command line
+import argparse
+# Request/response encoding
+import gzip
+import hashlib
+import json
+# OS for the environment (API key)
+import os
+# Exit codes
+import sys
+# Uptime and fake latency
+import time
+# Default model and connection keep-alive shared with the client
+from chatmax_engine import DEFAULT_AI_MODEL, KEEPALIVE_S
+# Server-side conversation cache for delta-sync requests
+from chatmax_sync import DeltaCache, ResyncNeeded, RESYNC_STATUS
+# Prompt size estimate for the fake upstream's usage
+from chatmax_ratelimit import CHARS_PER_TOKEN
+
+
+# Constants
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+# Upstream calls running at once
+DEFAULT_CONCURRENCY = 32
+# Requests waiting for an upstream slot before new ones are refused with 503
+DEFAULT_MAX_QUEUE = 256
+# Seconds a refused client is asked to wait
+RETRY_AFTER_S = 2
+# Largest accepted request body (decompressed)
+MAX_BODY_BYTES = 8 * 1024 * 1024
+# Idle keep-alive connections are closed after this many seconds
+IDLE_TIMEOUT_S = KEEPALIVE_S
+# Upstream request timeout
+UPSTREAM_TIMEOUT_S = 120.0
+# Responses smaller than this are not gzip'd even when the client accepts it
+GZIP_MIN_BYTES = 1024
+# Fake upstream defaults: fixed latency plus streaming time at a token rate
+FAKE_LATENCY_S = 0.05
+FAKE_TOKENS_PER_S = 0.0
+FAKE_REPLY_WORDS = 40
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+           411: 'Length Required', 413: 'Payload Too Large', 415: 'Unsupported Media Type', 500: 'Internal Server Error',
+           502: 'Bad Gateway', 503: 'Service Unavailable'}
+
+
+# Functions
+
+def payload_key(messages: list):
+    # Identical payloads (same messages in the same order) share one upstream call
+    data = json.dumps(messages, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class FakeUpstream:
+    # Deterministic replies: the same messages always get the same answer,
+    # after `latency_s` plus the reply's tokens at `tokens_per_s` (0 = instant)
+
+    name = 'fake'
+
+    def __init__(self, latency_s: float = FAKE_LATENCY_S, tokens_per_s: float = FAKE_TOKENS_PER_S, reply_words: int = FAKE_REPLY_WORDS):
+        self.latency_s = max(0.0, latency_s)
+        self.tokens_per_s = max(0.0, tokens_per_s)
+        self.reply_words = max(1, reply_words)
+
+    def reply_for(self, messages: list):
+        digest = payload_key(messages)[:12]
+        last = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '')
+        words = [f'w{int(digest[i % 12], 16)}' for i in range(self.reply_words - 1)]
+        return f"[{digest}] {' '.join(words)} re: {last[:60]}"
+
+    async def complete(self, messages: list):
+        reply = self.reply_for(messages)
+        completion = max(1, len(reply) // CHARS_PER_TOKEN)
+        delay = self.latency_s + (completion / self.tokens_per_s if self.tokens_per_s else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        prompt = sum(len(m.get('content') or '') for m in messages) // CHARS_PER_TOKEN + 4 * len(messages)
+        usage = {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+        return {'response': reply, 'model': 'fake', 'usage': usage}
+
+    async def close(self):
+        pass
+
+
+class OpenAIUpstream:
+    # Chat Completions through one AsyncOpenAI client whose httpx pool keeps
+    # `pool_size` connections open to the API
+
+    name = 'openai'
+
+    def __init__(self, api_key: str, model: str = DEFAULT_AI_MODEL, pool_size: int = DEFAULT_CONCURRENCY, timeout_s: float = UPSTREAM_TIMEOUT_S):
+        # Imported here so the fake upstream works without openai installed
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=KEEPALIVE_S)
+        self.client = AsyncOpenAI(api_key=api_key, timeout=timeout_s, http_client=DefaultAsyncHttpxClient(limits=limits))
+        self.model = model
+
+    async def complete(self, messages: list):
+        kwargs = {'model': self.model, 'messages': messages}
+        if self.model.startswith('gpt-5'):
+            kwargs['reasoning_effort'] = 'minimal'
+            kwargs['verbosity'] = 'low'
+        response = await self.client.chat.completions.create(**kwargs)
+        usage = getattr(response, 'usage', None)
+        try:
+            usage = usage.model_dump() if usage is not None else None
+        except Exception:
+            usage = None
+        return {'response': response.choices[0].message.content or '', 'model': getattr(response, 'model', None) or self.model, 'usage': usage}
+
+    async def close(self):
+        try:
+            await self.client.close()
+        except Exception:
+            pass
+
+
+class HttpError(Exception):
+
+    def __init__(self, status: int, message: str = '', headers: dict | None = None, body: dict | None = None):
+        super().__init__(message or REASONS.get(status, ''))
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+
+
+class ChatServer:
+    # Serves the server-mode contract on one event loop
+
+    def __init__(self, upstream, concurrency: int = DEFAULT_CONCURRENCY, max_queue: int = DEFAULT_MAX_QUEUE, cache: DeltaCache | None = None):
+        self.upstream = upstream
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.cache = cache or DeltaCache()
+        self.started = time.monotonic()
+        self._slots = None
+        self._inflight = {}
+        self._waiting = 0
+        self._server = None
+        self.stats = {'requests': 0, 'upstream_calls': 0, 'coalesced': 0, 'rejected': 0, 'resyncs': 0, 'errors': 0, 'connections': 0}
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def serve_forever(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.upstream.close()
+
+    def summary(self):
+        return dict(self.stats, in_flight=len(self._inflight), waiting=self._waiting, cached_conversations=len(self.cache),
+                    upstream=self.upstream.name, uptime_s=round(time.monotonic() - self.started, 1))
+
+    # Upstream
+
+    async def complete(self, messages: list):
+        # (result, shared) for a payload: joins an identical call already in
+        # flight, otherwise waits for a slot (or refuses when the queue is full)
+        key = payload_key(messages)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future), True
+        if self._slots.locked() and self._waiting >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise HttpError(503, 'Server busy', {'Retry-After': str(RETRY_AFTER_S)})
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self._waiting += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                self._waiting -= 1
+            try:
+                self.stats['upstream_calls'] += 1
+                result = await self.upstream.complete(messages)
+            finally:
+                self._slots.release()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e if isinstance(e, Exception) else HttpError(503, 'Request cancelled'))
+                # Retrieved here so an exception nobody joined is not reported as unhandled
+                future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def chat(self, body):
+        if not isinstance(body, dict):
+            raise HttpError(400, 'Expected a JSON object')
+        if 'messages' not in body and not isinstance(body.get('sync'), dict):
+            raise HttpError(400, "'messages' is required")
+        try:
+            messages, cid = self.cache.resolve(body)
+        except ResyncNeeded:
+            self.stats['resyncs'] += 1
+            raise HttpError(RESYNC_STATUS, 'Conversation not cached', body={'sync': {'status': 'resync'}})
+        if not isinstance(messages, list) or not messages:
+            raise HttpError(400, "'messages' must be a non-empty list")
+        try:
+            result, shared = await self.complete(messages)
+        except HttpError:
+            raise
+        except Exception as e:
+            status = getattr(e, 'status_code', None)
+            raise HttpError(status if status in (400, 429) else 502, f'Upstream error: {e}')
+        out = {'response': result.get('response', ''), 'model': result.get('model')}
+        # Coalesced callers did not cost anything extra, only the leader reports usage
+        if result.get('usage') and not shared:
+            out['usage'] = result['usage']
+        seq = self.cache.record_reply(cid, out['response'])
+        if seq is not None:
+            out['sync'] = {'status': 'ok', 'seq': seq}
+        return out
+
+    # HTTP
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), IDLE_TIMEOUT_S)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except HttpError as e:
+                    await self._respond(writer, e.status, {'error': str(e)}, e.headers, False, False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body, keep_alive = request
+                accept_gzip = 'gzip' in headers.get('accept-encoding', '')
+                extra = {}
+                try:
+                    status, data = 200, await self._route(method, path, headers, body)
+                except HttpError as e:
+                    status, data, extra = e.status, e.body or {'error': str(e)}, e.headers
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    status, data = 500, {'error': str(e)}
+                await self._respond(writer, status, data, extra, keep_alive, accept_gzip)
+                if not keep_alive:
+                    break
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, path, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, 'Malformed request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        body = b''
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HttpError(411, 'Chunked bodies are not supported')
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413)
+        if length:
+            body = await reader.readexactly(length)
+        return method.upper(), path, headers, body, keep_alive
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes):
+        if method == 'GET':
+            # Health checks and warm-up requests from the client
+            return {'status': 'ok', **self.summary()}
+        if method != 'POST':
+            raise HttpError(405)
+        self.stats['requests'] += 1
+        encoding = headers.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            try:
+                body = gzip.decompress(body)
+            except Exception:
+                raise HttpError(400, 'Invalid gzip body')
+            if len(body) > MAX_BODY_BYTES:
+                raise HttpError(413)
+        elif encoding not in ('', 'identity'):
+            raise HttpError(415, f'Unsupported Content-Encoding {encoding}')
+        try:
+            parsed = json.loads(body)
+        except Exception:
+            raise HttpError(400, 'Invalid JSON')
+        return await self.chat(parsed)
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, data: dict, extra: dict, keep_alive: bool, accept_gzip: bool):
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive' if keep_alive else 'close'}
+        if accept_gzip and len(payload) >= GZIP_MIN_BYTES:
+            payload = gzip.compress(payload, compresslevel=6, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(payload))
+        headers.update(extra or {})
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n" + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+        try:
+            writer.write(head.encode('latin-1') + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def build_upstream(args):
+    if args.upstream == 'fake':
+        return FakeUpstream(args.fake_latency, args.fake_tokens_per_s, args.fake_reply_words)
+    api_key = args.api_key or os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise SystemExit('chatmax_server: --api-key or OPENAI_API_KEY is required for the openai upstream')
+    return OpenAIUpstream(api_key, args.model, args.concurrency)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='Reference Chat Max server-mode endpoint (asyncio).')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--upstream', choices=['fake', 'openai'], default='fake', help='where replies come from')
+    parser.add_argument('--model', default=DEFAULT_AI_MODEL, help='OpenAI model (openai upstream)')
+    parser.add_argument('--api-key', help='OpenAI API key (default: OPENAI_API_KEY)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='upstream calls at once (also the connection pool size)')
+    parser.add_argument('--max-queue', type=int, default=DEFAULT_MAX_QUEUE, help='requests waiting for a slot before 503 is returned')
+    parser.add_argument('--fake-latency', type=float, default=FAKE_LATENCY_S, help='fake upstream: seconds before a reply')
+    parser.add_argument('--fake-tokens-per-s', type=float, default=FAKE_TOKENS_PER_S, help='fake upstream: reply token rate (0 = instant)')
+    parser.add_argument('--fake-reply-words', type=int, default=FAKE_REPLY_WORDS, help='fake upstream: words per reply')
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    server = ChatServer(build_upstream(args), args.concurrency, args.max_queue)
+    print(f'[server] {server.upstream.name} upstream on http://{args.host}:{args.port}/ '
+          f'({server.concurrency} concurrent, queue {server.max_queue})', file=sys.stderr)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    print(f'[server] {json.dumps(server.summary())}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+# File:        chatmax_sync.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Opt-in delta-sync protocol for Chat Max server mode. Instead of
+#              re-sending the whole trimmed history every turn, the client
+#              sends a conversation id, the sequence number the server is
+#              known to be at and only the messages it has not seen; the
+#              server rebuilds the context from its own cache. A server that
+#              lost (or never had) the conversation answers 409 and the client
+#              falls back to the full legacy payload, which also re-seeds the
+#              server's cache. Servers that do not speak the protocol ignore
+#              the extra 'sync' field and are then only sent legacy payloads.
+#
+#              Full request:   {"messages": [...], "sync": {"version", "conversation_id"}}
+#              Delta request:  {"append": [...new messages...], "system": [...] (only when changed),
+#                               "sync": {"version", "conversation_id", "base_seq", "window", "system_hash"}}
+#              Reply:          {"response": "...", "sync": {"status": "ok", "seq": n}}
+#              Cache miss:     HTTP 409 {"sync": {"status": "resync"}}
+
+
+# Imports
+
+# System-message fingerprints
+import hashlib
+import json
+# Least-recently-used server cache
+from collections import OrderedDict
+# Locking shared by worker threads
+import threading
+# Server cache expiry
+import time
+
+
+# Constants
+
+# Protocol version carried in every 'sync' object
+SYNC_VERSION = 1
+# HTTP status a server answers when it cannot apply a delta
+RESYNC_STATUS = 409
+# Messages of a conversation remembered per endpoint (client) and per conversation (server)
+TAIL_MAX = 200
+# Server cache limits
+CACHE_CONVERSATIONS = 1000
+CACHE_TTL_S = 3600.0
+
+
+# Functions
+
+def system_hash(system_messages: list):
+    data = json.dumps(system_messages, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def split_payload(payload: list):
+    # (leading system messages, conversation messages) of a legacy payload
+    system, rest = [], []
+    for m in payload:
+        if not rest and m.get('role') == 'system':
+            system.append({'role': 'system', 'content': m.get('content', '')})
+        else:
+            rest.append({'role': m.get('role'), 'content': m.get('content', '')})
+    return system, rest
+
+
+class ResyncNeeded(Exception):
+    # Raised by the server cache when a delta cannot be applied
+    pass
+
+
+class SyncState:
+    # What the client believes one endpoint holds for one conversation
+
+    def __init__(self, seq: int, tail: list, system_hash_: str):
+        self.seq = seq
+        self.tail = tail
+        self.system_hash = system_hash_
+
+
+class DeltaClient:
+    # Client side: per (endpoint, conversation) sync state and counters
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+        self._unsupported = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.delta = 0
+            self.full = 0
+            self.resyncs = 0
+
+    def supported(self, url: str):
+        with self._lock:
+            return url not in self._unsupported
+
+    def mark_unsupported(self, url: str):
+        with self._lock:
+            self._unsupported.add(url)
+            for key in [k for k in self._states if k[0] == url]:
+                del self._states[key]
+
+    def forget(self, url: str, conversation_id: str):
+        with self._lock:
+            self._states.pop((url, conversation_id), None)
+
+    def build(self, url: str, conversation_id: str, payload: list, force_full: bool = False):
+        # (request body, pending) for a turn; pending is handed back to commit()
+        system, rest = split_payload(payload)
+        h = system_hash(system)
+        with self._lock:
+            state = None if force_full else self._states.get((url, conversation_id))
+        append = self._new_messages(state, rest) if state is not None else None
+        sync = {'version': SYNC_VERSION, 'conversation_id': conversation_id}
+        if append is None:
+            body = {'messages': payload, 'sync': sync}
+            return body, {'kind': 'full', 'rest': rest, 'hash': h}
+        sync.update({'base_seq': state.seq, 'window': len(rest), 'system_hash': h})
+        body = {'append': append, 'sync': sync}
+        if h != state.system_hash:
+            body['system'] = system
+        return body, {'kind': 'delta', 'rest': rest, 'hash': h, 'append': append}
+
+    @staticmethod
+    def _new_messages(state: SyncState, window: list):
+        # The shortest suffix of the window that, appended to what the server
+        # holds, reproduces the window (the worst case resends the window but
+        # still skips the system messages); None for an empty window
+        tail = state.tail
+        n = len(window)
+        for k in range(1, n + 1):
+            head = window[:n - k]
+            if len(head) <= len(tail) and tail[len(tail) - len(head):] == head:
+                return window[n - k:]
+        return None
+
+    def commit(self, url: str, conversation_id: str, pending: dict, reply: str, server_seq):
+        # A turn succeeded: remember what the server now holds
+        if server_seq is None:
+            return
+        with self._lock:
+            if pending['kind'] == 'full':
+                self.full += 1
+                tail = list(pending['rest'])
+            else:
+                self.delta += 1
+                old = self._states.get((url, conversation_id))
+                tail = (old.tail if old is not None else []) + list(pending['append'])
+            tail.append({'role': 'assistant', 'content': reply})
+            self._states[(url, conversation_id)] = SyncState(int(server_seq), tail[-TAIL_MAX:], pending['hash'])
+
+    def record_resync(self, url: str, conversation_id: str):
+        with self._lock:
+            self.resyncs += 1
+            self._states.pop((url, conversation_id), None)
+
+    def summary(self):
+        with self._lock:
+            return {'delta': self.delta, 'full': self.full, 'resyncs': self.resyncs, 'unsupported': len(self._unsupported)}
+
+
+# Process-wide client state used by server-mode calls
+SYNC = DeltaClient()
+
+
+class DeltaCache:
+    # Server side: conversations keyed by id, least recently used evicted.
+    # resolve() turns a request body into the full message list for the model,
+    # record_reply() stores the model's answer and returns the new sequence number
+
+    def __init__(self, max_conversations: int = CACHE_CONVERSATIONS, ttl_s: float = CACHE_TTL_S):
+        self.max_conversations = max_conversations
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, body: dict):
+        # (messages for the model, conversation id or None). Raises
+        # ResyncNeeded when a delta does not match the cached conversation
+        sync = body.get('sync') if isinstance(body.get('sync'), dict) else None
+        cid = sync.get('conversation_id') if sync else None
+        if 'messages' in body:
+            messages = body.get('messages') or []
+            if cid:
+                system, rest = split_payload(messages)
+                self._store(cid, {'system': system, 'hash': system_hash(system), 'messages': rest[-TAIL_MAX:], 'seq': len(rest)})
+            return messages, cid
+        if not cid:
+            raise ResyncNeeded('delta request without a conversation id')
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cid)
+            if entry is None or now - entry['used'] > self.ttl_s or entry['seq'] != sync.get('base_seq'):
+                self.misses += 1
+                raise ResyncNeeded('conversation not cached or out of date')
+            if 'system' in body:
+                entry['system'] = body['system'] or []
+                entry['hash'] = system_hash(entry['system'])
+            elif entry['hash'] != sync.get('system_hash'):
+                self.misses += 1
+                raise ResyncNeeded('system messages changed')
+            append = body.get('append') or []
+            entry['messages'] = (entry['messages'] + append)[-TAIL_MAX:]
+            entry['seq'] += len(append)
+            entry['used'] = now
+            self._entries.move_to_end(cid)
+            self.hits += 1
+            window = int(sync.get('window') or len(append))
+            return entry['system'] + entry['messages'][-window:], cid
+
+    def record_reply(self, cid: str | None, reply: str):
+        if not cid:
+            return None
+        with self._lock:
+            entry = self._entries.get(cid)
+            if entry is None:
+                return None
+            entry['messages'] = (entry['messages'] + [{'role': 'assistant', 'content': reply}])[-TAIL_MAX:]
+            entry['seq'] += 1
+            entry['used'] = time.monotonic()
+            return entry['seq']
+
+    def _store(self, cid: str, entry: dict):
+        entry['used'] = time.monotonic()
+        with self._lock:
+            self._entries[cid] = entry
+            self._entries.move_to_end(cid)
+            while len(self._entries) > self.max_conversations:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,214 @@
+# File:        chatmax_trace.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Lightweight per-request latency tracing for Chat Max. Each
+#              turn gets a Trace made of timed stage spans (payload build,
+#              preference file I/O, extraction call, main call, JSON decoding,
+#              rendering). Finished traces are kept in a ring buffer that can
+#              report p50/p95 per stage and per model and export to JSON.
+
+
+# Imports
+
+# JSON export of traces
+import json
+# Ring buffer of recent traces
+from collections import deque
+# Span context managers
+from contextlib import contextmanager
+# Thread-local active trace and buffer locking
+import threading
+# Monotonic timings and wall-clock trace start
+import time
+
+
+# Constants
+
+# Number of recent traces kept in memory
+TRACE_CAPACITY = 200
+
+# Stage names, in pipeline order (used for display ordering)
+STAGE_PAYLOAD = 'payload_build'
+STAGE_PREFS_IO = 'prefs_io'
+STAGE_EXTRACTION = 'extraction_call'
+STAGE_MAIN_CALL = 'main_call'
+STAGE_JSON_DECODE = 'json_decode'
+STAGE_RENDER = 'render'
+STAGE_TOTAL = 'total'
+STAGES = [STAGE_PAYLOAD, STAGE_PREFS_IO, STAGE_EXTRACTION, STAGE_MAIN_CALL, STAGE_JSON_DECODE, STAGE_RENDER, STAGE_TOTAL]
+
+# The trace that spans on the current thread are recorded against
+_active = threading.local()
+
+
+# Functions
+
+def percentile(values, pct: float):
+    # Nearest-rank percentile of an iterable of numbers (None when empty)
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, int(-(-pct * len(ordered) // 100)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Trace:
+    # Timing record for one turn, spans are (stage, offset_ms, duration_ms)
+
+    def __init__(self, kind: str = 'turn', backend: str | None = None, model: str | None = None, preset: str | None = None):
+        self.kind = kind
+        self.backend = backend
+        self.model = model
+        self.preset = preset
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.spans = []
+        self.total_ms = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    @property
+    def model_key(self):
+        # Groups traces by where they were served, e.g. 'local:gpt-5-nano' or 'server'
+        if self.backend == 'local':
+            return f'local:{self.model}'
+        return self.backend or 'unknown'
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(stage, start, time.perf_counter())
+
+    def record_span(self, stage: str, start: float, end: float):
+        # For stages that do not fit a with-block (e.g. a render finishing in a later Tk callback)
+        with self._lock:
+            self.spans.append((stage, round((start - self._t0) * 1000, 3), round((end - start) * 1000, 3)))
+
+    def stage_totals(self):
+        # A stage may run several times per turn (e.g. preference I/O), sum them
+        totals = {}
+        for stage, _, duration in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + duration
+        if self.total_ms is not None:
+            totals[STAGE_TOTAL] = self.total_ms
+        return totals
+
+    def finish(self, error: str | None = None):
+        if self.total_ms is None:
+            self.total_ms = round((time.perf_counter() - self._t0) * 1000, 3)
+        if error:
+            self.error = error
+        return self
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'backend': self.backend,
+            'model': self.model,
+            'preset': self.preset,
+            'started_at': self.started_at,
+            'total_ms': self.total_ms,
+            'error': self.error,
+            'spans': [{'stage': s, 'offset_ms': o, 'duration_ms': d} for s, o, d in self.spans],
+        }
+
+
+@contextmanager
+def activate(trace: Trace | None):
+    # Make `trace` the target of span() calls on this thread for the block
+    previous = getattr(_active, 'trace', None)
+    _active.trace = trace
+    try:
+        yield trace
+    finally:
+        _active.trace = previous
+
+
+def current_trace():
+    return getattr(_active, 'trace', None)
+
+
+@contextmanager
+def span(stage: str):
+    # Time a block against the active trace, a no-op when nothing is being traced
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    with trace.span(stage):
+        yield
+
+
+class TraceBuffer:
+    # Thread-safe ring buffer of finished traces with percentile summaries
+
+    def __init__(self, capacity: int = TRACE_CAPACITY):
+        self._traces = deque(maxlen=max(1, int(capacity)))
+        self._lock = threading.Lock()
+
+    def add(self, trace: Trace):
+        trace.finish()
+        with self._lock:
+            self._traces.append(trace)
+
+    def traces(self):
+        with self._lock:
+            return list(self._traces)
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+
+    def resize(self, capacity: int):
+        with self._lock:
+            self._traces = deque(self._traces, maxlen=max(1, int(capacity)))
+
+    @property
+    def capacity(self):
+        return self._traces.maxlen
+
+    def __len__(self):
+        with self._lock:
+            return len(self._traces)
+
+    def stats(self):
+        # {(model_key, stage): {'count', 'p50', 'p95'}} including an 'all' model row per stage
+        samples = {}
+        for trace in self.traces():
+            for stage, ms in trace.stage_totals().items():
+                samples.setdefault((trace.model_key, stage), []).append(ms)
+                samples.setdefault(('all', stage), []).append(ms)
+        out = {}
+        for key, values in samples.items():
+            out[key] = {'count': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95)}
+        return out
+
+    def stats_rows(self):
+        # Rows sorted by model then pipeline stage order, for display
+        order = {s: i for i, s in enumerate(STAGES)}
+        rows = []
+        for (model, stage), st in self.stats().items():
+            rows.append((model, stage, st['count'], st['p50'], st['p95']))
+        rows.sort(key=lambda r: (r[0] != 'all', r[0], order.get(r[1], len(order)), r[1]))
+        return rows
+
+    def export_json(self, path: str):
+        data = {
+            'exported_at': time.time(),
+            'stats': [
+                {'model': m, 'stage': s, 'count': c, 'p50_ms': p50, 'p95_ms': p95}
+                for m, s, c, p50, p95 in self.stats_rows()
+            ],
+            'traces': [t.to_dict() for t in self.traces()],
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        return len(data['traces'])
+
+
+# Process-wide buffer shared by the GUI, batch mode and benchmarks
+TRACES = TraceBuffer()
@@ -0,0 +1,184 @@
+# File:        chatmax_usage.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Token usage and cost metering for Chat Max. Normalizes the
+#              usage reported by the OpenAI API (or a server endpoint) and
+#              aggregates prompt/completion/cached tokens and estimated spend
+#              per conversation, per preset, per model and per purpose
+#              (chat reply vs preference extraction).
+
+
+# Imports
+
+# Locking for meters shared with worker threads
+import threading
+
+
+# Constants
+
+# USD per 1M tokens: (input, cached input, output)
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-5-nano': (0.05, 0.005, 0.40),
+    'gpt-5-mini': (0.25, 0.025, 2.00),
+}
+
+# Counter fields tracked for every bucket
+USAGE_FIELDS = ('requests', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'total_tokens')
+
+# Purposes a call can be metered under
+PURPOSE_CHAT = 'chat'
+PURPOSE_EXTRACTION = 'extraction'
+
+
+# Functions
+
+def _field(obj, name: str):
+    # Usage may be an OpenAI response object or a plain dict from a server
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def normalize_usage(raw):
+    # Map OpenAI-style usage ({prompt_tokens, completion_tokens, prompt_tokens_details.cached_tokens})
+    # to flat integer counts, returns None when nothing usable was reported
+    if raw is None:
+        return None
+    try:
+        prompt = int(_field(raw, 'prompt_tokens') or _field(raw, 'input_tokens') or 0)
+        completion = int(_field(raw, 'completion_tokens') or _field(raw, 'output_tokens') or 0)
+        details = _field(raw, 'prompt_tokens_details') or _field(raw, 'input_tokens_details')
+        cached = int(_field(details, 'cached_tokens') or _field(raw, 'cached_tokens') or 0)
+        total = int(_field(raw, 'total_tokens') or (prompt + completion))
+    except Exception:
+        return None
+    if not (prompt or completion or total):
+        return None
+    return {'prompt_tokens': prompt, 'completion_tokens': completion, 'cached_tokens': cached, 'total_tokens': total}
+
+
+def estimate_cost(model: str, usage: dict, prices: dict | None = None):
+    # Estimated USD for one call, None when the model has no known price
+    table = prices or MODEL_PRICES
+    price = table.get(model)
+    if not price or not usage:
+        return None
+    in_price, cached_price, out_price = price
+    cached = min(usage.get('cached_tokens', 0), usage.get('prompt_tokens', 0))
+    uncached = usage.get('prompt_tokens', 0) - cached
+    return (uncached * in_price + cached * cached_price + usage.get('completion_tokens', 0) * out_price) / 1_000_000
+
+
+def _empty_bucket():
+    bucket = {f: 0 for f in USAGE_FIELDS}
+    bucket['cost_usd'] = 0.0
+    return bucket
+
+
+def _add(bucket: dict, usage: dict, cost):
+    bucket['requests'] += 1
+    for f in USAGE_FIELDS[1:]:
+        bucket[f] += int(usage.get(f, 0))
+    if cost is not None:
+        bucket['cost_usd'] += cost
+
+
+def format_cost(usd: float):
+    # Sub-cent totals are common for short chats, keep them visible
+    return f'${usd:.4f}' if usd >= 0.01 else f'${usd:.6f}'
+
+
+def format_usage(bucket: dict):
+    # Short running-total text for the main window
+    if not bucket or not bucket.get('requests'):
+        return 'Usage: no tokens yet'
+    text = f"Usage: {bucket['prompt_tokens']:,} in / {bucket['completion_tokens']:,} out"
+    if bucket.get('cached_tokens'):
+        text += f" ({bucket['cached_tokens']:,} cached)"
+    return text + f" · {format_cost(bucket['cost_usd'])}"
+
+
+class UsageMeter:
+    # Running token/cost totals for one conversation
+
+    def __init__(self, prices: dict | None = None):
+        self.prices = prices
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.total = _empty_bucket()
+            self.by_model = {}
+            self.by_preset = {}
+            self.by_purpose = {}
+
+    def record(self, model: str, usage, preset: str | None = None, purpose: str = PURPOSE_CHAT):
+        usage = normalize_usage(usage)
+        if not usage:
+            return None
+        model = model or 'unknown'
+        cost = estimate_cost(model, usage, self.prices)
+        with self._lock:
+            _add(self.total, usage, cost)
+            _add(self.by_model.setdefault(model, _empty_bucket()), usage, cost)
+            _add(self.by_preset.setdefault(preset or 'Custom', _empty_bucket()), usage, cost)
+            _add(self.by_purpose.setdefault(purpose, _empty_bucket()), usage, cost)
+        return cost
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'total': dict(self.total),
+                'by_model': {k: dict(v) for k, v in self.by_model.items()},
+                'by_preset': {k: dict(v) for k, v in self.by_preset.items()},
+                'by_purpose': {k: dict(v) for k, v in self.by_purpose.items()},
+            }
+
+    def load_dict(self, data: dict):
+        # Restore totals saved with a conversation (missing or malformed data resets)
+        self.reset()
+        if not isinstance(data, dict):
+            return
+
+        def restore(src):
+            bucket = _empty_bucket()
+            if isinstance(src, dict):
+                for f in USAGE_FIELDS:
+                    try:
+                        bucket[f] = int(src.get(f, 0))
+                    except Exception:
+                        pass
+                try:
+                    bucket['cost_usd'] = float(src.get('cost_usd', 0.0))
+                except Exception:
+                    pass
+            return bucket
+
+        with self._lock:
+            self.total = restore(data.get('total'))
+            for name in ('by_model', 'by_preset', 'by_purpose'):
+                group = data.get(name)
+                if isinstance(group, dict):
+                    setattr(self, name, {str(k): restore(v) for k, v in group.items()})
+
+    def summary_text(self):
+        return format_usage(self.to_dict()['total'])
+
+    def breakdown_text(self):
+        # Multi-line per-model/per-preset/per-purpose report
+        data = self.to_dict()
+        lines = [format_usage(data['total'])]
+        for title, key in (('By model', 'by_model'), ('By preset', 'by_preset'), ('By purpose', 'by_purpose')):
+            group = data[key]
+            if not group:
+                continue
+            lines.append('')
+            lines.append(f'{title}:')
+            for name, bucket in sorted(group.items()):
+                lines.append(f"  {name}: {bucket['requests']} calls, {bucket['prompt_tokens']:,} in / {bucket['completion_tokens']:,} out ({bucket['cached_tokens']:,} cached), {format_cost(bucket['cost_usd'])}")
+        return '\n'.join(lines)
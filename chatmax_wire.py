@@ -0,0 +1,137 @@
+# File:        chatmax_wire.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Request encoding for Chat Max server mode. Request bodies can
+#              optionally be gzip-compressed (Content-Encoding: gzip); a server
+#              that rejects them gets the plain body instead and is remembered
+#              as not accepting gzip. Compressed responses are accepted, and
+#              byte counters show what went over the wire versus the JSON size.
+#              The payload shape ({"messages": [...]}) never changes.
+
+
+# Imports
+
+# Request body compression
+import gzip
+# Locking for counters shared by worker threads
+import threading
+# Fast JSON (orjson when installed)
+from chatmax_convfile import json_dumps
+
+
+# Constants
+
+# Compression defaults, overridable via settings.json 'server_compression'
+DEFAULT_COMPRESSION = {
+    'enabled': False,
+    # Bodies smaller than this are sent as they are (gzip only pays off on larger ones)
+    'min_bytes': 1024,
+    # gzip level, 1 (fast) to 9 (small)
+    'level': 6,
+}
+# Status codes after which a gzip body is retried uncompressed
+GZIP_REJECTED = (400, 415, 422)
+
+
+# Functions
+
+def merge_compression_settings(value):
+    merged = dict(DEFAULT_COMPRESSION)
+    if isinstance(value, dict):
+        merged['enabled'] = bool(value.get('enabled', merged['enabled']))
+        try:
+            if value.get('min_bytes') is not None:
+                merged['min_bytes'] = max(0, int(value['min_bytes']))
+            if value.get('level') is not None:
+                merged['level'] = max(1, min(9, int(value['level'])))
+        except Exception:
+            pass
+    return merged
+
+
+class WireStats:
+    # Request/response sizes: JSON bytes versus bytes actually sent/received
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._no_gzip = set()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.compressed = 0
+            self.fallbacks = 0
+            self.request_json = 0
+            self.request_wire = 0
+            self.response_json = 0
+            self.response_wire = 0
+            self.responses_compressed = 0
+
+    def accepts_gzip(self, endpoint: str):
+        with self._lock:
+            return endpoint not in self._no_gzip
+
+    def reject_gzip(self, endpoint: str):
+        with self._lock:
+            self._no_gzip.add(endpoint)
+            self.fallbacks += 1
+
+    def record_request(self, json_bytes: int, wire_bytes: int, compressed: bool):
+        with self._lock:
+            self.requests += 1
+            self.compressed += 1 if compressed else 0
+            self.request_json += json_bytes
+            self.request_wire += wire_bytes
+
+    def record_response(self, json_bytes: int, wire_bytes: int, compressed: bool):
+        with self._lock:
+            self.response_json += json_bytes
+            self.response_wire += wire_bytes
+            self.responses_compressed += 1 if compressed else 0
+
+    def summary(self):
+        with self._lock:
+            sent_saved = self.request_json - self.request_wire
+            received_saved = self.response_json - self.response_wire
+            return {
+                'requests': self.requests,
+                'compressed': self.compressed,
+                'fallbacks': self.fallbacks,
+                'request_json': self.request_json,
+                'request_wire': self.request_wire,
+                'request_saved': sent_saved / self.request_json if self.request_json else 0.0,
+                'response_json': self.response_json,
+                'response_wire': self.response_wire,
+                'response_saved': received_saved / self.response_json if self.response_json else 0.0,
+                'responses_compressed': self.responses_compressed,
+            }
+
+
+# Process-wide counters shown in Diagnostics and batch summaries
+WIRE = WireStats()
+
+
+def encode_body(obj, compression: dict | None = None, endpoint: str | None = None):
+    # (body bytes, headers, json size) for a POST. gzip is used when enabled,
+    # the body is big enough and the endpoint has not rejected it before
+    raw = json_dumps(obj)
+    headers = {'Content-Type': 'application/json'}
+    settings = merge_compression_settings(compression)
+    if settings['enabled'] and len(raw) >= settings['min_bytes'] and (endpoint is None or WIRE.accepts_gzip(endpoint)):
+        headers['Content-Encoding'] = 'gzip'
+        return gzip.compress(raw, compresslevel=settings['level'], mtime=0), headers, len(raw)
+    return raw, headers, len(raw)
+
+
+def response_sizes(resp):
+    # (decoded bytes, bytes on the wire, was compressed) of a requests response
+    body = len(resp.content)
+    encoding = (resp.headers.get('Content-Encoding') or '').lower()
+    if encoding and encoding != 'identity':
+        try:
+            return body, int(resp.headers.get('Content-Length')), True
+        except Exception:
+            return body, body, True
+    return body, body, False
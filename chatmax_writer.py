@@ -0,0 +1,133 @@
+# File:        chatmax_writer.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Write-behind persistence for Chat Max. Settings, preferences,
+#              presets and latency histograms are handed to a single
+#              background writer instead of being written (and fsync'd) on the
+#              Tk thread or a chat worker. Rapid successive writes to the same
+#              file are coalesced so only the newest content hits the disk,
+#              every write keeps the write-.tmp-then-os.replace semantics, and
+#              readers see pending content before it is flushed.
+
+
+# Imports
+
+# Pending writes are flushed when the interpreter exits
+import atexit
+# Background writer thread and its wake-ups
+import threading
+# OS for atomic replace, fsync and chmod
+import os
+
+
+# Functions
+
+def atomic_write(path: str, text, mode: int | None = 0o600, raise_errors: bool = False):
+    # Write text (or bytes) to '<path>.tmp', fsync, then replace so readers never see a partial file
+    try:
+        tmp = path + '.tmp'
+        with (open(tmp, 'wb') if isinstance(text, bytes) else open(tmp, 'w', encoding='utf-8')) as tf:
+            tf.write(text)
+            tf.flush()
+            try:
+                os.fsync(tf.fileno())
+            except Exception:
+                pass
+        os.replace(tmp, path)
+        if mode is not None:
+            try:
+                os.chmod(path, mode)
+            except Exception:
+                pass
+    except Exception:
+        # Best-effort only unless the caller reports errors itself (e.g. an explicit save)
+        if raise_errors:
+            raise
+
+
+class WriteBehind:
+    # Single background writer with one pending slot per file. A pending
+    # entry of None text means "delete the file"
+
+    def __init__(self):
+        self._pending = {}
+        self._inflight = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self.writes = 0
+        self.coalesced = 0
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='chatmax-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, path: str, text: str | None, mode: int | None = 0o600):
+        # Queue the new content for path, replacing anything not yet written
+        with self._cond:
+            if path in self._pending:
+                self.coalesced += 1
+            self._pending[path] = (text, mode)
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def remove(self, path: str):
+        # Delete path once earlier writes are done (so a queued write cannot recreate it)
+        self.submit(path, None)
+
+    def pending_text(self, path: str):
+        # (True, text) when a write (or delete, text None) for path has not reached the disk
+        with self._cond:
+            if path in self._pending:
+                return True, self._pending[path][0]
+            if self._inflight is not None and self._inflight[0] == path:
+                return True, self._inflight[1]
+        return False, None
+
+    def read_text(self, path: str):
+        # Newest content of path: pending if any, otherwise what is on disk (None if missing)
+        pending, text = self.pending_text(path)
+        if pending:
+            return text
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except Exception:
+            return None
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending) + (1 if self._inflight is not None else 0)
+
+    def flush(self, timeout: float | None = None):
+        # Block until everything queued so far is on disk, returns False on timeout
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and self._inflight is None, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                # Oldest file first (dicts keep insertion order)
+                path = next(iter(self._pending))
+                text, mode = self._pending.pop(path)
+                self._inflight = (path, text)
+            try:
+                if text is None:
+                    if os.path.exists(path):
+                        os.remove(path)
+                else:
+                    atomic_write(path, text, mode)
+            except Exception:
+                pass
+            with self._cond:
+                self._inflight = None
+                self.writes += 1
+                self._cond.notify_all()
+
+
+# Process-wide writer shared by the GUI, batch mode and the engine
+WRITER = WriteBehind()
+# Headless callers that never flush explicitly still get their writes on disk
+atexit.register(WRITER.flush, 5.0)
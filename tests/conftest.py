@@ -0,0 +1,82 @@
+# File:        conftest.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Shared pytest fixtures for the Chat Max modules: the repository
+#              root on sys.path and a local HTTP stub that answers every
+#              request with a fixed status.
+
+
+# Imports
+
+# Local stub server
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+# Fixtures
+import pytest
+
+# The chatmax_* modules live next to the tests directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Functions
+
+class StatusServer:
+    # Answers every GET/POST with `status` (plus extra headers) and counts the requests it saw
+
+    def __init__(self, status: int = 200, reply: str = 'ok', headers: dict | None = None):
+        self.status = status
+        self.reply = reply
+        self.headers = headers or {}
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _answer(self):
+                server.requests += 1
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                body = json.dumps({'response': server.reply}).encode('utf-8')
+                self.send_response(server.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in server.headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _answer
+            do_POST = _answer
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}/'
+        threading.Thread(target=self._httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def status_server():
+    # Factory: status_server(500) starts a stub that is stopped after the test
+    started = []
+
+    def start(status: int = 200, reply: str = 'ok', headers: dict | None = None):
+        server = StatusServer(status, reply, headers)
+        started.append(server)
+        return server
+
+    yield start
+    for server in started:
+        server.stop()
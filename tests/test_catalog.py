@@ -0,0 +1,106 @@
+# File:        test_catalog.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the recent-conversations catalog: refresh scans only
+#              new or changed files, drops deleted ones, survives a restart,
+#              and importing it stays light.
+
+
+# Imports
+
+import os
+import subprocess
+import sys
+import pytest
+from chatmax_catalog import ConversationCatalog, CATALOG_NAME
+from chatmax_convfile import write_conversation
+from chatmax_messages import Message, USER_ROLE
+from chatmax_writer import WRITER
+
+
+# Constants
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Functions
+
+def save(path, count: int, ts: int = 1_700_000_000, fmt: str = 'json'):
+    msgs = []
+    for i in range(count):
+        msgs.append(Message(USER_ROLE if i % 2 == 0 else 'Sarcastic Bot', f'line {i}', ts + i))
+    write_conversation(str(path), msgs, {}, fmt)
+    return msgs
+
+
+def bump_mtime(path, seconds: int = 10):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + seconds * 10 ** 9))
+
+
+@pytest.fixture
+def folder(tmp_path):
+    save(tmp_path / 'alpha.json', 4, ts=1_700_000_000)
+    save(tmp_path / 'beta.json.gz', 6, ts=1_700_100_000, fmt='gzip')
+    (tmp_path / 'notes.txt').write_text('not a conversation')
+    return tmp_path
+
+
+def test_refresh_scans_only_new_or_changed(folder):
+    catalog = ConversationCatalog(str(folder))
+    assert catalog.refresh() == 2
+    assert [e['title'] for e in catalog.recent()] == ['beta', 'alpha']
+    assert catalog.recent()[0]['messages'] == 6 and catalog.recent()[0]['preset'] == 'Sarcastic Bot'
+    assert catalog.refresh() == 0
+
+    save(folder / 'alpha.json', 9, ts=1_700_200_000)
+    bump_mtime(folder / 'alpha.json')
+    save(folder / 'gamma.json', 2)
+    assert catalog.refresh() == 2
+    alpha = next(e for e in catalog.recent() if e['title'] == 'alpha')
+    assert alpha['messages'] == 9
+    assert catalog.recent()[0]['title'] == 'alpha'
+
+
+def test_deleted_files_drop_out(folder):
+    catalog = ConversationCatalog(str(folder))
+    catalog.refresh()
+    os.remove(folder / 'beta.json.gz')
+    catalog.refresh()
+    assert [e['title'] for e in catalog.recent()] == ['alpha']
+
+
+def test_unreadable_file_is_not_rescanned_until_it_changes(folder):
+    broken = folder / 'broken.json'
+    broken.write_text('{not json')
+    catalog = ConversationCatalog(str(folder))
+    assert catalog.refresh() == 3
+    assert catalog.refresh() == 0
+    save(broken, 2)
+    bump_mtime(broken)
+    assert catalog.refresh() == 1
+    assert 'broken' in [e['title'] for e in catalog.recent()]
+
+
+def test_catalog_survives_restart_and_rebuild(folder):
+    catalog = ConversationCatalog(str(folder))
+    catalog.refresh()
+    msgs = save(folder / 'delta.json', 3)
+    catalog.record(str(folder / 'delta.json'), msgs)
+    WRITER.flush(5.0)
+    assert os.path.exists(folder / CATALOG_NAME)
+
+    reopened = ConversationCatalog(str(folder))
+    assert reopened.last()['title'] == 'delta'
+    assert len(reopened.recent()) == 3
+    assert reopened.refresh() == 0
+    assert reopened.rebuild() == 3
+
+
+def test_import_does_not_pull_in_the_engine():
+    script = (f'import sys; sys.path.insert(0, {ROOT!r})\n'
+              'import chatmax_catalog\n'
+              'print(sorted(m for m in ("chatmax_engine", "requests", "chatmax_routing") if m in sys.modules))\n')
+    out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True, timeout=60).stdout
+    assert out.strip() == '[]'
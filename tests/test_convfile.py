@@ -0,0 +1,93 @@
+# File:        test_convfile.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for saved-conversation formats: every format round-trips
+#              and is recognised from its content, whatever the file is called.
+
+
+# Imports
+
+import gzip
+import importlib.util
+import json
+import pytest
+from chatmax_convfile import (FORMATS, FORMAT_VERSION, GZIP_MAGIC, ZSTD_MAGIC, decode_conversation, encode_conversation,
+                              read_conversation, write_conversation, strip_extension, default_extension)
+from chatmax_messages import Message, USER_ROLE
+
+
+# Constants
+
+# Optional libraries behind some formats
+NEEDS = {'zstd': 'zstandard', 'msgpack': 'msgpack'}
+META = {'conversation_id': 'abc123', 'usage': {'total_tokens': 42}}
+
+
+# Functions
+
+def conversation():
+    return [
+        Message(USER_ROLE, 'Hello — ünïcödé ✓', 1_700_000_000),
+        Message('Default AI', 'Hi there!\nSecond line', 1_700_000_005, 'gpt-4o-mini'),
+        Message(USER_ROLE, '', 1_700_000_010),
+        Message('Casual Friendly', 'reply', 1_700_000_020, 'gpt-5-mini'),
+    ]
+
+
+def fields(messages):
+    return [(m.role, m.text, m.ts, m.model) for m in messages]
+
+
+@pytest.fixture(params=list(FORMATS))
+def fmt(request):
+    if request.param in NEEDS and importlib.util.find_spec(NEEDS[request.param]) is None:
+        pytest.skip(f'{NEEDS[request.param]} is not installed')
+    return request.param
+
+
+def test_round_trip(fmt, tmp_path):
+    path = str(tmp_path / f'conv{default_extension(fmt)}')
+    write_conversation(path, conversation(), META, fmt)
+    messages, meta = read_conversation(path)
+    assert fields(messages) == fields(conversation())
+    assert meta == META
+
+
+def test_format_detected_from_content_not_name(fmt, tmp_path):
+    path = tmp_path / 'renamed.dat'
+    path.write_bytes(encode_conversation(conversation(), META, fmt))
+    messages, _ = read_conversation(str(path))
+    assert fields(messages) == fields(conversation())
+
+
+def test_magic_bytes():
+    assert encode_conversation(conversation(), META, 'gzip').startswith(GZIP_MAGIC)
+    compact = json.loads(encode_conversation(conversation(), META, 'compact'))
+    assert compact['version'] == FORMAT_VERSION and compact['roles'] == [USER_ROLE, 'Default AI', 'Casual Friendly']
+    if importlib.util.find_spec('zstandard') is not None:
+        assert encode_conversation(conversation(), META, 'zstd').startswith(ZSTD_MAGIC)
+    # Identical conversations give identical gzip files
+    assert encode_conversation(conversation(), META, 'gzip') == encode_conversation(conversation(), META, 'gzip')
+
+
+def test_older_bare_list_files_load():
+    data = json.dumps([['You', 'hi', '2023-11-14 22:13:20'], ['AI', 'hello']]).encode('utf-8')
+    messages, meta = decode_conversation(data)
+    assert [m.text for m in messages] == ['hi', 'hello'] and meta == {}
+    assert decode_conversation(gzip.compress(data))[0][0].text == 'hi'
+
+
+def test_rejects_other_files():
+    with pytest.raises(ValueError):
+        decode_conversation(b'{"hello": "world"}')
+    newer = json.dumps({'format': 'chatmax-conversation', 'version': FORMAT_VERSION + 1, 'messages': []}).encode('utf-8')
+    with pytest.raises(ValueError):
+        decode_conversation(newer)
+
+
+def test_titles_strip_every_extension():
+    assert strip_extension('/tmp/chat.json.gz') == 'chat'
+    assert strip_extension('chat.json.zst') == 'chat'
+    assert strip_extension('chat.msgpack') == 'chat'
+    assert strip_extension('chat.json') == 'chat'
@@ -0,0 +1,76 @@
+# File:        test_latency.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the adaptive timeouts: derived from observed latency,
+#              and not inflated by calls that timed out.
+
+
+# Imports
+
+import pytest
+# Endpoint slower than the derived timeout
+from chatmax_bench import FakeBackend
+from chatmax_engine import ChatSession
+from chatmax_latency import get_latency_tracker, LatencyTracker, LATENCY_PATH
+
+
+# Constants
+
+POLICY = {'factor': 3.0, 'floor_s': 0.3, 'ceiling_s': 120.0, 'default_s': 30.0, 'min_samples': 20}
+
+
+# Functions
+
+def test_timeout_follows_p99():
+    tracker = LatencyTracker(None, POLICY)
+    assert tracker.timeout_for('server') == 30.0
+    for _ in range(40):
+        tracker.record('server', 1.0)
+    assert 3.0 <= tracker.timeout_for('server') <= 5.0
+
+
+def test_in_memory_trackers_are_separate():
+    a, b = get_latency_tracker(path=None), get_latency_tracker(path=None)
+    assert a is not b and a.path is None
+    assert get_latency_tracker() is get_latency_tracker(None, LATENCY_PATH)
+
+
+@pytest.fixture
+def slow_backend():
+    fb = FakeBackend(latency_s=0.0, tokens_per_s=0)
+    url = fb.start()
+    yield fb, url
+    fb.stop()
+
+
+def test_timeouts_do_not_grow_the_timeout(slow_backend, tmp_path):
+    fb, url = slow_backend
+    tracker = LatencyTracker(None, POLICY)
+    session = ChatSession({'use_local_ai': False, 'server_endpoint': url, 'offline_queue': False},
+                          prefs_path=str(tmp_path / 'preferences.json'), latency=tracker)
+    session.extract_preferences = False
+    for _ in range(30):
+        assert not session.send('hello').startswith('Error:')
+    key = session.latency_key()
+    before = tracker.timeout_for(key)
+    assert before < 1.0
+
+    # The endpoint stops answering in time: every call times out
+    fb.latency_s = before + 1.0
+    for _ in range(3):
+        assert session.send('hello again').startswith('Error:')
+    assert tracker.timeouts(key) == 3
+    assert tracker.samples(key) == 30
+    assert tracker.timeout_for(key) == before
+
+
+def test_local_call_is_a_single_request(status_server, monkeypatch):
+    # SDK retries would make one call take several timeouts
+    pytest.importorskip('openai')
+    from chatmax_engine import call_local_openai
+    failing = status_server(500)
+    monkeypatch.setenv('OPENAI_BASE_URL', failing.url + 'v1')
+    with pytest.raises(Exception):
+        call_local_openai([{'role': 'user', 'content': 'hi'}], 'test-no-retries', 'gpt-4o-mini', timeout=5)
+    assert failing.requests == 1
@@ -0,0 +1,97 @@
+# File:        test_messages.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for compact message records and the conversation log:
+#              spilling to the journal, then indexing and iterating over the
+#              mmap'd journal and the in-memory tail alike.
+
+
+# Imports
+
+import os
+import pytest
+from chatmax_messages import Message, MessageLog, USER_ROLE
+
+
+# Constants
+
+BASE_TS = 1_700_000_000
+
+
+# Functions
+
+def make_messages(count: int):
+    out = []
+    for i in range(count):
+        role = USER_ROLE if i % 2 == 0 else 'Default AI'
+        out.append(Message(role, f'message {i} — naïve ✓', BASE_TS + i, 'gpt-4o-mini' if i % 3 == 0 else None))
+    return out
+
+
+def same(a: Message, b: Message):
+    return (a.role, a.text, a.ts, a.model) == (b.role, b.text, b.ts, b.model)
+
+
+def test_message_round_trip_and_tuple_indexing():
+    msg = Message(USER_ROLE, 'hi', BASE_TS, 'gpt-5-mini')
+    assert msg[0] == USER_ROLE and msg[1] == 'hi' and msg[3] == 'gpt-5-mini'
+    assert len(msg) == 4 and len(Message('AI', 'x', BASE_TS)) == 3
+    assert same(Message.from_item(msg.to_list()), msg)
+    assert Message.from_item(['only role']) is None
+
+
+@pytest.fixture
+def spilled_log():
+    log = MessageLog({'enabled': True, 'keep_in_memory': 10})
+    msgs = make_messages(100)
+    for m in msgs[:60]:
+        log.append(m)
+    log.extend(msgs[60:])
+    yield log, msgs
+    log.close()
+
+
+def test_spill_keeps_newest_in_memory(spilled_log):
+    log, msgs = spilled_log
+    assert len(log) == 100
+    assert log.in_memory() == 10
+    assert os.path.exists(log._journal_path)
+
+
+def test_index_and_slice_across_journal_and_memory(spilled_log):
+    log, msgs = spilled_log
+    for i in (0, 1, 45, 89, 90, 99, -1, -100):
+        assert same(log[i], msgs[i])
+    assert [m.text for m in log[85:95]] == [m.text for m in msgs[85:95]]
+    with pytest.raises(IndexError):
+        log[100]
+    with pytest.raises(IndexError):
+        log[-101]
+
+
+def test_iteration_matches_and_survives_further_spills(spilled_log):
+    log, msgs = spilled_log
+    assert all(same(a, b) for a, b in zip(log, msgs)) and len(list(log)) == 100
+    # Reading maps the journal; later spills must be readable too
+    extra = make_messages(130)[100:]
+    log.extend(extra)
+    assert len(log) == 130
+    assert same(log[110], extra[10])
+    assert all(same(a, b) for a, b in zip(log, msgs + extra))
+
+
+def test_insert_after_and_clear(spilled_log):
+    log, msgs = spilled_log
+    reply = Message('Default AI', 'late reply', BASE_TS + 1000)
+    assert log.insert_after(lambda m: m.text == msgs[94].text, reply)
+    assert log[95].text == 'late reply' and same(log[96], msgs[95])
+    journal = log._journal_path
+    log.clear()
+    assert len(log) == 0 and not os.path.exists(journal)
+
+
+def test_spilling_off_keeps_everything_in_memory():
+    log = MessageLog()
+    log.extend(make_messages(50))
+    assert log.in_memory() == 50 and log._journal is None
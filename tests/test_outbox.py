@@ -0,0 +1,137 @@
+# File:        test_outbox.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the offline queue: what counts as an outage, that
+#              queued turns survive a restart in order, and that they are
+#              replayed oldest first with each reply slotted after its message.
+
+
+# Imports
+
+import os
+import pytest
+import requests
+# Endpoint that comes back online
+from chatmax_bench import FakeBackend
+import chatmax_engine
+from chatmax_engine import ChatSession, USER_ROLE
+from chatmax_latency import get_latency_tracker
+from chatmax_outbox import Outbox, is_offline_error
+from chatmax_ratelimit import RateLimiter, RateLimitWaitTimeout
+
+
+# Functions
+
+@pytest.fixture
+def outbox_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'outbox.json')
+    monkeypatch.setattr(chatmax_engine, 'OUTBOX_PATH', path)
+    return path
+
+
+def make_session(endpoint: str, tmp_path, **settings):
+    base = {'use_local_ai': False, 'server_endpoint': endpoint, 'offline_queue': True}
+    base.update(settings)
+    session = ChatSession(base, prefs_path=str(tmp_path / 'preferences.json'), latency=get_latency_tracker(path=None))
+    session.extract_preferences = False
+    return session
+
+
+def http_error(status: int):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def test_offline_errors():
+    assert is_offline_error(requests.ConnectionError('refused'))
+    assert is_offline_error(requests.Timeout('slow'))
+    assert is_offline_error(TimeoutError())
+    assert is_offline_error(http_error(503))
+    assert is_offline_error(http_error(429))
+    assert not is_offline_error(http_error(401))
+    assert not is_offline_error(RuntimeError('No server endpoint configured'))
+
+
+def test_rate_limiter_timeout_is_not_offline():
+    limiter = RateLimiter({'rpm': 1, 'max_wait_s': 0.05})
+    limiter.acquire(1)
+    with pytest.raises(RateLimitWaitTimeout) as info:
+        limiter.acquire(1)
+    assert isinstance(info.value, TimeoutError)
+    assert not is_offline_error(info.value)
+
+
+def test_outbox_persists_in_order(tmp_path):
+    path = str(tmp_path / 'outbox.json')
+    box = Outbox(path)
+    first = box.add('conv-a', 'one', 1, 'Default AI', [])
+    box.add('conv-b', 'other', 2, 'Default AI', [])
+    box.add('conv-a', 'two', 3, 'Default AI', [], attempts=0)
+
+    reloaded = Outbox(path)
+    assert [e['message'] for e in reloaded.pending()] == ['one', 'other', 'two']
+    assert [e['message'] for e in reloaded.pending('conv-a')] == ['one', 'two']
+    assert reloaded.first('conv-a')['id'] == first['id']
+
+    reloaded.remove(first['id'])
+    assert reloaded.drop('conv-b') == 1
+    assert [e['message'] for e in Outbox(path).pending()] == ['two']
+
+
+def test_queued_turns_replay_in_order(status_server, outbox_path, tmp_path):
+    down = status_server(200)
+    down.stop()
+    session = make_session(down.url, tmp_path)
+    for text in ('first', 'second', 'third'):
+        session.send(text)
+    assert session.queued_count() == 3
+    # Nothing but the user's messages yet
+    assert [m.text for m in session.full_history] == ['first', 'second', 'third']
+
+    # The queue is on disk, in order, for this conversation
+    stored = Outbox(outbox_path).pending(session.conversation_id)
+    assert [e['message'] for e in stored] == ['first', 'second', 'third']
+
+    fb = FakeBackend(latency_s=0.0, tokens_per_s=0)
+    try:
+        session.endpoint = fb.start()
+        assert session.deliver_queued(force=True) == 3
+    finally:
+        fb.stop()
+    assert session.queued_count() == 0
+    msgs = list(session.full_history)
+    assert [m.role == USER_ROLE for m in msgs] == [True, False] * 3
+    for user, reply in zip(msgs[0::2], msgs[1::2]):
+        assert reply.text.endswith(f're: {user.text}')
+
+
+def test_rate_limited_turn_is_not_queued(outbox_path, tmp_path):
+    fb = FakeBackend(latency_s=0.0, tokens_per_s=0)
+    try:
+        session = make_session(fb.start(), tmp_path, rate_limits={'rpm': 1, 'max_wait_s': 0.05})
+        assert not session.send('first').startswith('Error:')
+        assert session.send('second').startswith('Error: Rate limit')
+    finally:
+        fb.stop()
+    assert session.queued_count() == 0
+
+
+def test_ephemeral_session_touches_no_files(status_server, outbox_path, tmp_path):
+    down = status_server(200)
+    down.stop()
+    session = ChatSession({'use_local_ai': False, 'server_endpoint': down.url, 'offline_queue': True},
+                          prefs_path=str(tmp_path / 'preferences.json'), ephemeral=True)
+    session.extract_preferences = False
+    session.send('hello')
+    assert session.queued_count() == 1
+    assert session.outbox.path is None and session.latency.path is None
+    assert not os.path.exists(outbox_path)
+
+
+def test_outbox_opened_only_when_used(outbox_path, tmp_path):
+    session = make_session('http://127.0.0.1:9/', tmp_path, offline_queue=False)
+    assert session._outbox is None
+    assert session.queued_count() == 0
+    assert session.outbox is chatmax_engine.get_outbox(outbox_path)
@@ -0,0 +1,44 @@
+# File:        test_presets.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the cached personalities/ directory scan: files that
+#              are added, edited in place or removed are picked up.
+
+
+# Imports
+
+import json
+import os
+import time
+from chatmax_engine import load_personality_files
+
+
+# Functions
+
+def write_preset(path: str, values: list):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'values': values}, f)
+
+
+def test_scan_sees_added_and_removed_files(tmp_path):
+    write_preset(tmp_path / 'calm.json', [1] * 8)
+    assert load_personality_files(str(tmp_path)) == {'calm': (1,) * 8}
+    write_preset(tmp_path / 'loud.json', [9] * 8)
+    assert set(load_personality_files(str(tmp_path))) == {'calm', 'loud'}
+    os.remove(tmp_path / 'calm.json')
+    assert set(load_personality_files(str(tmp_path))) == {'loud'}
+
+
+def test_scan_sees_file_edited_in_place(tmp_path):
+    path = tmp_path / 'calm.json'
+    write_preset(path, [1] * 8)
+    assert load_personality_files(str(tmp_path))['calm'] == (1,) * 8
+    dir_mtime = os.stat(tmp_path).st_mtime_ns
+    # Rewrite the same file (same size) without touching the directory
+    with open(path, 'r+', encoding='utf-8') as f:
+        f.write(json.dumps({'values': [2] * 8}))
+    later = time.time_ns() + 10 ** 9
+    os.utime(path, ns=(later, later))
+    assert os.stat(tmp_path).st_mtime_ns == dir_mtime
+    assert load_personality_files(str(tmp_path))['calm'] == (2,) * 8
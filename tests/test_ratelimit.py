@@ -0,0 +1,118 @@
+# File:        test_ratelimit.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the shared rate limiter: chat before background work,
+#              Retry-After parsing and honouring, retries of 429 answers and
+#              giving up after max_wait_s.
+
+
+# Imports
+
+import threading
+import time
+from email.utils import formatdate
+import pytest
+import requests
+from chatmax_ratelimit import (RateLimiter, RateLimitWaitTimeout, retry_after_s, is_rate_limited, estimate_tokens,
+                               limiter_key, PRIORITY_CHAT, PRIORITY_BACKGROUND)
+
+
+# Functions
+
+def http_error(status: int, headers: dict | None = None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def test_retry_after_parsing():
+    assert retry_after_s(http_error(429, {'retry-after-ms': '1500'})) == 1.5
+    assert retry_after_s(http_error(429, {'Retry-After': '7'})) == 7.0
+    in_a_minute = retry_after_s(http_error(429, {'Retry-After': formatdate(time.time() + 60, usegmt=True)}))
+    assert 55 <= in_a_minute <= 61
+    assert retry_after_s(http_error(429, {'Retry-After': formatdate(time.time() - 60, usegmt=True)})) == 0.0
+    assert retry_after_s(http_error(429)) is None
+    assert retry_after_s(http_error(429, {'Retry-After': 'soon'})) is None
+    assert retry_after_s(RuntimeError('no response')) is None
+    assert is_rate_limited(http_error(429)) and not is_rate_limited(http_error(503))
+
+
+def test_chat_goes_before_queued_background_work():
+    limiter = RateLimiter({'rpm': 600})
+    # Empty the request bucket: one grant every 0.1s from here on
+    limiter.requests.tokens = 0.0
+    order = []
+
+    def take(label, priority):
+        limiter.acquire(1, priority)
+        order.append(label)
+
+    threads = [threading.Thread(target=take, args=(f'background {i}', PRIORITY_BACKGROUND)) for i in range(2)]
+    for t in threads:
+        t.start()
+    time.sleep(0.03)
+    chat = threading.Thread(target=take, args=('chat', PRIORITY_CHAT))
+    chat.start()
+    for t in threads + [chat]:
+        t.join(5)
+    assert order[0] == 'chat'
+    assert sorted(order[1:]) == ['background 0', 'background 1']
+    assert limiter.summary()['chat_granted'] == 1 and limiter.summary()['background_granted'] == 2
+
+
+def test_429_waits_retry_after_then_retries():
+    limiter = RateLimiter({'retries': 2})
+    answers = [http_error(429, {'retry-after-ms': '200'}), http_error(429, {'retry-after-ms': '200'}), 'ok']
+    stamps = []
+
+    def fn():
+        stamps.append(time.monotonic())
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert limiter.call(fn, 10) == 'ok'
+    assert stamps[1] - stamps[0] >= 0.19 and stamps[2] - stamps[1] >= 0.19
+    summary = limiter.summary()
+    assert summary['throttled'] == 2 and summary['retried'] == 2
+
+
+def test_429_gives_up_after_retries():
+    limiter = RateLimiter({'retries': 1})
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise http_error(429, {'Retry-After': '0'})
+
+    with pytest.raises(requests.HTTPError):
+        limiter.call(fn, 10)
+    assert len(calls) == 2
+
+
+def test_other_errors_are_not_retried():
+    limiter = RateLimiter({'retries': 3})
+    with pytest.raises(ValueError):
+        limiter.call(lambda: (_ for _ in ()).throw(ValueError('bad')), 10)
+    assert limiter.summary()['throttled'] == 0
+
+
+def test_gives_up_after_max_wait():
+    limiter = RateLimiter({'rpm': 1, 'max_wait_s': 5.0})
+    limiter.acquire(1)
+    started = time.monotonic()
+    # The next slot is a minute away: rejected at once, not after waiting
+    with pytest.raises(RateLimitWaitTimeout):
+        limiter.acquire(1, PRIORITY_BACKGROUND, max_wait_s=0.2)
+    assert time.monotonic() - started < 1.0
+    assert limiter.summary()['rejected'] == 1
+
+
+def test_token_estimate_and_keys():
+    messages = [{'role': 'user', 'content': 'x' * 400}]
+    assert estimate_tokens(messages, 100) == 100 + 4 + 100
+    assert limiter_key(True, 'sk-secret').startswith('openai:') and 'sk-secret' not in limiter_key(True, 'sk-secret')
+    assert limiter_key(False, endpoint=['http://a/', 'http://b/']) == 'server:http://a/,http://b/'
@@ -0,0 +1,270 @@
+# File:        test_routing.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for multi-endpoint routing: which errors fail over, and
+#              when a health check closes a tripped circuit breaker.
+
+
+# Imports
+
+import threading
+import time
+import pytest
+import requests
+# Healthy endpoint speaking the server-mode contract
+from chatmax_bench import FakeBackend
+# Single-endpoint POST used by the pool
+from chatmax_engine import post_server_api
+from chatmax_ratelimit import RateLimiter
+from chatmax_routing import EndpointPool, HedgeStats, is_failover_error, CLOSED, OPEN, HALF_OPEN, FAILURE_THRESHOLD, COOLDOWN_S
+
+
+# Constants
+
+MESSAGES = [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'Hello'}]
+
+
+# Functions
+
+@pytest.fixture
+def backend():
+    fb = FakeBackend(latency_s=0.0, tokens_per_s=0)
+    url = fb.start()
+    yield fb, url
+    fb.stop()
+
+
+def http_error(status: int):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def scripted(outcomes: dict, delay_s: float = 0.0):
+    # fn(url) for the pool: raises or returns what outcomes[url] says after
+    # delay_s (only for endpoints listed as slow), recording the call order
+    calls = []
+    lock = threading.Lock()
+
+    def fn(url):
+        with lock:
+            calls.append(url)
+        outcome, slow = outcomes[url]
+        if slow:
+            time.sleep(delay_s)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return fn, calls
+
+
+def capped_stats():
+    # Hedge stats whose rate cap refuses the next hedge
+    stats = HedgeStats()
+    assert stats.try_hedge(0.0, stats.record_request())
+    return stats
+
+
+def trip(pool: EndpointPool, url: str):
+    for _ in range(FAILURE_THRESHOLD):
+        pool.record_failure(url, RuntimeError('down'))
+
+
+def test_failover_errors_are_network_and_server_side():
+    assert is_failover_error(requests.ConnectionError('refused'))
+    assert is_failover_error(requests.Timeout('slow'))
+    assert is_failover_error(ConnectionResetError())
+    assert is_failover_error(TimeoutError())
+    assert is_failover_error(http_error(500))
+    assert is_failover_error(http_error(503))
+
+
+def test_client_errors_and_bugs_do_not_fail_over():
+    assert not is_failover_error(http_error(429))
+    assert not is_failover_error(http_error(400))
+    assert not is_failover_error(http_error(401))
+    assert not is_failover_error(TypeError('bad argument'))
+    assert not is_failover_error(KeyError('response'))
+    assert not is_failover_error(ValueError('bad json'))
+
+
+def test_call_fails_over_from_5xx_endpoint(status_server, backend):
+    broken = status_server(500)
+    fb, good = backend
+    pool = EndpointPool([broken.url, good])
+    reply = pool.call(lambda url: post_server_api(MESSAGES, url, timeout=5))
+    assert reply == fb.reply_for(MESSAGES)
+    assert broken.requests == 1
+    rows = {row[0]: row for row in pool.status_rows()}
+    assert rows[broken.url][5] == 1
+    assert rows[good][4] == 1
+
+
+def test_call_fails_over_from_unreachable_endpoint(status_server, backend):
+    dead = status_server(200)
+    dead.stop()
+    fb, good = backend
+    pool = EndpointPool([dead.url, good])
+    assert pool.call(lambda url: post_server_api(MESSAGES, url, timeout=5)) == fb.reply_for(MESSAGES)
+
+
+def test_call_does_not_fail_over_on_4xx(status_server):
+    rejecting = status_server(400)
+    spare = status_server(200)
+    pool = EndpointPool([rejecting.url, spare.url])
+    with pytest.raises(requests.HTTPError):
+        pool.call(lambda url: post_server_api(MESSAGES, url, timeout=5))
+    assert spare.requests == 0
+
+
+def test_call_does_not_fail_over_on_caller_bug():
+    tried = []
+
+    def fn(url):
+        tried.append(url)
+        raise TypeError('bug in the caller')
+
+    pool = EndpointPool(['http://a.invalid/', 'http://b.invalid/'])
+    with pytest.raises(TypeError):
+        pool.call(fn)
+    assert tried == ['http://a.invalid/']
+
+
+def test_probe_needs_2xx_to_close_breaker(status_server):
+    not_found = status_server(404)
+    pool = EndpointPool([not_found.url])
+    trip(pool, not_found.url)
+    assert pool.probe(not_found.url)
+    assert pool.status_rows()[0][1] == OPEN
+
+    healthy = status_server(200)
+    pool = EndpointPool([healthy.url])
+    trip(pool, healthy.url)
+    assert pool.probe(healthy.url)
+    assert pool.status_rows()[0][1] == CLOSED
+
+
+def test_probe_failure_counts_against_endpoint(status_server):
+    broken = status_server(502)
+    pool = EndpointPool([broken.url])
+    assert not pool.probe(broken.url)
+    assert pool.status_rows()[0][5] == 1
+
+
+def test_hedged_call_fails_over_when_primary_fails_before_hedge():
+    urls = ['http://a.invalid/', 'http://b.invalid/', 'http://c.invalid/']
+    fn, calls = scripted({urls[0]: (requests.ConnectionError('a'), False),
+                          urls[1]: (requests.ConnectionError('b'), False),
+                          urls[2]: ('from c', False)})
+    pool = EndpointPool(urls)
+    assert pool.hedged_call(fn, 5.0, stats=HedgeStats()) == 'from c'
+    assert calls == urls
+
+
+def test_hedged_call_fails_over_when_hedge_is_capped():
+    urls = ['http://a.invalid/', 'http://b.invalid/', 'http://c.invalid/']
+    fn, calls = scripted({urls[0]: (requests.Timeout('a'), True),
+                          urls[1]: ('from b', False),
+                          urls[2]: ('from c', False)}, delay_s=0.2)
+    stats = capped_stats()
+    pool = EndpointPool(urls)
+    assert pool.hedged_call(fn, 0.02, max_rate=0.0, stats=stats) == 'from b'
+    assert stats.suppressed == 1
+    assert calls == urls[:2]
+
+
+def test_hedged_call_fails_over_when_both_attempts_fail():
+    urls = ['http://a.invalid/', 'http://b.invalid/', 'http://c.invalid/']
+    fn, calls = scripted({urls[0]: (requests.Timeout('a'), True),
+                          urls[1]: (http_error(503), False),
+                          urls[2]: ('from c', False)}, delay_s=0.2)
+    pool = EndpointPool(urls)
+    assert pool.hedged_call(fn, 0.02, max_rate=1.0, stats=HedgeStats()) == 'from c'
+    assert sorted(calls[:2]) == sorted(urls[:2])
+    assert calls[2:] == [urls[2]]
+
+
+def test_hedged_call_raises_when_every_endpoint_failed():
+    urls = ['http://a.invalid/', 'http://b.invalid/']
+    fn, calls = scripted({urls[0]: (requests.Timeout('a'), True),
+                          urls[1]: (http_error(502), False)}, delay_s=0.2)
+    pool = EndpointPool(urls)
+    with pytest.raises(requests.RequestException):
+        pool.hedged_call(fn, 0.02, max_rate=1.0, stats=HedgeStats())
+    assert len(calls) == 2
+
+
+def test_hedge_to_faster_endpoint_wins(backend):
+    slow = FakeBackend(latency_s=1.0, tokens_per_s=0)
+    slow_url = slow.start()
+    try:
+        fb, fast_url = backend
+        stats = HedgeStats()
+        pool = EndpointPool([slow_url, fast_url])
+        started = time.perf_counter()
+        reply = pool.hedged_call(lambda url: post_server_api(MESSAGES, url, timeout=5), 0.05, max_rate=1.0, stats=stats)
+        assert reply == fb.reply_for(MESSAGES)
+        assert time.perf_counter() - started < 0.9
+        assert stats.summary()['hedge_wins'] == 1
+    finally:
+        slow.stop()
+
+
+def test_half_open_endpoint_gets_a_single_trial():
+    urls = ['http://recovering.invalid/', 'http://healthy.invalid/']
+    pool = EndpointPool(urls)
+    trip(pool, urls[0])
+    pool.endpoints[0].opened_at -= COOLDOWN_S
+    release = threading.Event()
+    calls = []
+
+    def fn(url):
+        calls.append(url)
+        if url == urls[0]:
+            release.wait(5)
+        return url
+
+    # Both endpoints are candidates; the trial goes to the recovering one
+    assert sorted(pool.candidates()) == sorted(urls)
+    assert pool.endpoints[0].state == HALF_OPEN
+    trial = threading.Thread(target=pool._call_in_turn, args=(fn, [urls[0]]))
+    trial.start()
+    while not pool.endpoints[0].trial_in_flight:
+        time.sleep(0.005)
+    # While the trial runs everyone else is sent to the healthy endpoint first
+    assert pool.candidates() == [urls[1], urls[0]]
+    for _ in range(5):
+        assert pool.call(fn) == urls[1]
+    release.set()
+    trial.join()
+    assert calls.count(urls[0]) == 1
+    assert pool.endpoints[0].state == CLOSED
+
+
+def test_hedge_cap_counts_the_hedged_request():
+    # Interleaved requests: each hedge marks its own slot, not the newest one
+    stats = HedgeStats(window=10)
+    slots = [stats.record_request() for _ in range(10)]
+    assert stats.try_hedge(0.2, slots[0])
+    assert not stats.try_hedge(0.2, slots[0])
+    assert stats.try_hedge(0.2, slots[3])
+    assert not stats.try_hedge(0.2, slots[5])
+    assert [s[0] for s in slots] == [True, False, False, True] + [False] * 6
+    assert stats.summary()['hedged'] == 2
+    assert stats.summary()['suppressed'] == 1
+
+
+def test_429_goes_to_the_rate_limiter_not_the_breaker(status_server):
+    limited = status_server(429, headers={'Retry-After': '0'})
+    spare = status_server(200)
+    pool = EndpointPool([limited.url, spare.url])
+    limiter = RateLimiter({'retries': 2})
+    with pytest.raises(requests.HTTPError):
+        limiter.call(lambda: pool.call(lambda url: post_server_api(MESSAGES, url, timeout=5)), 10)
+    assert limited.requests == 3
+    assert spare.requests == 0
+    assert limiter.summary()['throttled'] == 3
+    assert pool.status_rows()[0][1] == CLOSED
+    assert pool.status_rows()[0][5] == 0
@@ -0,0 +1,124 @@
+# File:        test_server.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the asyncio reference server against FakeUpstream:
+#              identical payloads share one upstream call, a full queue is
+#              refused with 503 and Retry-After, and a failed call reaches
+#              every caller that joined it.
+
+
+# Imports
+
+import asyncio
+import pytest
+from chatmax_server import ChatServer, FakeUpstream, HttpError, RETRY_AFTER_S
+
+
+# Constants
+
+HELLO = [{'role': 'user', 'content': 'hello'}]
+
+
+# Functions
+
+def run(coro_fn, upstream, **kwargs):
+    # Run coro_fn(server) on a fresh loop with a started (port 0) ChatServer
+    async def main():
+        server = ChatServer(upstream, **kwargs)
+        listener = await server.start('127.0.0.1', 0)
+        try:
+            return await coro_fn(server)
+        finally:
+            listener.close()
+            await listener.wait_closed()
+
+    return asyncio.run(main())
+
+
+def messages(i: int):
+    return [{'role': 'user', 'content': f'question {i}'}]
+
+
+def test_identical_payloads_share_one_upstream_call():
+    upstream = FakeUpstream(latency_s=0.1)
+
+    async def scenario(server):
+        results = await asyncio.gather(*(server.complete(list(HELLO)) for _ in range(5)))
+        return server, results
+
+    server, results = run(scenario, upstream)
+    assert [shared for _, shared in results].count(False) == 1
+    assert all(result == results[0][0] for result, _ in results)
+    assert results[0][0]['response'] == upstream.reply_for(HELLO)
+    assert server.stats['upstream_calls'] == 1 and server.stats['coalesced'] == 4
+
+
+def test_different_payloads_are_not_coalesced():
+    async def scenario(server):
+        await asyncio.gather(*(server.complete(messages(i)) for i in range(3)))
+        return server
+
+    server = run(scenario, FakeUpstream(latency_s=0.05))
+    assert server.stats['upstream_calls'] == 3 and server.stats['coalesced'] == 0
+
+
+def test_only_the_leader_reports_usage():
+    async def scenario(server):
+        return await asyncio.gather(*(server.chat({'messages': list(HELLO)}) for _ in range(3)))
+
+    replies = run(scenario, FakeUpstream(latency_s=0.05))
+    assert sum('usage' in reply for reply in replies) == 1
+    assert len({reply['response'] for reply in replies}) == 1
+
+
+def test_full_queue_is_refused_with_retry_after():
+    async def scenario(server):
+        # One slot busy, one caller queued: the queue (max 1) is now full
+        running = [asyncio.create_task(server.complete(messages(i))) for i in range(2)]
+        await asyncio.sleep(0.02)
+        with pytest.raises(HttpError) as refused:
+            await server.complete(messages(99))
+        # A payload already in flight still joins instead of being refused
+        joined, shared = await server.complete(messages(0))
+        done = await asyncio.gather(*running)
+        return server, refused.value, shared, joined, done
+
+    server, error, shared, joined, done = run(scenario, FakeUpstream(latency_s=0.2), concurrency=1, max_queue=1)
+    assert error.status == 503 and error.headers == {'Retry-After': str(RETRY_AFTER_S)}
+    assert shared and joined == done[0][0]
+    assert server.stats['rejected'] == 1 and server.stats['upstream_calls'] == 2
+    assert server.summary()['waiting'] == 0 and server.summary()['in_flight'] == 0
+
+
+def test_upstream_failure_reaches_every_joined_caller():
+    class FailingUpstream(FakeUpstream):
+        async def complete(self, messages):
+            await asyncio.sleep(0.05)
+            raise RuntimeError('upstream down')
+
+    async def scenario(server):
+        results = await asyncio.gather(*(server.complete(list(HELLO)) for _ in range(3)), return_exceptions=True)
+        # Nothing is left in flight, so the next call goes upstream again
+        retry = await asyncio.gather(server.complete(list(HELLO)), return_exceptions=True)
+        return server, results, retry
+
+    server, results, retry = run(scenario, FailingUpstream())
+    assert all(isinstance(r, RuntimeError) for r in results + retry)
+    assert server.stats['upstream_calls'] == 2 and server.stats['coalesced'] == 2
+
+
+def test_chat_maps_upstream_errors():
+    class FailingUpstream(FakeUpstream):
+        async def complete(self, messages):
+            raise RuntimeError('upstream down')
+
+    async def scenario(server):
+        with pytest.raises(HttpError) as bad_gateway:
+            await server.chat({'messages': list(HELLO)})
+        with pytest.raises(HttpError) as bad_request:
+            await server.chat({'messages': []})
+        return bad_gateway.value, bad_request.value
+
+    bad_gateway, bad_request = run(scenario, FailingUpstream())
+    assert bad_gateway.status == 502 and bad_request.status == 400
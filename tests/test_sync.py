@@ -0,0 +1,49 @@
+# File:        test_sync.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for delta sync in server mode against the fake backend:
+#              only new messages are sent after the first turn, and delta-sync
+#              requests are never hedged.
+
+
+# Imports
+
+import pytest
+# Server that speaks the delta-sync protocol
+from chatmax_bench import FakeBackend
+from chatmax_engine import call_server_api
+from chatmax_routing import HEDGES
+from chatmax_sync import SYNC
+
+
+# Functions
+
+@pytest.fixture
+def backend():
+    fb = FakeBackend(latency_s=0.0, tokens_per_s=0)
+    url = fb.start()
+    yield fb, url
+    fb.stop()
+
+
+def test_second_turn_sends_only_new_messages(backend):
+    fb, url = backend
+    SYNC.reset_stats()
+    messages = [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'Hello'}]
+    reply = call_server_api(messages, url, timeout=5, conversation_id='test-delta')
+    messages += [{'role': 'assistant', 'content': reply}, {'role': 'user', 'content': 'And again'}]
+    call_server_api(messages, url, timeout=5, conversation_id='test-delta')
+    assert SYNC.summary()['full'] == 1
+    assert SYNC.summary()['delta'] == 1
+    assert fb.cache.hits == 1
+
+
+def test_delta_sync_requests_are_not_hedged(backend):
+    fb, url = backend
+    fb.latency_s = 0.2
+    before = HEDGES.summary()['requests']
+    messages = [{'role': 'user', 'content': 'Hello'}]
+    call_server_api(messages, url, timeout=5, hedge_after=0.01, hedge_max_rate=1.0, conversation_id='test-nohedge')
+    assert fb.requests == 1
+    assert HEDGES.summary()['requests'] == before
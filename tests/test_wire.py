@@ -0,0 +1,129 @@
+# File:        test_wire.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for server-mode request encoding: gzip bodies, the plain
+#              retry (and no further gzip) after a server rejects them, and
+#              the WIRE byte counters.
+
+
+# Imports
+
+# Local gzip-aware stub server
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import json
+import threading
+# Fixtures
+import pytest
+from chatmax_engine import post_server_api
+from chatmax_wire import WIRE, encode_body, merge_compression_settings
+
+
+# Constants
+
+COMPRESSION = {'enabled': True, 'min_bytes': 0, 'level': 6}
+MESSAGES = [{'role': 'user', 'content': 'hello ' * 200}]
+
+
+# Functions
+
+class GzipServer:
+    # Answers {"response": ...}; a gzip request body is refused with `reject_status`
+    # unless accept_gzip is set. Records (Content-Encoding, decoded JSON) per request
+
+    def __init__(self, accept_gzip: bool, reject_status: int = 415):
+        self.seen = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                encoding = self.headers.get('Content-Encoding')
+                if encoding == 'gzip' and not accept_gzip:
+                    server.seen.append((encoding, None))
+                    self.send_response(reject_status)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                payload = json.loads(gzip.decompress(raw) if encoding == 'gzip' else raw)
+                server.seen.append((encoding, payload))
+                body = json.dumps({'response': 'r' * 2000}).encode('utf-8')
+                if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                    body = gzip.compress(body)
+                    self.send_response(200)
+                    self.send_header('Content-Encoding', 'gzip')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}/'
+        threading.Thread(target=self._httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def gzip_server():
+    started = []
+
+    def start(accept_gzip: bool, reject_status: int = 415):
+        server = GzipServer(accept_gzip, reject_status)
+        started.append(server)
+        return server
+
+    WIRE.reset()
+    yield start
+    for server in started:
+        server.stop()
+
+
+def test_gzip_body_is_accepted(gzip_server):
+    server = gzip_server(accept_gzip=True)
+    assert post_server_api(MESSAGES, server.url, compression=COMPRESSION) == 'r' * 2000
+    assert server.seen == [('gzip', {'messages': MESSAGES})]
+    summary = WIRE.summary()
+    assert summary['requests'] == 1 and summary['compressed'] == 1 and summary['fallbacks'] == 0
+    assert summary['request_wire'] < summary['request_json'] and summary['request_saved'] > 0.5
+    assert summary['responses_compressed'] == 1 and summary['response_wire'] < summary['response_json']
+
+
+@pytest.mark.parametrize('status', [400, 415, 422])
+def test_rejected_gzip_is_retried_plain_and_not_sent_again(gzip_server, status):
+    server = gzip_server(accept_gzip=False, reject_status=status)
+    assert post_server_api(MESSAGES, server.url, compression=COMPRESSION) == 'r' * 2000
+    assert server.seen == [('gzip', None), (None, {'messages': MESSAGES})]
+    # The endpoint is remembered: the next request goes plain straight away
+    post_server_api(MESSAGES, server.url, compression=COMPRESSION)
+    assert server.seen[2] == (None, {'messages': MESSAGES})
+    summary = WIRE.summary()
+    assert summary['fallbacks'] == 1 and summary['requests'] == 2 and summary['compressed'] == 0
+    assert summary['request_wire'] == summary['request_json']
+
+
+def test_other_endpoints_still_get_gzip(gzip_server):
+    refusing = gzip_server(accept_gzip=False)
+    accepting = gzip_server(accept_gzip=True)
+    post_server_api(MESSAGES, refusing.url, compression=COMPRESSION)
+    post_server_api(MESSAGES, accepting.url, compression=COMPRESSION)
+    assert accepting.seen[0][0] == 'gzip'
+
+
+def test_small_or_disabled_bodies_are_plain():
+    body, headers, size = encode_body({'messages': MESSAGES}, {'enabled': True, 'min_bytes': 10 ** 6})
+    assert 'Content-Encoding' not in headers and len(body) == size
+    body, headers, size = encode_body({'messages': MESSAGES}, None)
+    assert 'Content-Encoding' not in headers
+    assert merge_compression_settings({'enabled': 1, 'level': 42, 'min_bytes': -5}) == {'enabled': True, 'min_bytes': 0, 'level': 9}
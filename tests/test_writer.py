@@ -0,0 +1,61 @@
+# File:        test_writer.py
+# Author:      Colin Fajardo
+# Version:     0.4.4
+#
+# Description: Tests for the write-behind writer: coalescing, reads of pending
+#              content, deletes, and pending writes reaching the disk at exit.
+
+
+# Imports
+
+import os
+import subprocess
+import sys
+from chatmax_writer import WriteBehind
+
+
+# Constants
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Functions
+
+def test_rapid_writes_are_coalesced(tmp_path):
+    path = str(tmp_path / 'settings.json')
+    writer = WriteBehind()
+    # Holding the writer's lock keeps the thread from picking anything up
+    with writer._cond:
+        for i in range(5):
+            writer.submit(path, f'version {i}')
+        assert writer.pending_text(path) == (True, 'version 4')
+        assert writer.read_text(path) == 'version 4'
+        assert not os.path.exists(path)
+    assert writer.flush(5.0)
+    assert writer.coalesced == 4
+    assert writer.writes == 1
+    with open(path, encoding='utf-8') as f:
+        assert f.read() == 'version 4'
+    assert writer.pending_text(path) == (False, None)
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_remove_after_write(tmp_path):
+    path = str(tmp_path / 'presets.json')
+    writer = WriteBehind()
+    writer.submit(path, 'x')
+    writer.flush(5.0)
+    writer.remove(path)
+    assert writer.read_text(path) is None
+    writer.flush(5.0)
+    assert not os.path.exists(path)
+    assert writer.pending_count() == 0
+
+
+def test_pending_writes_reach_disk_at_exit(tmp_path):
+    path = str(tmp_path / 'preferences.json')
+    script = (f'import sys; sys.path.insert(0, {ROOT!r})\n'
+              'from chatmax_writer import WRITER\n'
+              f'WRITER.submit({path!r}, "x" * 5_000_000)\n')
+    subprocess.run([sys.executable, '-c', script], check=True, timeout=60)
+    assert os.path.getsize(path) == 5_000_000